@@ -0,0 +1,82 @@
+"""Serialization benchmark: stdlib json vs the fast JSON backends in main.py.
+
+Measures CPU time per request for the three hot serialization paths:
+  - audit line        one profile_calculation entry written by _persist_log
+  - profile response  the /calculate-profile body (stdlib path = FastAPI's
+                      jsonable_encoder + json.dumps, as before FastJSONResponse)
+  - tool result       calculate_profile result handed to the LLM as JSON text
+                      (stdlib path = the old loopback HTTP call's response body)
+
+Usage (from the repo root):
+    python backend/bench_serialization.py [iterations]
+"""
+import json, sys, time
+
+from fastapi.encoders import jsonable_encoder
+
+import main
+
+ANSWERS = {
+    "p1_1": 1, "p1_2": 0, "p1_3": 2,
+    "p2_1": 2, "p2_2": 2, "p2_3": 3, "p2_4": 1, "p2_5": 3,
+    "p3_1": 2, "p3_2": 2, "p3_3": 1, "p3_4": 2, "p3_5": 2,
+    "p4_1": 2, "p4_2": 3, "p4_3": 1, "p4_4": 2, "p4_5": 2,
+    "p5_1": 2, "p5_2": 0, "p5_3": 2, "p5_4": 3,
+    "p6_1": 1, "p6_2": 2, "p6_3": 2,
+}
+
+
+def _cpu_per_call(fn, iterations):
+    """CPU seconds per call (best of 3 runs)."""
+    best = float("inf")
+    for _ in range(3):
+        start = time.process_time()
+        for _ in range(iterations):
+            fn()
+        best = min(best, (time.process_time() - start) / iterations)
+    return best
+
+
+def main_bench(iterations):
+    result = main._build_profile_result(ANSWERS, main._get_ruleset())
+    entry = main.AuditRecord.from_entry({
+        "type": "profile_calculation", "profile": result["profile"], "score": 50,
+        "restrictions_count": 1, "rules_version": result["rules_version"],
+        "rules_hash": result["rules_hash"], "result": result,
+    }).to_dict()
+
+    def stdlib_response():
+        return json.dumps(jsonable_encoder(result), ensure_ascii=False, allow_nan=False,
+                          separators=(",", ":")).encode("utf-8")
+
+    baseline = {
+        "audit line": lambda: json.dumps(entry, default=str) + "\n",
+        "profile response": stdlib_response,
+        "tool result": lambda: stdlib_response().decode("utf-8"),
+    }
+    stdlib_cost = {name: _cpu_per_call(fn, iterations) for name, fn in baseline.items()}
+
+    backends = ["stdlib"] + [name for name, mod in (("orjson", main.orjson), ("msgspec", main.msgspec)) if mod]
+    print(f"Response size: {len(stdlib_response()) / 1024:.1f} KB, audit line: {len(baseline['audit line']()) / 1024:.1f} KB")
+    print(f"Active backend: {main.JSON_BACKEND}\n")
+    print(f"{'path':<18}{'old stdlib':>12}" + "".join(f"{b:>12}" for b in backends))
+
+    per_request = {b: 0.0 for b in backends}
+    for name in baseline:
+        row = f"{name:<18}{stdlib_cost[name] * 1e6:>10.1f}us"
+        for backend in backends:
+            _, dumps, _ = main._select_json_backend(backend)
+            payload = entry if name == "audit line" else result
+            cost = _cpu_per_call(lambda: dumps(payload), iterations)
+            per_request[backend] += cost
+            row += f"{cost * 1e6:>10.1f}us"
+        print(row)
+
+    total_old = sum(stdlib_cost.values())
+    print(f"\n{'per request':<18}{total_old * 1e6:>10.1f}us" + "".join(f"{c * 1e6:>10.1f}us" for c in per_request.values()))
+    for backend, cost in per_request.items():
+        print(f"  {backend}: saves {(total_old - cost) * 1e6:.1f}us CPU per profile request ({total_old / cost:.1f}x)")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -1,10 +1,16 @@
-import os, json, uuid, time
+import os, io, sys, json, gzip, uuid, time, array, queue, atexit, shutil, hashlib, hmac, asyncio, bisect, itertools, signal, threading, logging, cProfile, pstats
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
-from fastapi import FastAPI, Request
+from enum import Enum
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response
+from starlette.background import BackgroundTask
+from starlette.requests import ClientDisconnect
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+from typing import Annotated, Any, Optional, Union
 import httpx
 from dotenv import load_dotenv
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -12,9 +18,74 @@ from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
 load_dotenv()
+logger = logging.getLogger(__name__)
+
+# ---- JSON serialization ----
+# orjson or msgspec when installed (pip install .[fast]), stdlib otherwise.
+# Used for audit lines, API responses, tool results and upstream payloads.
+# JSON_BACKEND=orjson|msgspec|stdlib forces one.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _select_json_backend(name):
+    """Return (name, dumps, loads). dumps -> bytes; non-JSON types fall back
+    to str(); loads accepts str or bytes and raises json.JSONDecodeError."""
+    if name in ("auto", "orjson") and orjson is not None:
+        def dumps(obj):
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+        return "orjson", dumps, orjson.loads
+    if name in ("auto", "msgspec") and msgspec is not None:
+        encoder = msgspec.json.Encoder(enc_hook=str)
+        decoder = msgspec.json.Decoder()
+
+        def loads(data):
+            try:
+                return decoder.decode(data)
+            except msgspec.DecodeError as e:
+                raise json.JSONDecodeError(str(e), data if isinstance(data, str) else "", 0) from None
+        return "msgspec", encoder.encode, loads
+    if name not in ("auto", "stdlib"):
+        raise ValueError(f"JSON_BACKEND={name!r} is not installed or unknown")
+
+    def dumps(obj):
+        return json.dumps(obj, default=str, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return "stdlib", dumps, json.loads
+
+
+JSON_BACKEND, _json_dumps, _json_loads = _select_json_backend(os.getenv("JSON_BACKEND", "auto"))
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the selected fast serializer. Returning one
+    directly from a handler also skips FastAPI's jsonable_encoder pass."""
+
+    def render(self, content) -> bytes:
+        return _json_dumps(content)
+
+
+_startup_hooks = []  # async callables run on startup (start background workers)
+_shutdown_hooks = []  # async callables run on shutdown (drain queues, close shared clients)
+
+
+@asynccontextmanager
+async def _lifespan(app):
+    for hook in _startup_hooks:
+        await hook()
+    yield
+    for hook in reversed(_shutdown_hooks):  # last started, first stopped
+        await hook()
+
 
 limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(title="Explainable AI Financial Advisor")
+app = FastAPI(title="Explainable AI Financial Advisor", default_response_class=FastJSONResponse,
+              lifespan=_lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -41,21 +112,1073 @@ LLM_API_KEY = os.getenv("GROQ_API_KEY", "")
 AUDIT_KEY = os.getenv("AUDIT_KEY", "goose-audit-2024")
 
 # ---- Storage ----
-sessions = {}
-audit_log = []
+sessions = {}   # session_id -> Session
+audit_log = []  # AuditRecord, oldest first
+
+
+# ---- Compact in-memory records ----
+# Long-running processes keep every audit entry and chat turn in memory, so
+# they are stored as slotted records with epoch timestamps instead of dicts
+# with repeated keys and datetime strings. to_dict() renders the original
+# JSON shape for endpoints and the persistent log.
+
+class AuditType(str, Enum):
+    LLM_CALL = "llm_call"
+    PROFILE = "profile_calculation"
+    TEXT_CHAT = "text_chat"
+    TEXT_CHAT_TOOL_CALL = "text_chat_tool_call"
+    STEERING = "steering_demo"
+    WEBHOOK = "elevenlabs_webhook"
+    CONFIG_RELOAD = "config_reload"
+
+
+# Field order per entry type; values are stored positionally
+_AUDIT_FIELDS = {
+    AuditType.LLM_CALL: ("id", "source", "model", "messages_count", "last_user_message", "has_tools",
+                         "response", "tool_calls", "status", "error", "usage", "latency_ms", "ttft_ms"),
+    AuditType.PROFILE: ("session_id", "profile", "score", "restrictions_count", "rules_version", "result",
+                        "bulk_id", "client_ref"),
+    AuditType.TEXT_CHAT: ("session_id", "user_message", "response", "model", "usage", "latency_ms"),
+    AuditType.TEXT_CHAT_TOOL_CALL: ("session_id", "tool", "tool_args", "model"),
+    AuditType.STEERING: ("prompt", "preset", "model", "default_response", "steered_response"),
+    AuditType.WEBHOOK: ("session_id", "transcript_length"),
+    AuditType.CONFIG_RELOAD: ("content_version", "content_hash", "rules_version", "changed", "trigger"),
+}
+# Low-cardinality string values shared across entries
+_INTERNED_FIELDS = frozenset({"session_id", "source", "model", "status", "preset", "tool", "profile", "rules_version"})
+_ABSENT = object()
+
+
+def _fmt_ts(ts: float) -> str:
+    """Render an epoch timestamp the way entries always have (str(datetime))."""
+    return str(datetime.fromtimestamp(ts))
+
+
+@dataclass(slots=True, eq=False)
+class AuditRecord:
+    """One audit entry. Profile calculations hold a reference to their result,
+    which is shared with the session history rather than copied."""
+    ts: float
+    type: AuditType
+    rules_hash: str
+    values: tuple
+    extra: Optional[dict] = None
+
+    @classmethod
+    def from_entry(cls, entry: dict) -> "AuditRecord":
+        """Compact an entry dict. Its "timestamp" (epoch seconds or the
+        rendered string) is kept if given, else the record is stamped now."""
+        type_ = AuditType(entry["type"])
+        fields = _AUDIT_FIELDS[type_]
+        values = []
+        for key in fields:
+            value = entry.get(key, _ABSENT)
+            if key in _INTERNED_FIELDS and type(value) is str:
+                value = sys.intern(value)
+            values.append(value)
+        extra = {k: v for k, v in entry.items()
+                 if k not in fields and k not in ("type", "timestamp", "rules_hash")}
+        ts = entry.get("timestamp")
+        if ts is None:
+            ts = time.time()
+        elif isinstance(ts, str):
+            ts = datetime.fromisoformat(ts).timestamp()
+        return cls(ts, type_, entry["rules_hash"], tuple(values), extra or None)
+
+    def get(self, key, default=None):
+        fields = _AUDIT_FIELDS[self.type]
+        if key in fields:
+            value = self.values[fields.index(key)]
+            return default if value is _ABSENT else value
+        if key == "type":
+            return self.type.value
+        if key == "timestamp":
+            return _fmt_ts(self.ts)
+        if key == "rules_hash":
+            return self.rules_hash
+        return (self.extra or {}).get(key, default)
+
+    def to_dict(self) -> dict:
+        entry = {"timestamp": _fmt_ts(self.ts), "type": self.type.value}
+        for key, value in zip(_AUDIT_FIELDS[self.type], self.values):
+            if value is not _ABSENT:
+                entry[key] = value
+        entry["rules_hash"] = self.rules_hash
+        if self.extra:
+            entry.update(self.extra)
+        return entry
+
+
+@dataclass(slots=True, eq=False)
+class HistoryItem:
+    """One conversation turn. Tool turns keep a reference to the tool result
+    (the profile result recorded in the audit log) instead of its JSON text."""
+    source: str                      # "user" | "assistant" | "tool"
+    transcript: Optional[str]
+    ts: float = field(default_factory=time.time)
+    tool_calls: Optional[list] = None
+    tool_call_id: Optional[str] = None
+    result: Optional[dict] = None
+
+    def text(self) -> str:
+        if self.result is not None:
+            return _json_dumps(self.result).decode("utf-8")
+        return self.transcript or ""
+
+    def to_dict(self) -> dict:
+        item = {"source": self.source, "transcript": self.text(), "timestamp": _fmt_ts(self.ts)}
+        if self.tool_calls:
+            item["tool_calls"] = self.tool_calls
+        if self.tool_call_id:
+            item["tool_call_id"] = self.tool_call_id
+        return item
+
+
+@dataclass(slots=True, eq=False)
+class Session:
+    created: float = field(default_factory=time.time)
+    history: list = field(default_factory=list)  # HistoryItem
+    connections: int = 0  # open /ws/chat connections
 
 # ---- Persistent append-only log ----
 import pathlib as _pathlib
-_LOG_DIR = _pathlib.Path(__file__).resolve().parent / "logs"
-_LOG_DIR.mkdir(exist_ok=True)
-_LOG_FILE = _LOG_DIR / "audit.jsonl"
+_LOG_DIR = _pathlib.Path(os.getenv("LOG_DIR") or _pathlib.Path(__file__).resolve().parent / "logs")
+_LOG_FILE = _LOG_DIR / "audit.jsonl"  # active segment
+
+# Segments: the active file is sealed once it reaches AUDIT_SEGMENT_MAX_BYTES
+# or AUDIT_SEGMENT_MAX_AGE seconds, moved to logs/segments/ and compressed
+# (zstd if installed, else gzip) in the background. logs/segments.json
+# indexes each sealed segment's time range, entry count and entry types so
+# queries only open the segments they need. AUDIT_RETENTION_DAYS > 0 deletes
+# sealed segments older than that (MiFID II requires at least 5 years).
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AUDIT_SEGMENT_MAX_BYTES = int(os.getenv("AUDIT_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+AUDIT_SEGMENT_MAX_AGE = int(os.getenv("AUDIT_SEGMENT_MAX_AGE", "86400"))
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "0"))
+_SEGMENT_DIR = _LOG_DIR / "segments"
+_INDEX_FILE = _LOG_DIR / "segments.json"
+
+# Tamper evidence: every line ends with ,"chain":"<sha256>"} where the hash
+# covers the previous line's hash plus this line's payload (the line without
+# that suffix); the chain runs across segments. Every AUDIT_CHECKPOINT_EVERY
+# lines, and whenever a segment is sealed, an HMAC-signed checkpoint
+# (segment, entry count, byte offset, chain hash) goes to
+# audit.checkpoints.jsonl, so verification can resume from a checkpoint
+# instead of rehashing everything.
+# The signing key is its own secret, never AUDIT_KEY (that one has a default
+# and travels in query strings). Without it no checkpoint is written or
+# trusted, and verification rehashes from the first retained entry.
+# Checkpoints signed under another key report as bad signatures.
+AUDIT_SIGNING_KEY = os.getenv("AUDIT_SIGNING_KEY", "")
+AUDIT_SIGNING_KEY = AUDIT_SIGNING_KEY.encode("utf-8") if AUDIT_SIGNING_KEY not in ("", AUDIT_KEY) else None
+AUDIT_CHECKPOINT_EVERY = int(os.getenv("AUDIT_CHECKPOINT_EVERY", "1000"))
+_CHECKPOINT_FILE = _LOG_DIR / "audit.checkpoints.jsonl"
+_GENESIS_HASH = "0" * 64
+_CHAIN_PREFIX = b',"chain":"'
+_CHAIN_SUFFIX_LEN = len(_CHAIN_PREFIX) + 64 + 2  # ,"chain":"<64 hex>"}
+
+_segments = []  # sealed segment index entries, oldest first
+_index_lock = threading.Lock()  # guards _segments and segment files vs. the compressor
+_active = {}  # stats of the active segment (same shape as an index entry)
+_chain = {"segment": 0, "head": _GENESIS_HASH, "entries": 0, "offset": 0}  # writer state
+_verified = None  # last verified position: {"segment", "offset", "hash", "entries"}
+_log_lock = threading.Lock()  # held by the audit writer for each write (see _audit_writer_loop)
+
+def _new_segment_stats(segment, chain_hash, entries):
+    return {
+        "segment": segment, "first_ts": None, "last_ts": None, "entries": 0, "types": {},
+        "chain_start": {"hash": chain_hash, "entries": entries},
+    }
 
-def _persist_log(entry: dict):
+def _count_in_segment(stats, ts, entry_type):
+    # min/max: entries stamped when a request came in can reach the log late
+    if stats["first_ts"] is None or ts < stats["first_ts"]:
+        stats["first_ts"] = ts
+    if stats["last_ts"] is None or ts > stats["last_ts"]:
+        stats["last_ts"] = ts
+    stats["entries"] += 1
+    stats["types"][entry_type] = stats["types"].get(entry_type, 0) + 1
+
+def _save_index():
+    tmp = _INDEX_FILE.with_suffix(".tmp")
+    tmp.write_bytes(_json_dumps({"segments": _segments}))
+    os.replace(tmp, _INDEX_FILE)
+
+def _open_segment(desc):
+    """Binary line stream of a segment's uncompressed content. desc=None is
+    the active segment."""
+    if desc is None:
+        try:
+            return open(_LOG_FILE, "rb")
+        except FileNotFoundError:  # nothing written since the last rotation
+            return io.BytesIO()
+    with _index_lock:  # the compressor swaps files under this lock
+        desc = next(d for d in _segments if d["segment"] == desc["segment"])
+        path = _SEGMENT_DIR / desc["file"]
+        if desc["codec"] == "zstd":
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+        if desc["codec"] == "gzip":
+            return gzip.open(path, "rb")
+        return open(path, "rb")
+
+_compressors = set()  # running _compress_segment threads, joined before the log is handed over
+
+def _start_compression(desc):
+    def run():
+        try:
+            _compress_segment(desc)
+        finally:
+            _compressors.discard(thread)
+
+    thread = threading.Thread(target=run, name=f"compress-{desc['segment']}", daemon=True)
+    _compressors.add(thread)
+    thread.start()
+
+def _compress_segment(desc):
+    """Compress a sealed segment in place (runs in a background thread)."""
+    src = _SEGMENT_DIR / desc["file"]
+    codec = "zstd" if zstandard is not None else "gzip"
+    dst = src.with_name(src.name + (".zst" if codec == "zstd" else ".gz"))
+    tmp = dst.with_name(dst.name + ".tmp")
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+        if codec == "zstd":
+            zstandard.ZstdCompressor(level=10).copy_stream(fin, fout)
+        else:
+            with gzip.GzipFile(fileobj=fout, mode="wb", compresslevel=6) as gz:
+                shutil.copyfileobj(fin, gz, 1024 * 1024)
+    os.replace(tmp, dst)
+    with _index_lock:
+        desc.update(file=dst.name, codec=codec, stored_bytes=dst.stat().st_size)
+        _save_index()
+        src.unlink()
+
+def _prune_segments(now):
+    if AUDIT_RETENTION_DAYS <= 0:
+        return
+    cutoff = now - AUDIT_RETENTION_DAYS * 86400
+    with _index_lock:
+        for desc in _segments:
+            if not desc.get("pruned") and desc["last_ts"] is not None and desc["last_ts"] < cutoff:
+                (_SEGMENT_DIR / desc["file"]).unlink(missing_ok=True)
+                desc.update(pruned=True, stored_bytes=0)
+        _save_index()
+
+def _rotate_segment(now):
+    """Seal the active segment: checkpoint its end, move it to segments/,
+    start a fresh active file and compress the sealed one in the background."""
+    _write_checkpoint()  # signed anchor for whoever verifies the next segment
+    seq = _chain["segment"]
+    sealed = _SEGMENT_DIR / f"audit-{seq:06d}.jsonl"
+    os.replace(_LOG_FILE, sealed)
+    desc = {
+        **_active, "file": sealed.name, "codec": None,
+        "bytes": _chain["offset"], "stored_bytes": _chain["offset"],
+        "chain_end": {"hash": _chain["head"], "entries": _chain["entries"]},
+    }
+    with _index_lock:
+        _segments.append(desc)
+        _save_index()
+    _active.clear()
+    _active.update(_new_segment_stats(seq + 1, _chain["head"], _chain["entries"]))
+    _chain.update(segment=seq + 1, offset=0)
+    _start_compression(desc)
+    _prune_segments(now)
+
+def _chain_hash(prev_hash: str, payload: bytes) -> str:
+    return hashlib.sha256(prev_hash.encode("ascii") + payload).hexdigest()
+
+def _split_chained(line: bytes):
+    """Split a log line into (payload, chain hash); hash is None for legacy
+    lines written before chaining."""
+    body = line.rstrip(b"\n")
+    suffix = body[-_CHAIN_SUFFIX_LEN:]
+    if len(body) <= _CHAIN_SUFFIX_LEN or not suffix.startswith(_CHAIN_PREFIX) or not body.endswith(b'"}'):
+        return body, None
+    return body[:-_CHAIN_SUFFIX_LEN] + b"}", suffix[len(_CHAIN_PREFIX):-2].decode("ascii")
+
+def _sign_checkpoint(segment: Optional[int], entries: int, offset: int, chain_hash: str) -> str:
+    # Checkpoints written before segmentation carry no segment (they refer to segment 0)
+    fields = (entries, offset, chain_hash) if segment is None else (segment, entries, offset, chain_hash)
+    message = ":".join(map(str, fields)).encode("ascii")
+    return hmac.new(AUDIT_SIGNING_KEY, message, hashlib.sha256).hexdigest()
+
+def _read_checkpoints():
+    """All checkpoints, each with "valid" set from its signature (none
+    without a signing key)."""
+    checkpoints = []
+    if AUDIT_SIGNING_KEY is not None and _CHECKPOINT_FILE.exists():
+        with open(_CHECKPOINT_FILE, "rb") as f:
+            for line in f:
+                try:
+                    cp = _json_loads(line)
+                except json.JSONDecodeError:
+                    continue
+                expected = _sign_checkpoint(cp.get("segment"), cp.get("entries", -1),
+                                            cp.get("offset", -1), cp.get("hash", ""))
+                cp["valid"] = hmac.compare_digest(expected, str(cp.get("sig", "")))
+                cp.setdefault("segment", 0)
+                checkpoints.append(cp)
+    return checkpoints
+
+def _write_checkpoint():
+    if AUDIT_SIGNING_KEY is None:
+        return
+    cp = {"segment": _chain["segment"], "entries": _chain["entries"], "offset": _chain["offset"],
+          "hash": _chain["head"], "ts": time.time()}
+    cp["sig"] = _sign_checkpoint(cp["segment"], cp["entries"], cp["offset"], cp["hash"])
+    with open(_CHECKPOINT_FILE, "ab") as f:
+        f.write(_json_dumps(cp) + b"\n")
+
+def _line_stats(line: bytes):
+    """(epoch ts, type) of a persisted line, or None if unreadable."""
+    try:
+        entry = _json_loads(line)
+        return datetime.fromisoformat(entry["timestamp"]).timestamp(), entry.get("type", "")
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _load_log_state():
+    """Startup (see _start_audit_writer): create the log directories, load
+    the segment index, resume unfinished compression, and restore the active
+    segment's stats and the writer's chain head (from the newest signed
+    checkpoint in the active segment, reading forward)."""
+    if AUDIT_SIGNING_KEY is None:
+        logger.warning("AUDIT_SIGNING_KEY is not set (or equals AUDIT_KEY): audit checkpoints are not signed")
+    _SEGMENT_DIR.mkdir(parents=True, exist_ok=True)
+    if _INDEX_FILE.exists():
+        _segments.extend(_json_loads(_INDEX_FILE.read_bytes())["segments"])
+    for desc in _segments:
+        if desc["codec"] is None and not desc.get("pruned"):
+            _start_compression(desc)
+
+    last = _segments[-1] if _segments else None
+    segment = last["segment"] + 1 if last else 0
+    start_hash, start_entries = (last["chain_end"]["hash"], last["chain_end"]["entries"]) if last else (_GENESIS_HASH, 0)
+    _active.update(_new_segment_stats(segment, start_hash, start_entries))
+
+    size = _LOG_FILE.stat().st_size if _LOG_FILE.exists() else 0
+    head, entries, resume = start_hash, start_entries, 0
+    for cp in reversed(_read_checkpoints()):
+        if cp["valid"] and cp.get("segment") == segment and cp["offset"] <= size:
+            head, entries, resume = cp["hash"], cp["entries"], cp["offset"]
+            break
+    if size:
+        with open(_LOG_FILE, "rb") as f:
+            offset = 0
+            for line in f:
+                stats = _line_stats(line)
+                if stats is not None:
+                    _count_in_segment(_active, *stats)
+                if offset >= resume:
+                    _, chain_hash = _split_chained(line)
+                    if chain_hash is not None:
+                        head, entries = chain_hash, entries + 1
+                offset += len(line)
+    _chain.update(segment=segment, head=head, entries=entries, offset=size)
+
+def _verify_audit_chain(full: bool = False) -> dict:
+    """Stream-verify the hash chain and checkpoints across all segments.
+    Incremental by default: resumes where the previous verification stopped,
+    or at the newest validly signed checkpoint after a restart. full=True
+    rehashes from the oldest retained segment. Reports throughput in MB/s."""
+    global _verified
+    checkpoints = _read_checkpoints()
+    bad_sigs = [cp for cp in checkpoints if not cp["valid"]]
+    signed = {(cp["segment"], cp["offset"]): cp for cp in checkpoints if cp["valid"]}
+    with _index_lock:
+        sealed = [dict(d) for d in _segments]
+    with _log_lock:  # no write in progress: head, offset and file size agree
+        writer = dict(_chain)
+        active_size = _LOG_FILE.stat().st_size if _LOG_FILE.exists() else 0
+
+    report = {
+        "ok": True, "mode": "full" if full else "incremental",
+        "entries_verified": 0, "legacy_lines": 0, "checkpoints_checked": 0, "segments_read": 0,
+        "bad_checkpoint_signatures": len(bad_sigs), "signed_checkpoints": AUDIT_SIGNING_KEY is not None,
+        "error": None,
+    }
+    if bad_sigs:
+        report.update(ok=False, error={"reason": "checkpoint signature mismatch", "segment": bad_sigs[0].get("segment"),
+                                       "entries": bad_sigs[0].get("entries")})
+
+    start = {"segment": 0, "offset": 0, "hash": _GENESIS_HASH, "entries": 0}
+    retained = [d for d in sealed if not d.get("pruned")]
+    if not full and _verified is not None:
+        start = dict(_verified)
+    elif not full and signed:
+        cp = max(signed.values(), key=lambda c: (c["segment"], c["offset"]))
+        start = {"segment": cp["segment"], "offset": cp["offset"], "hash": cp["hash"], "entries": cp["entries"]}
+    elif len(retained) < len(sealed):
+        # Older segments were pruned: start from the signed checkpoint sealing the last pruned one
+        last_pruned = [d for d in sealed if d.get("pruned")][-1]
+        anchor = signed.get((last_pruned["segment"], last_pruned["bytes"]))
+        if anchor is None:
+            report.update(ok=False, error={"reason": "no signed anchor after pruned segments"})
+            return report
+        start = {"segment": last_pruned["segment"] + 1, "offset": 0,
+                 "hash": anchor["hash"], "entries": anchor["entries"]}
+    report.update(start_segment=start["segment"], start_offset=start["offset"], start_entries=start["entries"])
+
+    plan = [d for d in retained if d["segment"] >= start["segment"]] + [None]  # None = active
+    prev, entries = start["hash"], start["entries"]
+    failure = None
+    position = (start["segment"], start["offset"])
+    scanned = 0
+    t0 = time.perf_counter()
+    for desc in plan:
+        segment = desc["segment"] if desc else writer["segment"]
+        limit = desc["bytes"] if desc else active_size
+        skip = start["offset"] if segment == start["segment"] else 0
+        if skip > limit:
+            failure = {"reason": "segment truncated before checkpoint", "segment": segment}
+            break
+        report["segments_read"] += 1
+        offset = 0
+        with _open_segment(desc) as f:
+            if desc is None:
+                f.seek(skip)
+                offset = skip
+            for line in f:
+                if offset < skip:  # sealed segments stream up to the resume point
+                    offset += len(line)
+                    continue
+                if offset + len(line) > limit or not line.endswith(b"\n"):
+                    break  # still being written; picked up next time
+                payload, chain_hash = _split_chained(line)
+                if chain_hash is None:
+                    if entries == 0:
+                        report["legacy_lines"] += 1  # written before chaining was enabled
+                        offset += len(line)
+                        scanned += len(line)
+                        continue
+                    failure = {"reason": "unchained line inside chain", "segment": segment, "offset": offset}
+                    break
+                if _chain_hash(prev, payload) != chain_hash:
+                    failure = {"reason": "hash mismatch", "segment": segment,
+                               "offset": offset, "entry": entries + 1}
+                    break
+                prev, entries = chain_hash, entries + 1
+                offset += len(line)
+                scanned += len(line)
+                report["entries_verified"] += 1
+                cp = signed.get((segment, offset))
+                if cp is not None and offset > skip:
+                    report["checkpoints_checked"] += 1
+                    if cp["hash"] != prev or cp["entries"] != entries:
+                        failure = {"reason": "checkpoint does not match chain",
+                                   "segment": segment, "offset": offset}
+                        break
+        if failure:
+            break
+        position = (segment, offset)
+        if desc is not None and offset != desc["bytes"]:
+            failure = {"reason": "sealed segment length mismatch", "segment": segment}
+            break
+    elapsed = time.perf_counter() - t0
+    report.update(
+        end_segment=position[0], end_offset=position[1], entries=entries, head=prev, bytes=scanned,
+        seconds=round(elapsed, 4), mb_per_s=round(scanned / elapsed / 1e6, 1) if elapsed > 0 else None,
+        # The writer's in-memory head catches truncation of the unsealed tail
+        matches_writer_head=prev == writer["head"] if position == (writer["segment"], writer["offset"]) else None,
+    )
+    if failure is None and report["matches_writer_head"] is False:
+        failure = {"reason": "log head differs from writer head"}
+    if failure is not None:
+        report.update(ok=False, error=failure)
+    if report["ok"]:
+        _verified = {"segment": position[0], "offset": position[1], "hash": prev, "entries": entries}
+    return report
+
+def _read_lines_backwards(path, block_size=64 * 1024):
+    """Yield complete lines of a file newest first, reading fixed-size blocks
+    from the end so a tail query doesn't load the whole active segment."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos, tail = f.tell(), b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line
+        if tail:
+            yield tail
+
+def _query_log(last_n: int, entry_type: Optional[str] = None,
+               since: Optional[float] = None, until: Optional[float] = None) -> dict:
+    """Newest last_n persisted entries matching the filters, oldest first.
+    The segment index rules out segments by time range and entry type before
+    any file is opened; the active segment is read backwards from the end."""
+    with _index_lock:
+        candidates = [dict(d) for d in _segments if not d.get("pruned")]
+        total = sum(d["entries"] for d in _segments) + _active.get("entries", 0)
+    candidates.append(None)  # active segment
+
+    def overlaps(stats):
+        if not stats or not stats.get("entries"):
+            return False
+        if entry_type and not stats["types"].get(entry_type):
+            return False
+        if since is not None and stats["last_ts"] < since:
+            return False
+        return until is None or stats["first_ts"] <= until
+
+    def matches(line):
+        try:
+            entry = _json_loads(line)
+        except json.JSONDecodeError:
+            return None
+        if entry_type and entry.get("type") != entry_type:
+            return None
+        if since is not None or until is not None:
+            ts = datetime.fromisoformat(entry["timestamp"]).timestamp()
+            if (since is not None and ts < since) or (until is not None and ts > until):
+                return None
+        return entry
+
+    found, segments_read = [], 0
+    for desc in reversed(candidates):
+        if len(found) >= last_n:
+            break
+        if not overlaps(desc if desc is not None else _active):
+            continue
+        segments_read += 1
+        if desc is None:
+            if not _LOG_FILE.exists():
+                continue
+            for line in _read_lines_backwards(_LOG_FILE):
+                entry = matches(line)
+                if entry is not None:
+                    found.append(entry)
+                    if len(found) >= last_n:
+                        break
+        else:
+            # Compressed streams only read forward: keep the newest matches
+            newest = deque(maxlen=last_n - len(found))
+            with _open_segment(desc) as f:
+                for line in f:
+                    entry = matches(line)
+                    if entry is not None:
+                        newest.append(entry)
+            found.extend(reversed(newest))
+    found.reverse()
+    return {"total_lines": total, "returned": len(found), "segments_read": segments_read, "entries": found}
+
+def _persist_log(entry: dict, ts: Optional[float] = None):
     """Append a single JSON line to the persistent log file.
-    Append-only: no edits, no deletions, no truncation."""
-    line = json.dumps(entry, default=str) + "\n"
-    with open(_LOG_FILE, "a", encoding="utf-8") as f:
+    Append-only: no edits, no deletions, no truncation. Each line is
+    hash-chained to the previous one; full segments are sealed and rotated."""
+    ts = time.time() if ts is None else ts
+    payload = _json_dumps(entry)
+    chain_hash = _chain_hash(_chain["head"], payload)
+    line = payload[:-1] + _CHAIN_PREFIX + chain_hash.encode("ascii") + b'"}\n'
+    with open(_LOG_FILE, "ab") as f:
         f.write(line)
+        offset = f.tell()
+    _chain.update(head=chain_hash, entries=_chain["entries"] + 1, offset=offset)
+    _count_in_segment(_active, ts, entry.get("type", ""))
+    if _chain["entries"] % AUDIT_CHECKPOINT_EVERY == 0:
+        _write_checkpoint()
+    if offset >= AUDIT_SEGMENT_MAX_BYTES or ts - _active["first_ts"] >= AUDIT_SEGMENT_MAX_AGE:
+        _rotate_segment(ts)
+
+# ---- Analytics (counters + hourly rollups, updated on every audit write) ----
+# Compliance dashboards read these instead of scanning the log, so every
+# query is O(1) in the log size. The state is derived data only: it is
+# rebuilt from the persisted segments at startup (in the background, see
+# _start_audit_writer) and on ?rebuild=1.
+ANALYTICS_HOURS = int(os.getenv("ANALYTICS_HOURS", str(24 * 90)))  # hourly buckets kept
+
+def _new_analytics():
+    return {
+        "entries": 0, "by_type": {},
+        "profiles": 0, "profile_counts": {},
+        "restricted_profiles": 0, "restriction_hits": {},
+        "flagged_profiles": 0, "coherence_hits": {},
+        "llm_calls": 0, "llm_errors": 0,
+        "sessions": {},  # session_id -> [first_ts, last_ts, turns]
+        "session_seconds": 0.0, "session_turns": 0,
+        "hourly": {},  # epoch hour -> {"entries", "profiles", "restricted", "llm_calls", "llm_errors", "profile_counts"}
+        "rebuilt_at": None, "rebuilt_entries": 0, "rebuild_seconds": None,
+    }
+
+_analytics = _new_analytics()
+_analytics_lock = threading.Lock()
+_analytics_pending = None  # entries written while a rebuild is scanning the log
+
+def _bump(counter: dict, key, n=1):
+    counter[key] = counter.get(key, 0) + n
+
+def _analytics_count(state: dict, entry: dict, ts: float):
+    """Fold one audit entry into the counters and its hourly bucket."""
+    entry_type = entry.get("type", "")
+    hour = int(ts // 3600) * 3600
+    bucket = state["hourly"].get(hour)
+    if bucket is None:
+        bucket = state["hourly"][hour] = {"entries": 0, "profiles": 0, "restricted": 0,
+                                          "llm_calls": 0, "llm_errors": 0, "profile_counts": {}}
+        if len(state["hourly"]) > ANALYTICS_HOURS:
+            del state["hourly"][min(state["hourly"])]
+    state["entries"] += 1
+    bucket["entries"] += 1
+    _bump(state["by_type"], entry_type)
+
+    if entry_type == AuditType.PROFILE.value:
+        explanation = (entry.get("result") or {}).get("explanation", {})
+        restrictions = explanation.get("restrictions_applied", [])
+        coherence = explanation.get("coherence_checks", [])
+        state["profiles"] += 1
+        bucket["profiles"] += 1
+        _bump(state["profile_counts"], entry.get("profile"))
+        _bump(bucket["profile_counts"], entry.get("profile"))
+        if restrictions:
+            state["restricted_profiles"] += 1
+            bucket["restricted"] += 1
+        for r in restrictions:
+            _bump(state["restriction_hits"], r.get("rule"))
+        if coherence:
+            state["flagged_profiles"] += 1
+        for c in coherence:
+            _bump(state["coherence_hits"], c.get("flag"))
+    elif entry_type == AuditType.LLM_CALL.value:
+        state["llm_calls"] += 1
+        bucket["llm_calls"] += 1
+        if entry.get("status") == "error":
+            state["llm_errors"] += 1
+            bucket["llm_errors"] += 1
+
+    session_id = entry.get("session_id")
+    if session_id:
+        session = state["sessions"].get(session_id)
+        if session is None:
+            session = state["sessions"][session_id] = [ts, ts, 0]
+        elif ts > session[1]:
+            # Keep the running sum of durations instead of re-summing sessions
+            state["session_seconds"] += ts - session[1]
+            session[1] = ts
+        if entry_type == AuditType.TEXT_CHAT.value:
+            session[2] += 1
+            state["session_turns"] += 1
+
+def _analytics_add(entry: dict, ts: float):
+    with _analytics_lock:
+        _analytics_count(_analytics, entry, ts)
+        if _analytics_pending is not None:
+            _analytics_pending.append((entry, ts))
+
+def _begin_analytics_rebuild():
+    """Start a rebuild: fix the cut-off (the writer's current segment and
+    offset) and start recording entries written after it. Holding _log_lock
+    keeps the audit writer between entries, so the cut-off is exact.
+    Returns None if a rebuild is already running."""
+    global _analytics_pending
+    with _log_lock, _analytics_lock:
+        if _analytics_pending is not None:
+            return None  # a rebuild is already running
+        _analytics_pending = []
+        with _index_lock:
+            sealed = [dict(d) for d in _segments if not d.get("pruned")]
+        return sealed, (_chain["segment"], _chain["offset"])
+
+def _rebuild_analytics(sealed, cutoff) -> dict:
+    """Recompute the analytics state from the persisted log up to the cut-off,
+    replay the entries audited meanwhile, and swap it in."""
+    global _analytics, _analytics_pending
+    t0 = time.perf_counter()
+    state = _new_analytics()
+    cutoff_segment, cutoff_offset = cutoff
+    try:
+        for desc in sealed + [{"segment": cutoff_segment}]:
+            last = desc["segment"] == cutoff_segment
+            # The cut-off segment may have been sealed since; then read it from segments/
+            with _open_segment(None if last and _chain["segment"] == cutoff_segment else desc) as f:
+                offset = 0
+                for line in f:
+                    offset += len(line)
+                    if last and offset > cutoff_offset:
+                        break
+                    try:
+                        entry = _json_loads(line)
+                        ts = datetime.fromisoformat(entry["timestamp"]).timestamp()
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    _analytics_count(state, entry, ts)
+    except BaseException:
+        with _analytics_lock:
+            _analytics_pending = None
+        raise
+    with _analytics_lock:
+        state["rebuilt_entries"] = state["entries"]
+        for entry, ts in _analytics_pending:
+            _analytics_count(state, entry, ts)
+        state["rebuilt_at"] = _fmt_ts(time.time())
+        state["rebuild_seconds"] = round(time.perf_counter() - t0, 4)
+        _analytics, _analytics_pending = state, None
+    return state
+
+def _analytics_report(hours: int) -> dict:
+    def rates(counter, total):
+        return {k: {"count": n, "rate": round(n / total, 4) if total else 0.0}
+                for k, n in sorted(counter.items(), key=lambda kv: -kv[1])}
+
+    with _analytics_lock:
+        s = _analytics
+        sessions = len(s["sessions"])
+        now_hour = int(time.time() // 3600) * 3600
+        hourly = []
+        for hour in range(now_hour - (hours - 1) * 3600, now_hour + 1, 3600):
+            bucket = s["hourly"].get(hour)
+            if bucket is not None:
+                hourly.append({"hour": _fmt_ts(hour), **bucket, "profile_counts": dict(bucket["profile_counts"])})
+        return {
+            "entries": s["entries"],
+            "by_type": dict(s["by_type"]),
+            "profiles": {"count": s["profiles"], "distribution": rates(s["profile_counts"], s["profiles"])},
+            "restrictions": {
+                "hit_rate": round(s["restricted_profiles"] / s["profiles"], 4) if s["profiles"] else 0.0,
+                "by_rule": rates(s["restriction_hits"], s["profiles"]),
+            },
+            "coherence": {
+                "flag_rate": round(s["flagged_profiles"] / s["profiles"], 4) if s["profiles"] else 0.0,
+                "by_flag": rates(s["coherence_hits"], s["profiles"]),
+            },
+            "llm": {
+                "calls": s["llm_calls"], "errors": s["llm_errors"],
+                "error_rate": round(s["llm_errors"] / s["llm_calls"], 4) if s["llm_calls"] else 0.0,
+            },
+            "sessions": {
+                "count": sessions,
+                "avg_duration_seconds": round(s["session_seconds"] / sessions, 1) if sessions else 0.0,
+                "avg_turns": round(s["session_turns"] / sessions, 2) if sessions else 0.0,
+            },
+            "hourly": hourly,
+            "rebuilding": _analytics_pending is not None,
+            "rebuilt_at": s["rebuilt_at"],
+            "rebuilt_entries": s["rebuilt_entries"],
+            "rebuild_seconds": s["rebuild_seconds"],
+        }
+
+# ---- Ordered audit writer ----
+# Disk writes (hash chain, segment rotation, checkpoints) and analytics
+# updates happen on one writer thread, in _audit call order, after the
+# response has gone out. _audit runs on the event loop, so it never waits
+# for the writer and never drops an entry; the backlog is bounded at
+# admission instead. Once the writer is AUDIT_QUEUE_SIZE entries behind (or,
+# during a handoff, not writing yet) requests that would add entries are
+# shed with 503 before doing any work (see _audit_backlog_full), counted as
+# "shed" in /health. Requests admitted just before that can still finish,
+# so the queue may go a few entries past the bound ("over_backlog"). The log is opened and the writer started by the
+# app's startup hook, not on import, so scripts importing this module
+# (rescore.py, benchmarks) never touch the log. Stopped (after writing
+# everything queued) on shutdown and at interpreter exit.
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+_audit_queue = queue.Queue()
+_audit_writer_stats = {"written": 0, "failed": 0, "shed": 0, "over_backlog": 0}
+AUDIT_RETRY_AFTER = 5  # seconds, for requests shed while the writer catches up
+
+
+def _audit_backlog_full() -> bool:
+    """Admission check for requests that write audit entries."""
+    if _audit_queue.qsize() < AUDIT_QUEUE_SIZE:
+        return False
+    _audit_writer_stats["shed"] += 1
+    return True
+
+
+def _audit_busy():
+    return JSONResponse(status_code=503, content={"error": "Audit log is behind, please retry",
+                                                  "retry_after": AUDIT_RETRY_AFTER},
+                        headers={"Retry-After": str(AUDIT_RETRY_AFTER)})
+
+def _audit_writer_loop():
+    while True:
+        item = _audit_queue.get()
+        try:
+            if item is None:
+                return
+            entry, record, keep_result = item
+            with _log_lock:
+                _persist_log(record.to_dict(), record.ts)
+                _analytics_add(entry, record.ts)
+            if not keep_result:
+                i = _AUDIT_FIELDS[record.type].index("result")
+                record.values = record.values[:i] + (_ABSENT,) + record.values[i + 1:]
+            _audit_writer_stats["written"] += 1
+        except Exception:
+            _audit_writer_stats["failed"] += 1
+            logger.exception("[AUDIT WRITER ERROR]")
+        finally:
+            _audit_queue.task_done()
+
+_audit_writer = threading.Thread(target=_audit_writer_loop, name="audit-writer", daemon=True)
+_analytics_startup = None  # the startup analytics rebuild task
+
+# One writer per log. During a deploy the new process serves beside the old
+# one (see Graceful handoff), but each keeps its own chain head and segment
+# index in memory, so only the holder of an exclusive lock on
+# logs/audit.lock opens the log. A new process waits for the lock in the
+# background: its entries stay queued and the log endpoints answer 503
+# until the old process has written its last entry, finished compressing,
+# saved its newest AUDIT_TAIL_ENTRIES in-memory entries to
+# logs/audit_tail.json (read by /audit, the panel stream and call-window
+# lookups) and exited. The new process then loads the chain head and
+# index, puts that tail in front of its own entries and starts the writer.
+try:
+    import fcntl
+except ImportError:  # no flock (Windows): one process at a time, no handoff
+    fcntl = None
+
+AUDIT_TAIL_ENTRIES = int(os.getenv("AUDIT_TAIL_ENTRIES", "1000"))
+AUDIT_LOCK_POLL = float(os.getenv("AUDIT_LOCK_POLL", "0.5"))
+_LOCK_FILE = _LOG_DIR / "audit.lock"
+_TAIL_FILE = _LOG_DIR / "audit_tail.json"
+_log_ready = threading.Event()  # set while this process holds the lock and the log is open
+_log_opening = None  # the task that waits for the lock and opens the log
+_lock_handle = None
+
+def _try_lock_log() -> bool:
+    global _lock_handle
+    _LOG_DIR.mkdir(parents=True, exist_ok=True)
+    f = open(_LOCK_FILE, "ab")
+    if fcntl is not None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+    _lock_handle = f
+    return True
+
+def _unlock_log():
+    global _lock_handle
+    if _lock_handle is not None:
+        _lock_handle.close()  # releases the flock
+        _lock_handle = None
+
+def _read_audit_tail() -> list:
+    try:
+        return [AuditRecord.from_entry(e) for e in _json_loads(_TAIL_FILE.read_bytes())["entries"]]
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.warning("[AUDIT] unreadable %s, previous in-memory entries not restored", _TAIL_FILE.name)
+        return []
+
+def _write_audit_tail(records):
+    tmp = _TAIL_FILE.with_suffix(".tmp")
+    tmp.write_bytes(_json_dumps({"saved": time.time(), "entries": [r.to_dict() for r in records]}))
+    os.replace(tmp, _TAIL_FILE)
+
+async def _open_audit_log():
+    """Wait for the log lock, then open the log, take over the previous
+    process's tail and start the writer. The analytics rebuild scans every
+    segment, so it runs beside the server instead of delaying startup;
+    entries written meanwhile are replayed."""
+    global _analytics_startup
+    if not _try_lock_log():
+        logger.info("[AUDIT] log held by another process, waiting for it to hand over")
+        while not _try_lock_log():
+            await asyncio.sleep(AUDIT_LOCK_POLL)
+    await asyncio.to_thread(_load_log_state)
+    tail = await asyncio.to_thread(_read_audit_tail)
+    if tail:
+        audit_log[:0] = tail
+        _audit_stream.reset()
+    started = _begin_analytics_rebuild()
+    _audit_writer.start()
+    _log_ready.set()
+    _analytics_startup = asyncio.create_task(asyncio.to_thread(_rebuild_analytics, *started))
+
+async def _start_audit_writer():
+    """Open the persistent log (once per process) as soon as it is free."""
+    global _log_opening
+    if _log_opening is None:
+        _log_opening = asyncio.create_task(_open_audit_log())
+
+async def _flush_audit_log():
+    """Wait until every entry audited so far is on disk."""
+    if _audit_writer.is_alive():
+        await asyncio.to_thread(_audit_queue.join)
+
+def _log_not_open():
+    """503 for log readers while the previous process still holds the log."""
+    return JSONResponse(status_code=503, content={"error": "Audit log not open yet (handoff in progress)"},
+                        headers={"Retry-After": "5"})
+
+def _stop_audit_writer():
+    if _audit_writer.is_alive():
+        _audit_queue.put(None)
+        _audit_writer.join()
+
+async def _close_audit_log():
+    """Hand the log over: write everything queued, stop the writer, let
+    running compressions finish, save the in-memory tail, release the lock."""
+    if _log_opening is None:
+        return
+    if not _log_ready.is_set():
+        _log_opening.cancel()
+        _unlock_log()
+        if _audit_queue.qsize():
+            logger.error("[AUDIT] stopped before the log was handed over: %d entries not written",
+                         _audit_queue.qsize())
+        return
+    await asyncio.to_thread(_stop_audit_writer)
+    for thread in list(_compressors):
+        await asyncio.to_thread(thread.join)
+    if AUDIT_TAIL_ENTRIES > 0:
+        await asyncio.to_thread(_write_audit_tail, audit_log[-AUDIT_TAIL_ENTRIES:])
+    _log_ready.clear()
+    _unlock_log()
+
+atexit.register(_stop_audit_writer)
+_startup_hooks.append(_start_audit_writer)
+_shutdown_hooks.append(_close_audit_log)
+
+# ---- Background bookkeeping ----
+# Handlers hand non-critical work (console logging and the like) to a
+# bounded queue served by BACKGROUND_WORKERS tasks, which run it in batches
+# on a worker thread. Work is never dropped: when the queue is full, or the
+# app isn't running (scripts importing this module), it runs inline.
+BACKGROUND_QUEUE_SIZE = int(os.getenv("BACKGROUND_QUEUE_SIZE", "1000"))
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+_background_queue = None
+_background_workers = []
+_background_stats = {"done": 0, "failed": 0, "inline": 0}
+
+def _run_background(batch):
+    for fn, args in batch:
+        try:
+            fn(*args)
+            _background_stats["done"] += 1
+        except Exception:
+            _background_stats["failed"] += 1
+            logger.exception("[BACKGROUND ERROR] %s", getattr(fn, "__name__", fn))
+
+def _defer(fn, *args):
+    """Run fn(*args) off the request path."""
+    if _background_queue is not None:
+        try:
+            _background_queue.put_nowait((fn, args))
+            return
+        except asyncio.QueueFull:
+            pass
+    _background_stats["inline"] += 1
+    _run_background([(fn, args)])
+
+def _log(*lines):
+    """Console logging off the request path (lines stay together, in order)."""
+    _defer(print, "\n".join(lines))
+
+async def _background_loop():
+    while True:
+        batch = [await _background_queue.get()]
+        while len(batch) < 100 and not _background_queue.empty():
+            batch.append(_background_queue.get_nowait())
+        try:
+            await asyncio.to_thread(_run_background, batch)
+        finally:
+            for _ in batch:
+                _background_queue.task_done()
+
+async def _start_background_workers():
+    global _background_queue
+    _background_queue = asyncio.Queue(maxsize=BACKGROUND_QUEUE_SIZE)
+    _background_workers[:] = [asyncio.create_task(_background_loop()) for _ in range(BACKGROUND_WORKERS)]
+
+async def _drain_background_workers():
+    """Finish all queued work, then stop the workers."""
+    global _background_queue
+    if _background_queue is None:
+        return
+    await _background_queue.join()
+    for task in _background_workers:
+        task.cancel()
+    _background_queue = None
+
+_startup_hooks.append(_start_background_workers)
+_shutdown_hooks.append(_drain_background_workers)
+
+# ---- Live audit stream ----
+# /audit/stream pushes new entries to the audit panels over SSE. Positions in
+# audit_log (which only ever grows) are the cursors: each subscriber reads
+# audit_log[cursor:] when woken, so publishing costs one wakeup per
+# subscriber and a slow client never holds a backlog on the server.
+AUDIT_STREAM_MAX_CLIENTS = int(os.getenv("AUDIT_STREAM_MAX_CLIENTS", "100"))
+AUDIT_STREAM_HEARTBEAT = float(os.getenv("AUDIT_STREAM_HEARTBEAT", "15"))
+
+class _Broadcaster:
+    """Fan-out wakeups for audit stream subscribers."""
+
+    def __init__(self):
+        self.waiters = set()  # futures of subscribers waiting for new entries
+        self.subscribers = 0
+        self.published = 0
+        self.resets = 0
+        self.closed = False
+
+    def publish(self):
+        self.published += 1
+        waiters, self.waiters = self.waiters, set()
+        for fut in waiters:
+            fut.get_loop().call_soon_threadsafe(_wake, fut)
+
+    def reset(self):
+        """Entries were put in front of audit_log (a handoff's tail), so
+        cursors are off: every subscriber gets a fresh snapshot."""
+        self.resets += 1
+        self.publish()
+
+    def close(self):
+        """End every stream (shutdown); new subscribers are refused."""
+        self.closed = True
+        self.publish()
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for the next publish; False if the timeout passed first."""
+        if self.closed:
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.add(fut)
+        try:
+            await asyncio.wait((fut,), timeout=timeout)
+        finally:
+            self.waiters.discard(fut)
+        return fut.done()
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+_audit_stream = _Broadcaster()
+
+async def _close_audit_stream():
+    _audit_stream.close()
+
+_shutdown_hooks.append(_close_audit_stream)
+
+def _audit(entry: dict, keep_result=True) -> AuditRecord:
+    """Record an audit entry in memory (as a compact AuditRecord) and queue
+    it for the ordered writer (disk + analytics). Every entry carries the
+    hash of the scoring rule set it was produced under. keep_result=False
+    drops a profile result from memory once it is on disk."""
+    entry.setdefault("rules_hash", _get_ruleset()["hash"])
+    record = AuditRecord.from_entry(entry)
+    audit_log.append(record)
+    _audit_queue.put_nowait((entry, record, keep_result))
+    backlog = _audit_queue.qsize()
+    if backlog > AUDIT_QUEUE_SIZE:  # admitted before the bound was reached
+        _audit_writer_stats["over_backlog"] += 1
+        if backlog == AUDIT_QUEUE_SIZE + 1:
+            logger.warning("[AUDIT] writer is more than %d entries behind, shedding new requests", AUDIT_QUEUE_SIZE)
+    _audit_stream.publish()
+    return record
 
 def _check_audit_key(request: Request):
     """Verify the audit key from query param or header."""
@@ -155,6 +1278,442 @@ PRESENTING THE RESULT:
 After the tool returns, present the `portfolio_summary` field from the result. Add a 1-2 sentence intro about what the profile means, then include the portfolio_summary content as-is (it contains markdown with tables, ETFs, allocation). Do NOT rewrite it."""
 
 
+# =====================================================================
+# Request Schemas (validated in one pass straight from the raw body)
+# =====================================================================
+
+class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    role: str
+    content: Optional[Any] = None  # text, content parts, or null alongside tool_calls
+
+
+class ChatCompletionRequest(BaseModel):
+    """OpenAI chat completions body. Unknown fields are kept and forwarded."""
+    model_config = ConfigDict(extra="allow")
+    messages: list[ChatMessage] = []
+    stream: bool = False
+    max_tokens: Optional[int] = None
+    tools: Optional[list[dict]] = None
+
+
+class ChatRequest(BaseModel):
+    message: str = ""
+
+
+# 0-based option index. Indices past the last option are clamped by the
+# scoring code (the LLM sometimes counts "Under 18" as an age option).
+AnswerIndex = Annotated[int, Field(ge=0)]
+
+
+class ProfileAnswers(BaseModel):
+    """Questionnaire answers p1_1 ... p6_3. Missing answers use the scoring defaults."""
+    model_config = ConfigDict(extra="ignore")
+    # Block 1: Personal details
+    p1_1: Optional[AnswerIndex] = None
+    p1_2: Optional[AnswerIndex] = None
+    p1_3: Optional[AnswerIndex] = None
+    # Block 2: Financial situation
+    p2_1: Optional[AnswerIndex] = None
+    p2_2: Optional[AnswerIndex] = None
+    p2_3: Optional[AnswerIndex] = None
+    p2_4: Optional[AnswerIndex] = None
+    p2_5: Optional[AnswerIndex] = None
+    # Block 3: Knowledge & experience
+    p3_1: Optional[AnswerIndex] = None
+    p3_2: Optional[AnswerIndex] = None
+    p3_3: Optional[AnswerIndex] = None
+    p3_4: Optional[AnswerIndex] = None
+    p3_5: Optional[AnswerIndex] = None
+    # Block 4: Investment objectives
+    p4_1: Optional[AnswerIndex] = None
+    p4_2: Optional[AnswerIndex] = None
+    p4_3: Optional[AnswerIndex] = None
+    p4_4: Optional[AnswerIndex] = None
+    p4_5: Optional[AnswerIndex] = None
+    # Block 5: Risk tolerance
+    p5_1: Optional[AnswerIndex] = None
+    p5_2: Optional[AnswerIndex] = None
+    p5_3: Optional[AnswerIndex] = None
+    p5_4: Optional[AnswerIndex] = None
+    # Block 6: ESG
+    p6_1: Optional[AnswerIndex] = None
+    p6_2: Optional[AnswerIndex] = None
+    p6_3: Optional[AnswerIndex] = None
+
+    def as_dict(self) -> dict:
+        """Only the answers actually given, as the scoring code expects."""
+        return self.model_dump(exclude_none=True)
+
+
+class ProfileRequest(BaseModel):
+    answers: ProfileAnswers = ProfileAnswers()
+    rules_version: Optional[str] = None
+
+    @field_validator("answers", mode="before")
+    @classmethod
+    def _answers_from_json_string(cls, value):
+        # LLM tool calls pass the answers as a JSON string
+        if isinstance(value, (str, bytes)):
+            try:
+                return _json_loads(value)
+            except json.JSONDecodeError:
+                raise ValueError("answers is not valid JSON") from None
+        return value
+
+
+
+class BulkProfileRequest(ProfileRequest):
+    """One line of a bulk upload: a profile request plus the caller's reference."""
+    id: Optional[Union[str, int]] = None
+
+def _validation_errors(exc: ValidationError) -> list:
+    """Flatten pydantic errors into [{"field": "answers.p1_1", "message": ...}]."""
+    return [
+        {"field": ".".join(str(p) for p in err["loc"]) or "body", "message": err["msg"]}
+        for err in exc.errors(include_url=False)
+    ]
+
+
+def _invalid_request(exc: ValidationError, error="Invalid request"):
+    return JSONResponse(status_code=422, content={"error": error, "detail": _validation_errors(exc)})
+
+
+# =====================================================================
+# Token-Bucket Rate Limiting (LLM traffic, weighted by estimated tokens)
+# =====================================================================
+# slowapi counts requests per IP, but all voice traffic arrives from
+# ElevenLabs' IPs and a greeting costs far less than a tool-calling turn.
+# LLM calls are instead charged their estimated prompt tokens against three
+# buckets at once: the session, the client IP and the shared upstream quota.
+# Buckets refill continuously and are refilled lazily on access (O(1)).
+TOKENS_PER_MINUTE_SESSION = int(os.getenv("TOKENS_PER_MINUTE_SESSION", "20000"))
+TOKENS_PER_MINUTE_CLIENT = int(os.getenv("TOKENS_PER_MINUTE_CLIENT", "120000"))
+TOKENS_PER_MINUTE_UPSTREAM = int(os.getenv("TOKENS_PER_MINUTE_UPSTREAM", "60000"))
+STEER_CALLS_PER_HOUR = int(os.getenv("STEER_CALLS_PER_HOUR", "100"))  # Neuronpedia quota
+
+# scope -> (capacity, refill per second); capacity = one window of burst
+_BUCKET_RATES = {
+    "session": (TOKENS_PER_MINUTE_SESSION, TOKENS_PER_MINUTE_SESSION / 60),
+    "client": (TOKENS_PER_MINUTE_CLIENT, TOKENS_PER_MINUTE_CLIENT / 60),
+    "upstream": (TOKENS_PER_MINUTE_UPSTREAM, TOKENS_PER_MINUTE_UPSTREAM / 60),
+    "neuronpedia": (STEER_CALLS_PER_HOUR, STEER_CALLS_PER_HOUR / 3600),
+}
+
+
+@dataclass(slots=True)
+class _Bucket:
+    tokens: float
+    updated: float
+
+
+_buckets = OrderedDict()  # (scope, key) -> _Bucket, least recently used first
+_bucket_stats = {"allowed": 0, "limited": {}}
+
+
+def _refill(scope, key, now):
+    capacity, rate = _BUCKET_RATES[scope]
+    bucket = _buckets.get((scope, key))
+    if bucket is None:
+        bucket = _buckets[(scope, key)] = _Bucket(capacity, now)
+    else:
+        bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        _buckets.move_to_end((scope, key))
+    return bucket
+
+
+def _evict_idle_buckets(now):
+    """Drop least recently used buckets that would be full again by now
+    (a new bucket starts full, so forgetting them changes nothing)."""
+    while _buckets:
+        (scope, key), bucket = next(iter(_buckets.items()))
+        capacity, rate = _BUCKET_RATES[scope]
+        if bucket.tokens + (now - bucket.updated) * rate < capacity:
+            break
+        del _buckets[(scope, key)]
+
+
+def _take_tokens(keys, cost):
+    """Charge `cost` to every (scope, key) bucket if all of them can afford
+    it. Returns None when allowed, else (scope, seconds until affordable).
+    A cost above a bucket's capacity is clamped so big requests still pass
+    once the bucket is full."""
+    now = time.monotonic()
+    _evict_idle_buckets(now)
+    buckets = [(scope, _refill(scope, key, now)) for scope, key in keys if key is not None]
+    wait, limited_by = 0.0, None
+    for scope, bucket in buckets:
+        capacity, rate = _BUCKET_RATES[scope]
+        need = min(cost, capacity)
+        if bucket.tokens < need and (need - bucket.tokens) / rate > wait:
+            wait, limited_by = (need - bucket.tokens) / rate, scope
+    if limited_by is not None:
+        _bump(_bucket_stats["limited"], limited_by)
+        return limited_by, wait
+    for _, bucket in buckets:
+        bucket.tokens -= cost
+    _bucket_stats["allowed"] += 1
+    return None
+
+
+def _charge_tokens(keys, cost):
+    """Debit buckets unconditionally (work already done, e.g. the follow-up
+    call after a tool call). Buckets may go negative, delaying later calls."""
+    now = time.monotonic()
+    for scope, key in keys:
+        if key is not None:
+            _refill(scope, key, now).tokens -= cost
+
+
+def _estimate_tokens(messages, tools=None):
+    """Rough prompt size: ~4 characters per token plus per-message overhead."""
+    chars = 0
+    for m in messages:
+        content = m.get("content") if isinstance(m, dict) else m.content
+        if isinstance(content, str):
+            chars += len(content)
+        elif content:
+            chars += len(_json_dumps(content))
+        if isinstance(m, dict) and m.get("tool_calls"):
+            chars += len(_json_dumps(m["tool_calls"]))
+    if tools:
+        chars += len(_json_dumps(tools))
+    return chars // 4 + 4 * len(messages)
+
+
+def _rate_limited(scope, wait):
+    retry_after = max(1, int(wait + 0.999))
+    return JSONResponse(
+        status_code=429,
+        content={"error": "Rate limit exceeded", "scope": scope, "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+# =====================================================================
+# Upstream Admission Control (concurrency limit + priority lanes)
+# =====================================================================
+# At most LLM_MAX_CONCURRENCY upstream calls run at once. Others wait in a
+# bounded queue with one lane per priority: voice turns first (a caller is
+# waiting on the line), then text chat, then the steering demo. A full
+# queue, or a wait longer than LLM_QUEUE_TIMEOUT, sheds the request with
+# 503 + Retry-After instead of piling more calls onto a saturated upstream.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+_LANES = ("voice", "chat", "steer")  # highest priority first
+
+_upstream = {
+    "active": 0,
+    "waiting": {lane: deque() for lane in _LANES},  # futures resolved when handed a slot
+    "waits": {lane: deque(maxlen=500) for lane in _LANES},  # recent queue waits (s)
+    "served": dict.fromkeys(_LANES, 0),
+    "shed": dict.fromkeys(_LANES, 0),
+    "service_time": 1.0,  # EWMA of slot hold time, for Retry-After
+}
+
+
+class _Overloaded(Exception):
+    def __init__(self, lane, retry_after):
+        super().__init__(f"Upstream busy ({lane} lane)")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class _Slot:
+    """A held upstream slot. Use as `async with` or call release(); releasing
+    twice is harmless (streams release from both the generator and the
+    response's background task)."""
+    __slots__ = ("acquired", "released")
+
+    def __init__(self):
+        self.acquired = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        held = time.monotonic() - self.acquired
+        _upstream["service_time"] = 0.9 * _upstream["service_time"] + 0.1 * held
+        for lane in _LANES:
+            queue = _upstream["waiting"][lane]
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)  # slot handed over; active count unchanged
+                    return
+        _upstream["active"] -= 1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+def _queue_depth():
+    return sum(len(q) for q in _upstream["waiting"].values())
+
+
+def _retry_after():
+    waves = (_queue_depth() + LLM_MAX_CONCURRENCY) / LLM_MAX_CONCURRENCY
+    return max(1, int(waves * _upstream["service_time"] + 0.999))
+
+
+async def _upstream_slot(lane) -> _Slot:
+    """Wait for an upstream slot in `lane`. Raises _Overloaded when the
+    queue is full or the wait exceeds LLM_QUEUE_TIMEOUT, and (lane "audit")
+    when the audit writer is too far behind to take the call's entries."""
+    if _audit_backlog_full():
+        raise _Overloaded("audit", AUDIT_RETRY_AFTER)
+    start = time.monotonic()
+    if _upstream["active"] < LLM_MAX_CONCURRENCY and not _queue_depth():
+        _upstream["active"] += 1
+    else:
+        if _queue_depth() >= LLM_QUEUE_SIZE:
+            _upstream["shed"][lane] += 1
+            raise _Overloaded(lane, _retry_after())
+        future = asyncio.get_running_loop().create_future()
+        waiting = _upstream["waiting"][lane]
+        waiting.append(future)
+        try:
+            await asyncio.wait_for(future, LLM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            _upstream["shed"][lane] += 1
+            raise _Overloaded(lane, _retry_after()) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                _Slot().release()  # handed a slot just as we gave up: pass it on
+            raise
+        finally:
+            if future in waiting:  # gave up without a slot: don't count as queued
+                waiting.remove(future)
+    _upstream["waits"][lane].append(time.monotonic() - start)
+    _upstream["served"][lane] += 1
+    return _Slot()
+
+
+def _upstream_busy(exc: _Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Service busy, please retry", "lane": exc.lane, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def _upstream_metrics():
+    lanes = {}
+    for lane in _LANES:
+        waits = sorted(_upstream["waits"][lane])
+        lanes[lane] = {
+            "queued": len(_upstream["waiting"][lane]),
+            "served": _upstream["served"][lane],
+            "shed": _upstream["shed"][lane],
+            "wait_avg_ms": round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            "wait_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+        }
+    return {
+        "active": _upstream["active"],
+        "max_concurrency": LLM_MAX_CONCURRENCY,
+        "queue_depth": _queue_depth(),
+        "queue_size": LLM_QUEUE_SIZE,
+        "service_time_s": round(_upstream["service_time"], 3),
+        "lanes": lanes,
+    }
+
+
+# ---- LLM usage & latency telemetry ----
+# Every upstream LLM call records the provider's token usage (streams ask for
+# it with stream_options.include_usage; estimated when it isn't reported),
+# its latency and, for streams, time to first token. Totals are kept per
+# session and per stage, the step of the conversation that made the call:
+#   voice_turn / voice_tool_result  - /v1/chat/completions (ElevenLabs)
+#   chat_turn / chat_tool_followup  - text chat, before and after calculate_profile
+# The last USAGE_WINDOW calls per stage are kept for percentiles.
+# LLM_STREAM_USAGE=0 stops sending stream_options (older Ollama rejects it).
+USAGE_WINDOW = int(os.getenv("USAGE_WINDOW", "500"))
+USAGE_SESSIONS = int(os.getenv("USAGE_SESSIONS", "10000"))
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "1") != "0"
+_usage_stages = {}  # stage -> totals + recent (tokens, latency, ttft, tokens/s) samples
+_usage_sessions = OrderedDict()  # session key -> totals, least recently active first
+
+
+def _new_usage_totals():
+    return {"calls": 0, "errors": 0, "estimated": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0}
+
+
+def _usage_from(data):
+    """Token usage from a response or stream chunk ("usage", or Groq's x_groq.usage)."""
+    usage = data.get("usage") or (data.get("x_groq") or {}).get("usage")
+    if usage and "prompt_tokens" in usage:
+        return {"prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage.get("completion_tokens") or 0}
+    return None
+
+
+def _record_llm_call(stage, session_key, usage, latency, ttft=None, messages=(), completion="", error=False):
+    """Fold one upstream call into the stage and session totals. Returns the
+    fields for its audit entry (usage, latency_ms, ttft_ms)."""
+    stats = _usage_stages.get(stage)
+    if stats is None:
+        stats = _usage_stages[stage] = {**_new_usage_totals(), "samples": deque(maxlen=USAGE_WINDOW)}
+    fields = {"latency_ms": round(latency * 1000)}
+    if ttft is not None:
+        fields["ttft_ms"] = round(ttft * 1000)
+    totals = [stats]
+    if session_key:
+        session = _usage_sessions.pop(session_key, None) or _new_usage_totals()
+        _usage_sessions[session_key] = session
+        if len(_usage_sessions) > USAGE_SESSIONS:
+            _usage_sessions.popitem(last=False)
+        totals.append(session)
+    for t in totals:
+        t["calls"] += 1
+        t["latency_s"] += latency
+    if error:
+        for t in totals:
+            t["errors"] += 1
+        return fields
+
+    if usage is None:
+        usage = {"prompt_tokens": _estimate_tokens(messages), "completion_tokens": len(completion) // 4, "estimated": True}
+    for t in totals:
+        t["prompt_tokens"] += usage["prompt_tokens"]
+        t["completion_tokens"] += usage["completion_tokens"]
+        t["estimated"] += "estimated" in usage
+    generation = latency - (ttft or 0.0)
+    stats["samples"].append((
+        usage["prompt_tokens"] + usage["completion_tokens"], latency, ttft,
+        usage["completion_tokens"] / generation if generation > 0 else 0.0,
+    ))
+    fields["usage"] = usage
+    return fields
+
+
+def _p50_p95(values):
+    values = sorted(values)
+    if not values:
+        return 0, 0
+    return values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+def _usage_summary(totals):
+    summary = {k: (round(v, 3) if type(v) is float else v) for k, v in totals.items() if k != "samples"}
+    summary["total_tokens"] = totals["prompt_tokens"] + totals["completion_tokens"]
+    samples = totals.get("samples")
+    if samples is not None:
+        for name, values, scale in (
+            ("tokens_per_turn", [s[0] for s in samples], 1),
+            ("latency_ms", [s[1] for s in samples], 1000),
+            ("ttft_ms", [s[2] for s in samples if s[2] is not None], 1000),
+            ("tokens_per_s", [s[3] for s in samples], 1),
+        ):
+            p50, p95 = _p50_p95(values)
+            summary[f"{name}_p50"], summary[f"{name}_p95"] = round(p50 * scale, 1), round(p95 * scale, 1)
+    return summary
+
+
 # =====================================================================
 # OpenAI-Compatible Endpoints (ElevenLabs Custom LLM points here)
 # =====================================================================
@@ -174,53 +1733,81 @@ async def list_models():
 
 
 @app.post("/v1/chat/completions")
-@limiter.limit("30/minute")
 async def chat_completions(request: Request):
     """OpenAI-compatible chat completions.
     ElevenLabs sends all conversation here. We proxy to Ollama.
-    Every call is logged for explainability."""
+    Every call is logged for explainability.
+    Rate limited by estimated tokens per session (X-Session-Id header or the
+    OpenAI "user" field), client and upstream."""
 
-    body = await request.json()
-    messages = body.get("messages", [])
-    stream = body.get("stream", False)
+    try:
+        req = ChatCompletionRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        return _invalid_request(e)
+    messages = req.messages
+    stream = req.stream
+
+    extra = req.model_extra or {}
+    session_key = request.headers.get("x-session-id") or extra.get("user") or extra.get("user_id")
 
     # Build audit entry
     last_user_msg = ""
     for m in reversed(messages):
-        if m.get("role") == "user":
-            last_user_msg = m.get("content", "")[:200]
+        if m.role == "user":
+            last_user_msg = m.content[:200] if isinstance(m.content, str) else ""
             break
 
     audit_entry = {
         "id": str(uuid.uuid4())[:8],
-        "timestamp": str(datetime.now()),
+        "timestamp": time.time(),  # when the request came in, as before
         "type": "llm_call",
         "source": "elevenlabs_custom_llm",
         "model": LLM_MODEL,
         "messages_count": len(messages),
         "last_user_message": last_user_msg,
-        "has_tools": "tools" in body,
+        "has_tools": "tools" in req.model_fields_set,
     }
 
     # Forward to LLM - use our model, sanitize fields for Groq compatibility
-    llm_body = {**body, "model": LLM_MODEL}
-    if llm_body.get("max_tokens") is not None and llm_body["max_tokens"] < 1:
+    llm_body = {**req.model_dump(exclude_unset=True), "model": LLM_MODEL}
+    if req.max_tokens is not None and req.max_tokens < 1:
         del llm_body["max_tokens"]
     llm_headers = {"Authorization": f"Bearer {LLM_API_KEY}"} if LLM_API_KEY else {}
+    stage = "voice_tool_result" if messages and messages[-1].role == "tool" else "voice_turn"
+
+    try:
+        slot = await _upstream_slot("voice")
+    except _Overloaded as e:
+        return _upstream_busy(e)
+    # Charged once admitted, so shed requests don't use up tokens
+    limited = _take_tokens(
+        [("session", session_key), ("client", get_remote_address(request)), ("upstream", LLM_URL)],
+        _estimate_tokens(messages, req.tools),
+    )
+    if limited:
+        slot.release()
+        return _rate_limited(*limited)
 
     if stream:
+        # Ask for usage; the usage-only final chunk is passed on only if the client asked too
+        stream_options = llm_body.get("stream_options") or {}
+        forward_usage = bool(stream_options.get("include_usage"))
+        if LLM_STREAM_USAGE:
+            llm_body["stream_options"] = {**stream_options, "include_usage": True}
         return StreamingResponse(
-            _stream_from_llm(llm_body, llm_headers, audit_entry),
+            _stream_from_llm(llm_body, llm_headers, audit_entry, slot, stage, session_key, forward_usage),
             media_type="text/event-stream",
             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            background=BackgroundTask(slot.release),  # in case the stream never starts
         )
     else:
+        started = time.monotonic()
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
+            async with slot, httpx.AsyncClient(timeout=30.0) as client:
                 resp = await client.post(
                     f"{LLM_URL}/v1/chat/completions", json=llm_body, headers=llm_headers
                 )
-                data = resp.json()
+                data = _json_loads(resp.content)
                 choice = data.get("choices", [{}])[0]
                 msg = choice.get("message", {})
                 reply = msg.get("content", "")
@@ -229,62 +1816,76 @@ async def chat_completions(request: Request):
                 audit_entry["response"] = reply[:500] if reply else None
                 audit_entry["tool_calls"] = bool(tool_calls)
                 audit_entry["status"] = "success"
-                audit_log.append(audit_entry)
-                _persist_log(audit_entry)
+                audit_entry.update(_record_llm_call(stage, session_key, _usage_from(data), time.monotonic() - started,
+                                                    messages=messages, completion=reply or ""))
+                _audit(audit_entry)
 
-                print(f"[BRAIN] User: {last_user_msg[:80]}")
+                lines = [f"[BRAIN] User: {last_user_msg[:80]}"]
                 if reply:
-                    print(f"[BRAIN] AI: {reply[:120]}")
+                    lines.append(f"[BRAIN] AI: {reply[:120]}")
                 if tool_calls:
-                    print(f"[BRAIN] Tool call: {tool_calls[0]['function']['name']}")
+                    lines.append(f"[BRAIN] Tool call: {tool_calls[0]['function']['name']}")
+                _log(*lines)
 
-                return data
+                return FastJSONResponse(data)
         except Exception as e:
             audit_entry["status"] = "error"
             audit_entry["error"] = str(e)
-            audit_log.append(audit_entry)
-            _persist_log(audit_entry)
-            print(f"[BRAIN ERROR] {e}")
+            audit_entry.update(_record_llm_call(stage, session_key, None, time.monotonic() - started, error=True))
+            _audit(audit_entry)
+            _log(f"[BRAIN ERROR] {e}")
             return JSONResponse(status_code=502, content={"error": str(e)})
 
 
-async def _stream_from_llm(body, headers, audit_entry):
-    """Stream LLM response as SSE, logging the full response."""
+async def _stream_from_llm(body, headers, audit_entry, slot, stage="voice_turn", session_key=None,
+                           forward_usage=True):
+    """Stream LLM response as SSE, logging the full response and its token
+    usage. Holds the upstream slot until the upstream stream ends."""
     full_response = ""
+    usage = ttft = None
+    started = time.monotonic()
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with slot, httpx.AsyncClient(timeout=30.0) as client:
             async with client.stream(
                 "POST", f"{LLM_URL}/v1/chat/completions", json=body, headers=headers
             ) as resp:
                 async for line in resp.aiter_lines():
                     if not line.strip():
                         continue
-                    yield line + "\n\n"
                     if line.startswith("data: ") and line.strip() != "data: [DONE]":
                         try:
-                            chunk = json.loads(line[6:])
-                            delta = chunk.get("choices", [{}])[0].get("delta", {})
-                            full_response += delta.get("content", "")
+                            chunk = _json_loads(line[6:])
+                            usage = _usage_from(chunk) or usage
+                            choices = chunk.get("choices")
+                            if not choices and "usage" in chunk and not forward_usage:
+                                continue  # usage-only chunk the client didn't ask for
+                            content = choices[0].get("delta", {}).get("content") or "" if choices else ""
+                            if content and ttft is None:
+                                ttft = time.monotonic() - started
+                            full_response += content
                         except:
                             pass
+                    yield line + "\n\n"
 
         audit_entry["response"] = full_response[:500]
         audit_entry["status"] = "success"
+        audit_entry.update(_record_llm_call(stage, session_key, usage, time.monotonic() - started, ttft,
+                                            messages=body.get("messages", ()), completion=full_response))
     except Exception as e:
         audit_entry["status"] = "error"
         audit_entry["error"] = str(e)
+        audit_entry.update(_record_llm_call(stage, session_key, None, time.monotonic() - started, error=True))
         error_chunk = {
             "id": "error",
             "object": "chat.completion.chunk",
             "choices": [{"index": 0, "delta": {"content": "I'm having a moment, could you repeat that?"}, "finish_reason": "stop"}],
         }
-        yield f"data: {json.dumps(error_chunk)}\n\n"
+        yield f"data: {_json_dumps(error_chunk).decode('utf-8')}\n\n"
         yield "data: [DONE]\n\n"
 
-    audit_log.append(audit_entry)
-    _persist_log(audit_entry)
+    _audit(audit_entry)
     if full_response:
-        print(f"[BRAIN Stream] {audit_entry['last_user_message'][:60]} -> {full_response[:80]}")
+        _log(f"[BRAIN Stream] {audit_entry['last_user_message'][:60]} -> {full_response[:80]}")
 
 
 # =====================================================================
@@ -309,261 +1910,767 @@ PROFILE_ALLOCATIONS = {
     "Aggressive":            {"Bonds": 5,  "Cash/Money Market": 5,  "Equities": 90},
 }
 
+# Example products per asset class. "sri" is the PRIIPs summary risk
+# indicator (1-7); an ESG substitute must have the same one as the product
+# it replaces. ESG attributes (illustrative, demo only): "sfdr" article
+# (6/8/9), "sustainable_pct" sustainable investments share, "taxonomy_pct"
+# EU Taxonomy-aligned share, "pai" whether principal adverse impacts are
+# considered. Tickers are unique across the catalog.
 ETF_CATALOG = {
     "Equities": [
-        {"ticker": "VOO",  "name": "Vanguard S&P 500 ETF",              "desc": "US large-cap (S&P 500)"},
-        {"ticker": "QQQ",  "name": "Invesco QQQ Trust",                 "desc": "US tech-heavy (Nasdaq 100)"},
-        {"ticker": "IWDA", "name": "iShares Core MSCI World UCITS ETF", "desc": "Global developed markets"},
-        {"ticker": "EEM",  "name": "iShares MSCI Emerging Markets ETF",  "desc": "Emerging markets"},
-        {"ticker": "VGK",  "name": "Vanguard FTSE Europe ETF",          "desc": "European equities"},
-        {"ticker": "INDA", "name": "iShares MSCI India ETF",            "desc": "Indian equities"},
-        {"ticker": "VTI",  "name": "Vanguard Total Stock Market ETF",   "desc": "US total market"},
-        {"ticker": "FEZ",  "name": "SPDR Euro Stoxx 50 ETF",           "desc": "Eurozone blue-chips"},
-        {"ticker": "EWJ",  "name": "iShares MSCI Japan ETF",           "desc": "Japanese equities"},
-        {"ticker": "VEU",  "name": "Vanguard FTSE All-World ex-US ETF","desc": "International ex-US"},
+        {"ticker": "VOO",  "name": "Vanguard S&P 500 ETF",              "desc": "US large-cap (S&P 500)", "sri": 4},
+        {"ticker": "QQQ",  "name": "Invesco QQQ Trust",                 "desc": "US tech-heavy (Nasdaq 100)", "sri": 5},
+        {"ticker": "IWDA", "name": "iShares Core MSCI World UCITS ETF", "desc": "Global developed markets", "sri": 4},
+        {"ticker": "EEM",  "name": "iShares MSCI Emerging Markets ETF",  "desc": "Emerging markets", "sri": 5},
+        {"ticker": "VGK",  "name": "Vanguard FTSE Europe ETF",          "desc": "European equities", "sri": 4},
+        {"ticker": "INDA", "name": "iShares MSCI India ETF",            "desc": "Indian equities", "sri": 5},
+        {"ticker": "VTI",  "name": "Vanguard Total Stock Market ETF",   "desc": "US total market", "sri": 4},
+        {"ticker": "FEZ",  "name": "SPDR Euro Stoxx 50 ETF",           "desc": "Eurozone blue-chips", "sri": 5},
+        {"ticker": "EWJ",  "name": "iShares MSCI Japan ETF",           "desc": "Japanese equities", "sri": 4},
+        {"ticker": "VEU",  "name": "Vanguard FTSE All-World ex-US ETF","desc": "International ex-US", "sri": 4},
+        {"ticker": "SUSW", "name": "iShares MSCI World SRI UCITS ETF",  "desc": "Global developed, SRI screened", "sri": 4,
+         "sfdr": 8, "sustainable_pct": 50, "taxonomy_pct": 6, "pai": True},
+        {"ticker": "IESE", "name": "iShares MSCI Europe SRI UCITS ETF", "desc": "European equities, SRI screened", "sri": 4,
+         "sfdr": 8, "sustainable_pct": 55, "taxonomy_pct": 8, "pai": True},
+        {"ticker": "SUSM", "name": "iShares MSCI EM SRI UCITS ETF",     "desc": "Emerging markets, SRI screened", "sri": 5,
+         "sfdr": 8, "sustainable_pct": 30, "taxonomy_pct": 3, "pai": True},
+        {"ticker": "INRG", "name": "iShares Global Clean Energy UCITS ETF", "desc": "Global clean energy", "sri": 6,
+         "sfdr": 9, "sustainable_pct": 90, "taxonomy_pct": 40, "pai": True},
     ],
     "Bonds": [
-        {"ticker": "AGG",  "name": "iShares Core US Aggregate Bond ETF",    "desc": "US investment-grade bonds"},
-        {"ticker": "BND",  "name": "Vanguard Total Bond Market ETF",        "desc": "US total bond market"},
-        {"ticker": "LQD",  "name": "iShares iBoxx IG Corporate Bond ETF",   "desc": "US corporate bonds"},
-        {"ticker": "TLT",  "name": "iShares 20+ Year Treasury Bond ETF",    "desc": "US long-term treasuries"},
-        {"ticker": "BSV",  "name": "Vanguard Short-Term Bond ETF",          "desc": "US short-term bonds"},
-        {"ticker": "IBGS", "name": "iShares Euro Govt Bond 1-3yr UCITS ETF","desc": "Euro short-term govt bonds"},
-        {"ticker": "JNK",  "name": "SPDR Bloomberg High Yield Bond ETF",    "desc": "US high-yield bonds"},
-        {"ticker": "EMB",  "name": "iShares JP Morgan EM Bond ETF",         "desc": "Emerging market bonds"},
-        {"ticker": "VCIT", "name": "Vanguard Intermediate Corporate Bond",  "desc": "US intermediate corporates"},
-        {"ticker": "IEAC", "name": "iShares Euro Corporate Bond UCITS ETF", "desc": "Euro corporate bonds"},
+        {"ticker": "AGG",  "name": "iShares Core US Aggregate Bond ETF",    "desc": "US investment-grade bonds", "sri": 2},
+        {"ticker": "BND",  "name": "Vanguard Total Bond Market ETF",        "desc": "US total bond market", "sri": 2},
+        {"ticker": "LQD",  "name": "iShares iBoxx IG Corporate Bond ETF",   "desc": "US corporate bonds", "sri": 3},
+        {"ticker": "TLT",  "name": "iShares 20+ Year Treasury Bond ETF",    "desc": "US long-term treasuries", "sri": 4},
+        {"ticker": "BSV",  "name": "Vanguard Short-Term Bond ETF",          "desc": "US short-term bonds", "sri": 2},
+        {"ticker": "IBGS", "name": "iShares Euro Govt Bond 1-3yr UCITS ETF","desc": "Euro short-term govt bonds", "sri": 2},
+        {"ticker": "JNK",  "name": "SPDR Bloomberg High Yield Bond ETF",    "desc": "US high-yield bonds", "sri": 3},
+        {"ticker": "EMB",  "name": "iShares JP Morgan EM Bond ETF",         "desc": "Emerging market bonds", "sri": 4},
+        {"ticker": "VCIT", "name": "Vanguard Intermediate Corporate Bond",  "desc": "US intermediate corporates", "sri": 3},
+        {"ticker": "IEAC", "name": "iShares Euro Corporate Bond UCITS ETF", "desc": "Euro corporate bonds", "sri": 3},
+        {"ticker": "GRON", "name": "iShares EUR Green Bond UCITS ETF",     "desc": "Euro green bonds", "sri": 3,
+         "sfdr": 9, "sustainable_pct": 85, "taxonomy_pct": 45, "pai": True},
+        {"ticker": "SUOE", "name": "iShares EUR Corp Bond ESG UCITS ETF",  "desc": "Euro corporates, ESG screened", "sri": 3,
+         "sfdr": 8, "sustainable_pct": 25, "taxonomy_pct": 4, "pai": True},
+        {"ticker": "SUSU", "name": "iShares USD Corp Bond ESG UCITS ETF",  "desc": "USD corporates, ESG screened", "sri": 3,
+         "sfdr": 8, "sustainable_pct": 20, "taxonomy_pct": 2, "pai": True},
     ],
     "Cash/Money Market": [
-        {"ticker": "BIL",  "name": "SPDR Bloomberg 1-3 Month T-Bill ETF",  "desc": "Ultra-short US treasuries"},
-        {"ticker": "SHV",  "name": "iShares Short Treasury Bond ETF",      "desc": "US short treasury bonds"},
-        {"ticker": "XEON", "name": "Xtrackers EUR Overnight Rate Swap ETF","desc": "Euro overnight rate"},
-        {"ticker": "JPST", "name": "JPMorgan Ultra-Short Income ETF",      "desc": "Ultra-short income"},
-        {"ticker": "MINT", "name": "PIMCO Enhanced Short Maturity ETF",    "desc": "Short-maturity active"},
-        {"ticker": "GBIL", "name": "Goldman Sachs Access Treasury 0-1Y",   "desc": "US 0-1 year treasuries"},
-        {"ticker": "GSY",  "name": "Invesco Ultra Short Duration ETF",     "desc": "Ultra-short duration"},
-        {"ticker": "SGOV", "name": "iShares 0-3 Month Treasury Bond ETF",  "desc": "Ultra-short treasuries"},
-        {"ticker": "ISTR", "name": "iShares Euro Govt 0-1yr UCITS ETF",   "desc": "Euro ultra-short govt"},
-        {"ticker": "FLOT", "name": "iShares Floating Rate Bond ETF",      "desc": "Floating rate notes"},
+        {"ticker": "BIL",  "name": "SPDR Bloomberg 1-3 Month T-Bill ETF",  "desc": "Ultra-short US treasuries", "sri": 1},
+        {"ticker": "SHV",  "name": "iShares Short Treasury Bond ETF",      "desc": "US short treasury bonds", "sri": 1},
+        {"ticker": "XEON", "name": "Xtrackers EUR Overnight Rate Swap ETF","desc": "Euro overnight rate", "sri": 1},
+        {"ticker": "JPST", "name": "JPMorgan Ultra-Short Income ETF",      "desc": "Ultra-short income", "sri": 1},
+        {"ticker": "MINT", "name": "PIMCO Enhanced Short Maturity ETF",    "desc": "Short-maturity active", "sri": 1},
+        {"ticker": "GBIL", "name": "Goldman Sachs Access Treasury 0-1Y",   "desc": "US 0-1 year treasuries", "sri": 1},
+        {"ticker": "GSY",  "name": "Invesco Ultra Short Duration ETF",     "desc": "Ultra-short duration", "sri": 1},
+        {"ticker": "SGOV", "name": "iShares 0-3 Month Treasury Bond ETF",  "desc": "Ultra-short treasuries", "sri": 1},
+        {"ticker": "ISTR", "name": "iShares Euro Govt 0-1yr UCITS ETF",   "desc": "Euro ultra-short govt", "sri": 1},
+        {"ticker": "FLOT", "name": "iShares Floating Rate Bond ETF",      "desc": "Floating rate notes", "sri": 1},
+        {"ticker": "EEDS", "name": "iShares EUR Ultrashort Bond ESG UCITS ETF", "desc": "Euro ultra-short, ESG screened", "sri": 1,
+         "sfdr": 8, "sustainable_pct": 10, "taxonomy_pct": 1, "pai": True},
     ],
 }
 
-# Which ETFs to recommend per profile (indices into ETF_CATALOG lists)
+# Which ETFs to recommend per profile (tickers from ETF_CATALOG). With an
+# ESG preference the picks that don't meet it are replaced by products of
+# the same asset class and risk indicator that do (see _index_etf_catalog).
 PROFILE_ETFS = {
     "Very Conservative": {
-        "Equities": [0, 2],          # VOO, IWDA
-        "Bonds":    [0, 1, 4, 5],    # AGG, BND, BSV, IBGS
-        "Cash/Money Market": [0, 2, 3],  # BIL, XEON, JPST
+        "Equities": ["VOO", "IWDA"],
+        "Bonds":    ["AGG", "BND", "BSV", "IBGS"],
+        "Cash/Money Market": ["BIL", "XEON", "JPST"],
     },
     "Conservative": {
-        "Equities": [0, 2, 7],       # VOO, IWDA, FEZ
-        "Bonds":    [0, 1, 2, 4, 5], # AGG, BND, LQD, BSV, IBGS
-        "Cash/Money Market": [0, 2],     # BIL, XEON
+        "Equities": ["VOO", "IWDA", "FEZ"],
+        "Bonds":    ["AGG", "BND", "LQD", "BSV", "IBGS"],
+        "Cash/Money Market": ["BIL", "XEON"],
     },
     "Moderate Conservative": {
-        "Equities": [0, 2, 4, 7],    # VOO, IWDA, VGK, FEZ
-        "Bonds":    [0, 1, 2, 9],    # AGG, BND, LQD, IEAC
-        "Cash/Money Market": [2],        # XEON
+        "Equities": ["VOO", "IWDA", "VGK", "FEZ"],
+        "Bonds":    ["AGG", "BND", "LQD", "IEAC"],
+        "Cash/Money Market": ["XEON"],
     },
     "Moderate": {
-        "Equities": [0, 1, 2, 3, 4], # VOO, QQQ, IWDA, EEM, VGK
-        "Bonds":    [0, 2, 8],       # AGG, LQD, VCIT
-        "Cash/Money Market": [2],        # XEON
+        "Equities": ["VOO", "QQQ", "IWDA", "EEM", "VGK"],
+        "Bonds":    ["AGG", "LQD", "VCIT"],
+        "Cash/Money Market": ["XEON"],
     },
     "Moderate Aggressive": {
-        "Equities": [0, 1, 2, 3, 4, 5, 9],  # VOO, QQQ, IWDA, EEM, VGK, INDA, VEU
-        "Bonds":    [0, 6],          # AGG, JNK
-        "Cash/Money Market": [2],        # XEON
+        "Equities": ["VOO", "QQQ", "IWDA", "EEM", "VGK", "INDA", "VEU"],
+        "Bonds":    ["AGG", "JNK"],
+        "Cash/Money Market": ["XEON"],
     },
     "Aggressive": {
-        "Equities": [0, 1, 2, 3, 5, 6, 8, 9],  # VOO, QQQ, IWDA, EEM, INDA, VTI, EWJ, VEU
-        "Bonds":    [6],             # JNK
-        "Cash/Money Market": [2],        # XEON
+        "Equities": ["VOO", "QQQ", "IWDA", "EEM", "INDA", "VTI", "EWJ", "VEU"],
+        "Bonds":    ["JNK"],
+        "Cash/Money Market": ["XEON"],
+    },
+}
+
+# ESG preference (p6_2, p6_3) and the catalog attributes it is checked
+# against. Entries without ESG attributes are Article 6 products with no
+# sustainable or taxonomy-aligned share.
+ESG_TYPES = ["EU Taxonomy", "PAI (Principal Adverse Impact)", "Art. 8/Art. 9 SFDR"]
+ESG_MINIMUM_LABELS = ["No minimum", "25%", "50%", "75%", "100%"]
+ESG_MINIMUMS = [0, 25, 50, 75, 100]
+ESG_DEFAULTS = {"sfdr": 6, "sustainable_pct": 0, "taxonomy_pct": 0, "pai": False}
+
+
+# Block 1 option labels (personal details are not scored, only restrict)
+AGE_LABELS = ["18-30", "31-45", "46-60", "61-70", ">70"]
+EMPLOYMENT_LABELS = ["Employed", "Self-employed", "Civil servant", "Unemployed", "Retired", "Student"]
+DEPENDENTS_LABELS = ["None", "1-2", "3+"]
+
+# Scored blocks: (answer key, label, points per option, option labels)
+SCORING_BLOCKS = [
+    {
+        "id": "block_2", "name": "Financial Situation", "key": "financial_situation",  # max 22 pts
+        "questions": [
+            ["p2_1", "Annual net income", [1, 2, 3, 4, 5], ["<15K", "15-30K", "30-60K", "60-100K", ">100K"]],
+            ["p2_2", "Financial assets", [1, 2, 3, 4, 5], ["<10K", "10-50K", "50-150K", "150-500K", ">500K"]],
+            ["p2_3", "Fixed expenses ratio", [1, 2, 3, 4], [">70%", "50-70%", "30-49%", "<30%"]],
+            ["p2_4", "Emergency fund", [1, 2, 3, 4], ["None", "1-3 months", "3-6 months", ">6 months"]],
+            ["p2_5", "Outstanding debts", [1, 2, 3, 4], ["Significant", "Manageable", "Small loans", "None"]],
+        ],
+    },
+    {
+        "id": "block_3", "name": "Knowledge & Experience", "key": "knowledge_experience",  # max 16 pts
+        "questions": [
+            ["p3_1", "Financial education", [1, 2, 3, 4], ["None", "Basic", "University degree", "Certified"]],
+            ["p3_2", "Products traded (3yr)", [1, 2, 3, 4], ["Deposits only", "Funds/pensions", "Stocks/ETFs/bonds", "Derivatives"]],
+            ["p3_3", "Trading frequency", [1, 2, 3, 4], ["Never", "Few times/year", "Several/year", "Monthly+"]],
+            ["p3_4", "Understands equity risk", [0, 1, 2], ["No", "Somewhat", "Yes"]],
+            ["p3_5", "Understands diversification", [0, 1, 2], ["No", "Somewhat", "Yes"]],
+        ],
+    },
+    {
+        "id": "block_4", "name": "Investment Objectives", "key": "investment_objectives",  # max 20 pts
+        "questions": [
+            ["p4_1", "Main objective", [1, 2, 3, 4], ["Preserve capital", "Regular income", "Growth", "Maximize returns"]],
+            ["p4_2", "Time horizon", [1, 2, 3, 4], ["<1 year", "1-3 years", "3-7 years", ">7 years"]],
+            ["p4_3", "% assets to invest", [4, 3, 2, 1], ["<10%", "10-25%", "26-50%", ">50%"]],  # INVERSE
+            ["p4_4", "Expected return", [1, 2, 3, 4], ["2-3%", "4-6%", "7-10%", ">10%"]],
+            ["p4_5", "Liquidity needs", [1, 2, 3, 4], ["Anytime", "1-2 years", "3-5 years", "None"]],
+        ],
+    },
+    {
+        "id": "block_5", "name": "Risk Tolerance", "key": "risk_tolerance",  # max 17 pts
+        "questions": [
+            ["p5_1", "Reaction to -10% loss", [1, 2, 3, 4], ["Sell everything", "Sell part", "Wait", "Invest more"]],
+            ["p5_2", "Max acceptable annual loss", [1, 2, 3, 4, 5], ["0%", "5%", "15%", "25%", ">25%"]],
+            ["p5_3", "Comfort with 20% fluctuation", [1, 2, 3, 4], ["Very uncomfortable", "Worried", "Normal", "Not concerned"]],
+            ["p5_4", "Risk/return preference", [1, 2, 3, 4], ["Earn little, no losses", "A bit more, small losses", "Good returns, accept losses", "Maximum returns, high risk"]],
+        ],
     },
+]
+
+
+# =====================================================================
+# Restriction & Coherence Rules (declarative - compiled once at startup)
+# =====================================================================
+
+# Each rule is pure data: conditions over answer keys (p1_1 ... p6_3) or
+# block totals (block_2 ... block_5), all of which must hold, plus the text
+# it contributes to the explanation. Kinds:
+#   cap       - caps the profile at max_level (0=Very Conservative ... 5=Aggressive)
+#   reduce    - lowers the final profile by `levels` after capping
+#   coherence - flags an inconsistency for the advisor, no profile effect
+# Point SCORING_RULES_FILE at a JSON file with the same shape to swap the
+# rule set (e.g. per jurisdiction) without touching code.
+MIFID_RULES = {
+    "jurisdiction": "ES",
+    "regulation": "MiFID II",
+    # Value assumed when an answer is missing
+    "defaults": {"p1_1": 2, "p1_2": 0, "p1_3": 0, "p4_2": 2, "p5_2": 1, "p5_4": 0},
+    "rules": [
+        {
+            "id": "age", "kind": "cap", "max_level": 3,
+            "when": [["p1_1", ">=", 3]],  # 61-70 or >70
+            "rule": "Age restriction (MiFID II Art. 25)",
+            "reason": "Client age range {p1_1_label} (>65): higher-risk profiles unsuitable",
+            "effect": "Maximum profile capped at Moderate",
+        },
+        {
+            "id": "income_stability", "kind": "cap", "max_level": 2,
+            "when": [["p1_2", "in", [3, 5]]],  # Unemployed or Student
+            "rule": "Income stability restriction",
+            "reason": "Employment status '{p1_2_label}': limited income stability",
+            "effect": "Maximum profile capped at Moderate Conservative",
+        },
+        {
+            "id": "dependents", "kind": "reduce", "levels": 1,
+            "when": [["p1_3", ">=", 2]],  # 3+
+            "rule": "Dependents adjustment",
+            "reason": "3+ financial dependents increases obligations",
+            "effect": "Profile reduced by one level",
+            "adjustment": "Reduced by 1 level due to 3+ dependents",
+        },
+        {
+            "id": "financial_capacity", "kind": "cap", "max_level": 1,
+            "when": [["block_2", "<", 8]],
+            "rule": "Financial capacity restriction",
+            "reason": "Financial situation score {block_2}/22 (below threshold of 8)",
+            "effect": "Maximum profile capped at Conservative",
+        },
+        {
+            "id": "knowledge", "kind": "cap", "max_level": 2,
+            "when": [["block_3", "<", 5]],
+            "rule": "Knowledge restriction (MiFID II appropriateness)",
+            "reason": "Knowledge score {block_3}/16 (below threshold of 5)",
+            "effect": "Maximum profile capped at Moderate Conservative",
+        },
+        {
+            "id": "short_horizon", "kind": "cap", "max_level": 3,
+            "when": [["p4_2", "==", 0]],  # < 1 year
+            "rule": "Short horizon restriction",
+            "reason": "Investment horizon < 1 year: volatile products unsuitable",
+            "effect": "Maximum profile capped at Moderate",
+        },
+        {
+            "id": "loss_vs_risk", "kind": "coherence",
+            "when": [["p5_2", "==", 0], ["p5_4", ">=", 2]],
+            "flag": "INCONSISTENCY DETECTED",
+            "detail": "Client accepts 0% loss but selected high risk/return preference",
+            "recommendation": "Advisor should discuss risk expectations with client",
+        },
+    ],
+}
+
+_RULE_OPS = {
+    "==": lambda v, c: v == c,
+    "!=": lambda v, c: v != c,
+    "<": lambda v, c: v < c,
+    "<=": lambda v, c: v <= c,
+    ">": lambda v, c: v > c,
+    ">=": lambda v, c: v >= c,
+    "in": lambda v, c: v in c,
+}
+
+# Explanation keys each rule kind contributes
+_RULE_OUTPUT_KEYS = {
+    "cap": ("rule", "reason", "effect"),
+    "reduce": ("rule", "reason", "effect"),
+    "coherence": ("flag", "detail", "recommendation"),
+}
+
+
+def _compile_rules(table):
+    """Compile a rule table into per-field bitmask lookups.
+
+    Every condition gets one bit. For each field a rule reads, the mask of
+    conditions that hold is precomputed for 0..N, where N is one past the
+    largest constant the field is compared with (larger values behave like N).
+    Evaluation is then one tuple lookup per field, however many rules exist;
+    anything that is not a non-negative int falls back to the raw predicates."""
+    field_conds = {}
+    rules = []
+    triggers = {}
+    bit = 0
+    for order, spec in enumerate(table["rules"]):
+        kind = spec.get("kind")
+        if kind not in _RULE_OUTPUT_KEYS:
+            raise ValueError(f"Rule {spec.get('id')!r}: unknown kind {kind!r}")
+        if not spec.get("when"):
+            raise ValueError(f"Rule {spec.get('id')!r}: no conditions")
+        mask = 0
+        for field, op, const in spec["when"]:
+            if op not in _RULE_OPS:
+                raise ValueError(f"Rule {spec.get('id')!r}: unknown operator {op!r}")
+            if op == "in":
+                const = tuple(const)
+            if not all(type(c) is int for c in (const if op == "in" else (const,))):
+                raise ValueError(f"Rule {spec.get('id')!r}: constants must be integers")
+            field_conds.setdefault(field, []).append((1 << bit, op, const))
+            mask |= 1 << bit
+            bit += 1
+        # Rules are only checked when their lowest condition bit is set
+        triggers.setdefault(mask & -mask, []).append(order)
+        output = tuple(
+            (key, spec[key], "{" in spec[key]) for key in _RULE_OUTPUT_KEYS[kind]
+        )
+        rules.append((mask, kind, spec, output))
+
+    defaults = table.get("defaults", {})
+    fields = []
+    for field, conds in field_conds.items():
+        consts = [c for _, op, const in conds for c in (const if op == "in" else (const,))]
+        top = max(0, max(consts) + 1)
+        lookup = tuple(
+            sum(b for b, op, const in conds if _RULE_OPS[op](v, const)) for v in range(top + 1)
+        )
+        fields.append((field, defaults.get(field, 0), top, lookup, tuple(conds)))
+
+    return {
+        "jurisdiction": table.get("jurisdiction", ""),
+        "regulation": table.get("regulation", ""),
+        "defaults": defaults,
+        "fields": tuple(fields),
+        "rules": tuple(rules),
+        "triggers": triggers,
+    }
+
+
+class _RuleContext(dict):
+    """Lazy format context for rule text: {p1_1} is the raw answer,
+    {p1_1_label} its option label, {block_2} a block total."""
+
+    def __init__(self, answers, block_totals, defaults, labels):
+        super().__init__(block_totals)
+        self.answers = answers
+        self.defaults = defaults
+        self.labels = labels
+
+    def __missing__(self, key):
+        if key.endswith("_label"):
+            labels = self.labels[key[:-6]]
+            return labels[min(self[key[:-6]], len(labels) - 1)]
+        return self.answers.get(key, self.defaults.get(key, 0))
+
+
+def _apply_rules(ruleset, answers, block_totals):
+    """Evaluate a rule set's compiled rules. Returns the profile cap, the
+    reductions to apply after capping, and the restriction/coherence explanations."""
+    compiled = ruleset["rules"]
+    satisfied = 0
+    for field, default, top, lookup, conds in compiled["fields"]:
+        v = block_totals[field] if field in block_totals else answers.get(field, default)
+        if type(v) is int and v >= 0:
+            satisfied |= lookup[v if v < top else top]
+        else:
+            for b, op, const in conds:
+                if _RULE_OPS[op](v, const):
+                    satisfied |= b
+
+    fired = []
+    pending = satisfied
+    while pending:
+        low = pending & -pending
+        for order in compiled["triggers"].get(low, ()):
+            mask = compiled["rules"][order][0]
+            if satisfied & mask == mask:
+                fired.append(order)
+        pending ^= low
+    fired.sort()
+
+    outcome = {"max_level": len(ruleset["profiles"]) - 1, "reductions": [], "restrictions": [], "coherence": []}
+    context = None
+    for order in fired:
+        _, kind, spec, output = compiled["rules"][order]
+        entry = {}
+        for key, text, templated in output:
+            if templated:
+                if context is None:
+                    context = _RuleContext(answers, block_totals, compiled["defaults"], ruleset["labels"])
+                text = text.format_map(context)
+            entry[key] = text
+        if kind == "cap":
+            outcome["max_level"] = min(outcome["max_level"], spec["max_level"])
+            outcome["restrictions"].append(entry)
+        elif kind == "reduce":
+            outcome["reductions"].append((spec["levels"], spec["adjustment"]))
+            outcome["restrictions"].append(entry)
+        else:
+            outcome["coherence"].append(entry)
+    return outcome
+
+
+# =====================================================================
+# Versioned Scoring Rule Sets
+# =====================================================================
+
+# A rule set is everything that decides a profile: score bands, scored
+# blocks and restriction rules. Its hash is stamped on every result and
+# audit entry so historical assessments keep their meaning when the tables
+# change. Bump "version" whenever any of the three changes.
+MIFID_II_ES_RULESET = {
+    "version": "mifid2-es-2024.1",
+    "methodology": "MiFID II Suitability Assessment (EU Directive 2014/65/EU)",
+    "profiles": [list(p) for p in PROFILES],
+    "blocks": SCORING_BLOCKS,
+    "rules": MIFID_RULES,
 }
 
+_ruleset_sources = {}    # version -> definition (as registered)
+_compiled_rulesets = {}  # version -> compiled rule set, filled on first use
+
+
+def _ruleset_hash(definition):
+    """Content hash of a rule set definition (canonical JSON, sha256)."""
+    canonical = json.dumps(definition, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def register_ruleset(definition, registry=None):
+    """Register a rule set definition in `registry` (default: the live one).
+    Missing sections are inherited from the built-in MiFID II (ES) rule set.
+    Returns the version string."""
+    registry = _ruleset_sources if registry is None else registry
+    definition = {**MIFID_II_ES_RULESET, **definition}
+    version = definition["version"]
+    known = registry.get(version)
+    if known is not None and _ruleset_hash(known) != _ruleset_hash(definition):
+        raise ValueError(f"Rule set {version!r} is already registered with different content")
+    registry[version] = definition
+    return version
+
+
+def _compile_ruleset(definition):
+    """Compile a rule set definition into the structures scoring reads."""
+    profiles = tuple((name, low, high) for name, low, high in definition["profiles"])
+    blocks = []
+    labels = {"p1_1": AGE_LABELS, "p1_2": EMPLOYMENT_LABELS, "p1_3": DEPENDENTS_LABELS}
+    for block in definition["blocks"]:
+        questions = tuple((key, label, list(scores), list(options)) for key, label, scores, options in block["questions"])
+        block_max = sum(max(scores) for _, _, scores, _ in questions)
+        blocks.append((block["id"], block["name"], block["key"], block_max, questions))
+        for key, _, _, options in questions:
+            labels[key] = options
+    return {
+        "version": definition["version"],
+        "hash": _ruleset_hash(definition),
+        "methodology": definition.get("methodology", ""),
+        "profiles": profiles,
+        "blocks": tuple(blocks),
+        "max_score": sum(b[3] for b in blocks),
+        "labels": labels,
+        "rules": _compile_rules(definition["rules"]),
+    }
+
+
+def _get_ruleset(version=None):
+    """Compiled rule set for `version` (default: the current one).
+    Compiled once per version and cached, so bulk re-scoring is cheap.
+    Raises KeyError for unknown versions."""
+    version = version or CURRENT_RULESET
+    compiled = _compiled_rulesets.get(version)
+    if compiled is None:
+        compiled = _compiled_rulesets[version] = _compile_ruleset(_ruleset_sources[version])
+    return compiled
+
+
+def _load_ruleset_file(path, registry):
+    """Register a rule set file (a full or partial rule set, or a bare rule
+    table) in `registry` and return its version."""
+    with open(path, "r", encoding="utf-8") as f:
+        definition = json.load(f)
+    if isinstance(definition.get("rules"), list):
+        # Bare rule table (jurisdiction/defaults/rules)
+        version = definition.get("version") or f"custom-{_ruleset_hash(definition)}"
+        definition = {"version": version, "rules": definition}
+    elif "version" not in definition:
+        raise ValueError(f"{path}: rule set needs a 'version'")
+    return register_ruleset(definition, registry)
+
+
+# Content and rule set files that can be reloaded without a restart
+# (see "Hot Reload" below)
+CONFIG_DIR = _pathlib.Path(os.getenv("CONFIG_DIR") or _pathlib.Path(__file__).resolve().parent / "config")
+
+
+def _load_rulesets(registry):
+    """Register the built-in rule set and every rule set file in `registry`,
+    and return the version SCORING_RULES_FILE names (else the built-in one).
+    Runs again on every reload, into a copy of the live registry that is
+    swapped in only once the whole config is valid; a registered version
+    can't change content, so new tables need a new version."""
+    register_ruleset(MIFID_II_ES_RULESET, registry)
+    # Archived versions stay scoreable: every *.json in SCORING_RULES_DIR and
+    # CONFIG_DIR/rules is registered
+    for directory in (os.getenv("SCORING_RULES_DIR"), CONFIG_DIR / "rules"):
+        if directory:
+            for path in sorted(_pathlib.Path(directory).glob("*.json")):
+                _load_ruleset_file(path, registry)
+    if os.getenv("SCORING_RULES_FILE"):
+        return _load_ruleset_file(os.environ["SCORING_RULES_FILE"], registry)
+    return MIFID_II_ES_RULESET["version"]
+
+
+CURRENT_RULESET = _load_rulesets(_ruleset_sources)
+_get_ruleset()  # compile the current rule set at startup
+
 
 @app.post("/calculate-profile")
 @limiter.limit("10/minute")
 async def calculate_profile(request: Request):
     """MiFID II profile calculation with FULL explainability.
     Every score, restriction, and adjustment is documented.
-    This is the 'explainable' core of the demo."""
+    This is the 'explainable' core of the demo.
+    Optional "rules_version" scores against a specific registered rule set."""
+    if _audit_backlog_full():
+        return _audit_busy()
 
-    body = await request.json()
-    answers_raw = body.get("answers", "{}")
+    try:
+        req = ProfileRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        return _invalid_request(e, "Invalid answers")
 
-    if isinstance(answers_raw, str):
-        try:
-            answers = json.loads(answers_raw)
-        except json.JSONDecodeError:
-            return {"error": "Invalid answers JSON", "received": answers_raw}
-    else:
-        answers = answers_raw
+    try:
+        ruleset = _get_ruleset(req.rules_version)
+    except KeyError:
+        return JSONResponse(status_code=400, content={
+            "error": f"Unknown rules version: {req.rules_version}",
+            "available": list(_ruleset_sources.keys()),
+        })
+
+    return FastJSONResponse(_score_and_record(req.answers.as_dict(), ruleset))
+
+
+def _score_and_record(answers, ruleset, session_id=None, bulk_id=None, ref=None):
+    """Score an answer set and log it to the audit trail. Returns the result."""
+    result = _build_profile_result(answers, ruleset)
+
+    # Log for audit trail
+    profile_entry = {
+        "type": "profile_calculation",
+        "session_id": session_id,
+        "profile": result["profile"],
+        "score": result["explanation"]["total_score"],
+        "restrictions_count": len(result["explanation"]["restrictions_applied"]),
+        "rules_version": ruleset["version"],
+        "rules_hash": ruleset["hash"],
+        "result": result,
+    }
+    if session_id is None:
+        del profile_entry["session_id"]
+    if bulk_id is not None:
+        profile_entry["bulk_id"] = bulk_id
+        profile_entry["client_ref"] = ref
+        _audit(profile_entry, keep_result=False)
+        return result  # one log line per bulk request, not per result
+    _audit(profile_entry)
+
+    _log(f"[PROFILE] {result['profile']} (score {result['score']}, {profile_entry['restrictions_count']} restrictions)")
+    return result
+
+
+# ---- Bulk scoring (NDJSON stream) ----
+# POST /calculate-profile/bulk takes one JSON object per line: the same body
+# as /calculate-profile plus an optional "id". It streams back one line per
+# input line, in order, while the upload is still arriving. The body is read
+# chunk by chunk and results are written as they are computed. Only the
+# partial line being received and one batch of output are held, so memory
+# stays flat however large the upload is. Back-pressure works in both
+# directions. uvicorn stops reading the socket while we don't receive, and
+# send() waits while the client doesn't read, so a slow client or a busy
+# audit writer slows the upload down instead of piling up data.
+#
+# Every result is a profile_calculation audit entry with the bulk_id and the
+# line's id. Its result stays in memory only until it is on disk. Clients
+# must read the response while uploading (curl -T, aiohttp), or sit behind a
+# proxy that buffers the request (nginx does by default).
+#
+# BULK_API_KEY is its own secret, never AUDIT_KEY (that one has a default
+# and travels in query strings); without it the endpoint is disabled.
+BULK_API_KEY = os.getenv("BULK_API_KEY", "")
+BULK_API_KEY = BULK_API_KEY if BULK_API_KEY not in ("", AUDIT_KEY) else None
+BULK_MAX_LINES = int(os.getenv("BULK_MAX_LINES", "100000"))
+BULK_MAX_LINE_BYTES = 64 * 1024
+BULK_SLICE = 0.01  # seconds of scoring per write; other requests get the loop in between
+BULK_AUDIT_BACKLOG = 1000  # audit entries not yet on disk before scoring waits
+
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse whose body iterator reads the request itself.
+    Starlette's disconnect listener would race it for receive() and drop
+    body chunks; a disconnect shows up as ClientDisconnect from
+    request.stream() instead."""
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+def _check_bulk_key(request: Request):
+    key = request.headers.get("x-api-key") or request.query_params.get("key") or ""
+    return BULK_API_KEY is not None and hmac.compare_digest(key.encode(), BULK_API_KEY.encode())
+
+
+def _bulk_line(number, raw, default_ruleset, bulk_id, compact):
+    """Score one NDJSON line. Returns the output object."""
+    try:
+        data = _json_loads(raw)
+    except json.JSONDecodeError:
+        return {"line": number, "error": "Invalid JSON"}
+    try:
+        req = BulkProfileRequest.model_validate(data)
+    except ValidationError as e:
+        ref = data.get("id") if isinstance(data, dict) else None
+        return {"line": number, "id": ref, "error": "Invalid answers", "detail": _validation_errors(e)}
+    try:
+        ruleset = _get_ruleset(req.rules_version) if req.rules_version else default_ruleset
+    except KeyError:
+        return {"line": number, "id": req.id, "error": f"Unknown rules version: {req.rules_version}"}
+
+    result = _score_and_record(req.answers.as_dict(), ruleset, bulk_id=bulk_id, ref=req.id)
+    if not compact:
+        return {"line": number, "id": req.id, "result": result}
+    risk = result["risk_projection"]
+    return {
+        "line": number,
+        "id": req.id,
+        "profile": result["profile"],
+        "score": result["score"],
+        "allocation": result["allocation"],
+        "etfs": {ac: [e["ticker"] for e in etfs] for ac, etfs in result["recommended_etfs"].items()},
+        "restrictions": [r["rule"] for r in result["explanation"]["restrictions_applied"]],
+        "risk_fits": risk["loss_tolerance"]["fits"] if risk else None,
+        "rules_version": result["rules_version"],
+    }
+
+
+async def _bulk_results(request, default_ruleset, bulk_id, compact):
+    stats = {"bulk_id": bulk_id, "lines": 0, "scored": 0, "errors": 0}
+    started = time.perf_counter()
+    pending, out = b"", []
+    number = 0  # input line number, blank lines included
+    slice_end = time.perf_counter() + BULK_SLICE
+
+    def take(raw):
+        stats["lines"] += 1
+        line = _bulk_line(number, raw, default_ruleset, bulk_id, compact)
+        stats["errors" if "error" in line else "scored"] += 1
+        out.append(_json_dumps(line) + b"\n")
+
+    try:
+        async for chunk in request.stream():
+            *lines, pending = (pending + chunk).split(b"\n")
+            for raw in lines:
+                number += 1
+                if not raw.strip():
+                    continue
+                if stats["lines"] >= BULK_MAX_LINES:
+                    stats["stopped"] = f"More than {BULK_MAX_LINES} lines"
+                    break
+                take(raw)
+                if time.perf_counter() >= slice_end:
+                    yield b"".join(out)
+                    out.clear()
+                    # Let the (running) audit writer keep up before scoring more
+                    while _audit_queue.qsize() > BULK_AUDIT_BACKLOG:
+                        await asyncio.sleep(0.01)
+                    await asyncio.sleep(0)
+                    slice_end = time.perf_counter() + BULK_SLICE
+            if "stopped" in stats:
+                break
+            if len(pending) > BULK_MAX_LINE_BYTES:
+                stats["stopped"] = f"Line {number + 1} is longer than {BULK_MAX_LINE_BYTES} bytes"
+                break
+        else:
+            if pending.strip() and stats["lines"] < BULK_MAX_LINES:
+                number += 1
+                take(pending)  # last line without a newline
+    except ClientDisconnect:
+        stats["stopped"] = "Client disconnected"
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    stats["per_second"] = round(stats["lines"] / stats["seconds"], 1) if stats["seconds"] else None
+    _log(f"[BULK] {bulk_id}: {stats['scored']} scored, {stats['errors']} errors in {stats['seconds']}s"
+         + (f" ({stats['stopped']})" if "stopped" in stats else ""))
+    out.append(_json_dumps({"summary": stats}) + b"\n")
+    yield b"".join(out)
+
+
+@app.post("/calculate-profile/bulk")
+@limiter.limit("10/minute")
+async def calculate_profile_bulk(request: Request):
+    """Score many answer sets in one streamed NDJSON request - protected by
+    API key (x-api-key header). One input line: {"id": ..., "answers": {...},
+    "rules_version": ...}; one output line per input line, in order, then a
+    {"summary": ...} line. Params: ?rules_version=default for all lines,
+    ?compact=1 for profile, allocation and tickers instead of full results."""
+    if BULK_API_KEY is None:
+        return JSONResponse(status_code=503, content={"error": "Bulk scoring is disabled (BULK_API_KEY not set)"})
+    if not _check_bulk_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing API key"})
+    if not _log_ready.is_set():  # a handoff: nothing would drain the entries yet
+        return _log_not_open()
+    if _audit_backlog_full():
+        return _audit_busy()
+    version = request.query_params.get("rules_version")
+    try:
+        ruleset = _get_ruleset(version)
+    except KeyError:
+        return JSONResponse(status_code=400, content={
+            "error": f"Unknown rules version: {version}",
+            "available": list(_ruleset_sources.keys()),
+        })
+    compact = request.query_params.get("compact") in ("1", "true")
+    bulk_id = uuid.uuid4().hex[:12]
+    return _DuplexStreamingResponse(_bulk_results(request, ruleset, bulk_id, compact),
+                                    media_type="application/x-ndjson", headers={"X-Bulk-Id": bulk_id})
+
+
+def _build_profile_result(answers, ruleset):
+    """Score one answer set against a compiled rule set and build the full
+    result (profile, allocation, ETFs, explanation). No audit, no I/O."""
 
     # Explanation object - this IS the explainability
     explanation = {
-        "methodology": "MiFID II Suitability Assessment (EU Directive 2014/65/EU)",
+        "methodology": ruleset["methodology"],
         "input_answers": answers,
         "scoring_detail": {},
         "block_scores": {},
         "restrictions_applied": [],
         "coherence_checks": [],
         "total_score": 0,
-        "max_possible_score": 75,
+        "max_possible_score": ruleset["max_score"],
         "raw_profile": "",
         "final_profile": "",
         "adjustments": [],
+        "rules_version": ruleset["version"],
+        "rules_hash": ruleset["hash"],
     }
 
-    max_profile_level = 5  # 0=Very Conservative ... 5=Aggressive
-
     # --- BLOCK 1: Personal Details (restrictions only, no scoring) ---
     age = answers.get("p1_1", 2)
     employment = answers.get("p1_2", 0)
     dependents = answers.get("p1_3", 0)
 
-    age_labels = ["18-30", "31-45", "46-60", "61-70", ">70"]
-    emp_labels = ["Employed", "Self-employed", "Civil servant", "Unemployed", "Retired", "Student"]
-    dep_labels = ["None", "1-2", "3+"]
-
     explanation["scoring_detail"]["block_1"] = {
         "name": "Personal Details",
         "scores": False,
         "data": {
-            "age_range": age_labels[min(age, 4)],
-            "employment": emp_labels[min(employment, 5)],
-            "dependents": dep_labels[min(dependents, 2)],
+            "age_range": AGE_LABELS[min(age, 4)],
+            "employment": EMPLOYMENT_LABELS[min(employment, 5)],
+            "dependents": DEPENDENTS_LABELS[min(dependents, 2)],
         }
     }
 
-    if age >= 3:  # 61-70 or >70
-        max_profile_level = min(max_profile_level, 3)
-        explanation["restrictions_applied"].append({
-            "rule": "Age restriction (MiFID II Art. 25)",
-            "reason": f"Client age range {age_labels[min(age, 4)]} (>65): higher-risk profiles unsuitable",
-            "effect": "Maximum profile capped at Moderate",
-        })
+    # --- BLOCKS 2-5: Financial situation, knowledge, objectives, risk tolerance ---
+    block_totals = {}
+    for block_id, name, key, block_max, questions in ruleset["blocks"]:
+        block_total, details = _score_block(answers, questions)
+        block_totals[block_id] = block_total
+        explanation["scoring_detail"][block_id] = {"name": name, "max": block_max, "score": block_total, "details": details}
+        explanation["block_scores"][key] = f"{block_total}/{block_max}"
 
-    if employment in [3, 5]:  # Unemployed or Student
-        max_profile_level = min(max_profile_level, 2)
-        explanation["restrictions_applied"].append({
-            "rule": "Income stability restriction",
-            "reason": f"Employment status '{emp_labels[min(employment, 5)]}': limited income stability",
-            "effect": "Maximum profile capped at Moderate Conservative",
-        })
+    # --- Restrictions & coherence checks (compiled rule table) ---
+    outcome = _apply_rules(ruleset, answers, block_totals)
+    explanation["restrictions_applied"] = outcome["restrictions"]
+    explanation["coherence_checks"] = outcome["coherence"]
 
-    reduce_for_dependents = dependents >= 2
-    if reduce_for_dependents:
-        explanation["restrictions_applied"].append({
-            "rule": "Dependents adjustment",
-            "reason": "3+ financial dependents increases obligations",
-            "effect": "Profile reduced by one level",
-        })
+    # --- Calculate Total ---
+    total = sum(block_totals.values())
+    explanation["total_score"] = total
 
-    # --- BLOCK 2: Financial Situation (max 22 pts) ---
-    b2_config = [
-        ("p2_1", "Annual net income", [1, 2, 3, 4, 5], ["<15K", "15-30K", "30-60K", "60-100K", ">100K"]),
-        ("p2_2", "Financial assets", [1, 2, 3, 4, 5], ["<10K", "10-50K", "50-150K", "150-500K", ">500K"]),
-        ("p2_3", "Fixed expenses ratio", [1, 2, 3, 4], [">70%", "50-70%", "30-49%", "<30%"]),
-        ("p2_4", "Emergency fund", [1, 2, 3, 4], ["None", "1-3 months", "3-6 months", ">6 months"]),
-        ("p2_5", "Outstanding debts", [1, 2, 3, 4], ["Significant", "Manageable", "Small loans", "None"]),
-    ]
-    b2_total, b2_details = _score_block(answers, b2_config)
-    explanation["scoring_detail"]["block_2"] = {"name": "Financial Situation", "max": 22, "score": b2_total, "details": b2_details}
-    explanation["block_scores"]["financial_situation"] = f"{b2_total}/22"
+    # Determine raw profile from score
+    profiles = ruleset["profiles"]
+    raw_profile = "Moderate"
+    raw_level = 3
+    for i, (name, low, high) in enumerate(profiles):
+        if low <= total <= high:
+            raw_profile = name
+            raw_level = i
+            break
 
-    if b2_total < 8:
-        max_profile_level = min(max_profile_level, 1)
-        explanation["restrictions_applied"].append({
-            "rule": "Financial capacity restriction",
-            "reason": f"Financial situation score {b2_total}/22 (below threshold of 8)",
-            "effect": "Maximum profile capped at Conservative",
-        })
+    explanation["raw_profile"] = raw_profile
 
-    # --- BLOCK 3: Knowledge & Experience (max 16 pts) ---
-    b3_config = [
-        ("p3_1", "Financial education", [1, 2, 3, 4], ["None", "Basic", "University degree", "Certified"]),
-        ("p3_2", "Products traded (3yr)", [1, 2, 3, 4], ["Deposits only", "Funds/pensions", "Stocks/ETFs/bonds", "Derivatives"]),
-        ("p3_3", "Trading frequency", [1, 2, 3, 4], ["Never", "Few times/year", "Several/year", "Monthly+"]),
-        ("p3_4", "Understands equity risk", [0, 1, 2], ["No", "Somewhat", "Yes"]),
-        ("p3_5", "Understands diversification", [0, 1, 2], ["No", "Somewhat", "Yes"]),
-    ]
-    b3_total, b3_details = _score_block(answers, b3_config)
-    explanation["scoring_detail"]["block_3"] = {"name": "Knowledge & Experience", "max": 16, "score": b3_total, "details": b3_details}
-    explanation["block_scores"]["knowledge_experience"] = f"{b3_total}/16"
+    # Apply restrictions
+    final_level = min(raw_level, outcome["max_level"])
+    for levels, adjustment in outcome["reductions"]:
+        final_level = max(0, final_level - levels)
+        explanation["adjustments"].append(adjustment)
 
-    if b3_total < 5:
-        max_profile_level = min(max_profile_level, 2)
-        explanation["restrictions_applied"].append({
-            "rule": "Knowledge restriction (MiFID II appropriateness)",
-            "reason": f"Knowledge score {b3_total}/16 (below threshold of 5)",
-            "effect": "Maximum profile capped at Moderate Conservative",
-        })
-
-    # --- BLOCK 4: Investment Objectives (max 20 pts) ---
-    b4_config = [
-        ("p4_1", "Main objective", [1, 2, 3, 4], ["Preserve capital", "Regular income", "Growth", "Maximize returns"]),
-        ("p4_2", "Time horizon", [1, 2, 3, 4], ["<1 year", "1-3 years", "3-7 years", ">7 years"]),
-        ("p4_3", "% assets to invest", [4, 3, 2, 1], ["<10%", "10-25%", "26-50%", ">50%"]),  # INVERSE
-        ("p4_4", "Expected return", [1, 2, 3, 4], ["2-3%", "4-6%", "7-10%", ">10%"]),
-        ("p4_5", "Liquidity needs", [1, 2, 3, 4], ["Anytime", "1-2 years", "3-5 years", "None"]),
-    ]
-    b4_total, b4_details = _score_block(answers, b4_config)
-    explanation["scoring_detail"]["block_4"] = {"name": "Investment Objectives", "max": 20, "score": b4_total, "details": b4_details}
-    explanation["block_scores"]["investment_objectives"] = f"{b4_total}/20"
-
-    if answers.get("p4_2", 2) == 0:
-        max_profile_level = min(max_profile_level, 3)
-        explanation["restrictions_applied"].append({
-            "rule": "Short horizon restriction",
-            "reason": "Investment horizon < 1 year: volatile products unsuitable",
-            "effect": "Maximum profile capped at Moderate",
-        })
-
-    # --- BLOCK 5: Risk Tolerance (max 17 pts) ---
-    b5_config = [
-        ("p5_1", "Reaction to -10% loss", [1, 2, 3, 4], ["Sell everything", "Sell part", "Wait", "Invest more"]),
-        ("p5_2", "Max acceptable annual loss", [1, 2, 3, 4, 5], ["0%", "5%", "15%", "25%", ">25%"]),
-        ("p5_3", "Comfort with 20% fluctuation", [1, 2, 3, 4], ["Very uncomfortable", "Worried", "Normal", "Not concerned"]),
-        ("p5_4", "Risk/return preference", [1, 2, 3, 4], ["Earn little, no losses", "A bit more, small losses", "Good returns, accept losses", "Maximum returns, high risk"]),
-    ]
-    b5_total, b5_details = _score_block(answers, b5_config)
-    explanation["scoring_detail"]["block_5"] = {"name": "Risk Tolerance", "max": 17, "score": b5_total, "details": b5_details}
-    explanation["block_scores"]["risk_tolerance"] = f"{b5_total}/17"
-
-    # Coherence check
-    q52 = answers.get("p5_2", 1)
-    q54 = answers.get("p5_4", 0)
-    if q52 == 0 and q54 >= 2:
-        explanation["coherence_checks"].append({
-            "flag": "INCONSISTENCY DETECTED",
-            "detail": "Client accepts 0% loss but selected high risk/return preference",
-            "recommendation": "Advisor should discuss risk expectations with client",
-        })
-
-    # --- Calculate Total ---
-    total = b2_total + b3_total + b4_total + b5_total
-    explanation["total_score"] = total
-
-    # Determine raw profile from score
-    raw_profile = "Moderate"
-    raw_level = 3
-    for i, (name, low, high) in enumerate(PROFILES):
-        if low <= total <= high:
-            raw_profile = name
-            raw_level = i
-            break
-
-    explanation["raw_profile"] = raw_profile
-
-    # Apply restrictions
-    final_level = min(raw_level, max_profile_level)
-    if reduce_for_dependents:
-        final_level = max(0, final_level - 1)
-        explanation["adjustments"].append("Reduced by 1 level due to 3+ dependents")
-
-    final_profile = PROFILES[final_level][0]
+    final_profile = profiles[final_level][0]
     explanation["final_profile"] = final_profile
 
     if raw_profile != final_profile:
@@ -573,49 +2680,43 @@ async def calculate_profile(request: Request):
 
     # --- ESG ---
     esg = None
+    esg_type = esg_level = None
     if answers.get("p6_1", 0) == 1:
-        esg_types = ["EU Taxonomy", "PAI (Principal Adverse Impact)", "Art. 8/Art. 9 SFDR"]
-        esg_mins = ["No minimum", "25%", "50%", "75%", "100%"]
+        esg_type = min(answers.get("p6_2", 0) or 0, len(ESG_TYPES) - 1)
+        esg_level = min(answers.get("p6_3", 0) or 0, len(ESG_MINIMUMS) - 1)
         esg = {
             "has_preference": True,
-            "type": esg_types[min(answers.get("p6_2", 0) or 0, 2)],
-            "minimum_sustainable_pct": esg_mins[min(answers.get("p6_3", 0) or 0, 4)],
+            "type": ESG_TYPES[esg_type],
+            "minimum_sustainable_pct": ESG_MINIMUM_LABELS[esg_level],
         }
 
     allocation = PROFILE_ALLOCATIONS.get(final_profile, PROFILE_ALLOCATIONS["Moderate"])
-    etf_selection = _get_etf_selection(final_profile)
-    portfolio_summary = _format_portfolio_text(final_profile, total, allocation, etf_selection, esg, explanation)
+    etf_selection, esg_unmatched = _get_etf_selection(final_profile, esg_type, esg_level)
+    if esg:
+        esg["unmatched_asset_classes"] = esg_unmatched
+    defaults = ruleset["rules"]["defaults"]
+    risk = _risk_projection(allocation, answers.get("p4_2", defaults.get("p4_2", 0)),
+                            answers.get("p5_2", defaults.get("p5_2", 0)))
+    portfolio_summary = _format_portfolio_text(final_profile, total, allocation, etf_selection, esg, explanation, risk)
 
-    result = {
+    return {
         "profile": final_profile,
-        "score": f"{total}/75",
+        "score": f"{total}/{ruleset['max_score']}",
         "allocation": allocation,
         "recommended_etfs": etf_selection,
         "portfolio_summary": portfolio_summary,
         "esg_preferences": esg,
+        "risk_projection": risk,
         "explanation": explanation,
         "validity_period": "3 years from assessment date",
         "regulatory_basis": "MiFID II Directive 2014/65/EU, Delegated Regulation 2017/565",
         "disclaimer": "DEMO ONLY. This is not real financial advice. Always consult a licensed financial advisor.",
         "assessed_at": str(datetime.now()),
         "assessed_by": f"{LLM_MODEL} via Groq API",
+        "rules_version": ruleset["version"],
+        "rules_hash": ruleset["hash"],
     }
 
-    # Log for audit trail
-    profile_entry = {
-        "timestamp": str(datetime.now()),
-        "type": "profile_calculation",
-        "profile": final_profile,
-        "score": total,
-        "restrictions_count": len(explanation["restrictions_applied"]),
-        "result": result,
-    }
-    audit_log.append(profile_entry)
-    _persist_log(profile_entry)
-
-    print(f"[PROFILE] {final_profile} (score {total}/75, {len(explanation['restrictions_applied'])} restrictions)")
-    return result
-
 
 def _score_block(answers, config):
     """Score a block of questions. Returns (total, details_list)."""
@@ -638,19 +2739,121 @@ def _score_block(answers, config):
     return total, details
 
 
-def _get_etf_selection(profile):
-    """Pick ETFs from the catalog for a given profile."""
-    indices = PROFILE_ETFS.get(profile, PROFILE_ETFS["Moderate"])
-    selection = {}
-    for asset_class, idxs in indices.items():
-        selection[asset_class] = [ETF_CATALOG[asset_class][i] for i in idxs]
-    return selection
+def _meets_esg(etf, esg_type, minimum):
+    """Does a catalog entry meet an ESG preference (index into ESG_TYPES,
+    minimum sustainable share in percent)?"""
+    if esg_type == 0:  # EU Taxonomy: some, or at least the minimum, taxonomy-aligned
+        return etf["taxonomy_pct"] > 0 and etf["taxonomy_pct"] >= minimum
+    if esg_type == 1:  # PAI: principal adverse impacts considered
+        return etf["pai"] and etf["sustainable_pct"] >= minimum
+    return etf["sfdr"] in (8, 9) and etf["sustainable_pct"] >= minimum
+
+
+def _index_etf_catalog(catalog, profile_etfs):
+    """Lookup tables for one catalog, and the ETF selection for every
+    profile x ESG type x minimum precomputed, so a request only does a
+    dict lookup however large the catalog is. Built with each content
+    snapshot (see _read_config)."""
+    by_ticker, by_asset_class, by_sfdr = {}, {}, {}
+    for asset_class, etfs in catalog.items():
+        by_asset_class[asset_class] = []
+        for etf in etfs:
+            entry = {**etf, "asset_class": asset_class}
+            entry.update((k, v) for k, v in ESG_DEFAULTS.items() if k not in etf)
+            by_ticker[entry["ticker"]] = entry
+            by_asset_class[asset_class].append(entry)
+            by_sfdr.setdefault(entry["sfdr"], []).append(entry)
+
+    # Products meeting each preference per asset class and risk indicator,
+    # most sustainable first. Entries without an "sri" are never substitutes.
+    eligible = {}
+    for esg_type in range(len(ESG_TYPES)):
+        for level, minimum in enumerate(ESG_MINIMUMS):
+            for asset_class, entries in by_asset_class.items():
+                for e in sorted(entries, key=lambda e: -e["sustainable_pct"]):
+                    if e.get("sri") is not None and _meets_esg(e, esg_type, minimum):
+                        eligible.setdefault((asset_class, e["sri"], esg_type, level), []).append(e)
+
+    selections = {}
+    for profile, picks in profile_etfs.items():
+        standard = {
+            asset_class: [by_ticker[t] if isinstance(t, str) else by_asset_class[asset_class][t] for t in tickers]
+            for asset_class, tickers in picks.items()
+        }
+        selections[profile, None, None] = (standard, [])
+        for esg_type in range(len(ESG_TYPES)):
+            for level in range(len(ESG_MINIMUMS)):
+                selection, unmatched = {}, []
+                for asset_class, chosen in standard.items():
+                    # Each pick that misses the preference is swapped for the most sustainable
+                    # qualifying product with the same risk indicator not picked yet. Without
+                    # one the standard pick stays (the class is reported as unmatched), so
+                    # the profile keeps its number of products and its risk per product.
+                    minimum = ESG_MINIMUMS[level]
+                    taken = {e["ticker"] for e in chosen if _meets_esg(e, esg_type, minimum)}
+                    picks = []
+                    for etf in chosen:
+                        if etf["ticker"] not in taken:
+                            candidates = eligible.get((asset_class, etf.get("sri"), esg_type, level), ())
+                            substitute = next((e for e in candidates if e["ticker"] not in taken), None)
+                            if substitute is None:
+                                if asset_class not in unmatched:
+                                    unmatched.append(asset_class)
+                            else:
+                                etf = substitute
+                                taken.add(etf["ticker"])
+                        picks.append(etf)
+                    selection[asset_class] = picks
+                selections[profile, esg_type, level] = (selection, unmatched)
+
+    return {"by_ticker": by_ticker, "by_asset_class": by_asset_class, "by_sfdr": by_sfdr, "selections": selections}
+
+
+def _get_etf_selection(profile, esg_type=None, esg_level=None):
+    """Pick ETFs from the catalog for a given profile and, optionally, ESG
+    preference (indices into ESG_TYPES and ESG_MINIMUMS). Returns
+    (selection, asset classes where a standard pick is kept because no
+    product with its risk indicator meets the preference)."""
+    selections = _content["etf_index"]["selections"]  # one snapshot, so catalog and selection always match
+    return selections.get((profile, esg_type, esg_level)) or selections["Moderate", esg_type, esg_level]
+
+
+@app.get("/etfs")
+async def list_etfs(request: Request):
+    """ETF catalog lookup.
+    Params: ?asset_class=Bonds&sfdr=6|8|9&min_sustainable_pct=N"""
+    index = _content["etf_index"]
+    asset_class = request.query_params.get("asset_class")
+    try:
+        sfdr = int(request.query_params["sfdr"]) if "sfdr" in request.query_params else None
+        min_sustainable_pct = float(request.query_params.get("min_sustainable_pct", 0))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Invalid query parameter: sfdr or min_sustainable_pct"})
+    if asset_class is not None:
+        candidates = index["by_asset_class"].get(asset_class, [])
+        if sfdr is not None:
+            candidates = [e for e in candidates if e["sfdr"] == sfdr]
+    elif sfdr is not None:
+        candidates = index["by_sfdr"].get(sfdr, [])
+    else:
+        candidates = index["by_ticker"].values()
+    etfs = [e for e in candidates if e["sustainable_pct"] >= min_sustainable_pct]
+    return FastJSONResponse({"count": len(etfs), "etfs": etfs})
+
+
+@app.get("/etfs/{ticker}")
+async def get_etf(ticker: str):
+    """One catalog entry by ticker."""
+    etf = _content["etf_index"]["by_ticker"].get(ticker.upper())
+    if etf is None:
+        return JSONResponse(status_code=404, content={"error": f"Unknown ticker: {ticker}"})
+    return FastJSONResponse(etf)
 
 
-def _format_portfolio_text(profile, score, allocation, etf_selection, esg, explanation):
+def _format_portfolio_text(profile, score, allocation, etf_selection, esg, explanation, risk=None):
     """Generate a formatted markdown portfolio summary."""
     lines = []
-    lines.append(f"## Your Investment Profile: **{profile}** (Score: {score}/75)")
+    lines.append(f"## Your Investment Profile: **{profile}** (Score: {score}/{explanation['max_possible_score']})")
     lines.append("")
 
     # Restrictions
@@ -696,6 +2899,21 @@ def _format_portfolio_text(profile, score, allocation, etf_selection, esg, expla
         lines.append(f"### ESG Preferences")
         lines.append(f"- Type: **{esg['type']}**")
         lines.append(f"- Minimum sustainable: **{esg['minimum_sustainable_pct']}**")
+        if esg.get("unmatched_asset_classes"):
+            lines.append(f"- No product in the catalog meets this preference for "
+                         f"{', '.join(esg['unmatched_asset_classes'])}; the standard selection is shown there")
+        else:
+            lines.append("- Every recommended product meets this preference")
+        lines.append("")
+
+    # Projected risk
+    if risk:
+        lines.append(f"### Projected Risk ({risk['horizon_years']}-year horizon)")
+        lines.append(f"- 1-year loss not exceeded in 95% of scenarios (VaR): **{risk['var_95_1y_pct']}%**")
+        lines.append(f"- Maximum drawdown: {risk['max_drawdown_pct']['median']}% typical, {risk['max_drawdown_pct']['p95']}% in a bad case")
+        outcome = risk["horizon_return_pct"]
+        lines.append(f"- Return after {risk['horizon_years']} years: {outcome['p5']}% to {outcome['p95']}% (median {outcome['p50']}%)")
+        lines.append(f"- {'✅' if risk['loss_tolerance']['fits'] else '⚠️'} {risk['loss_tolerance']['detail']}")
         lines.append("")
 
     # Coherence warnings
@@ -712,6 +2930,167 @@ def _format_portfolio_text(profile, score, allocation, etf_selection, esg, expla
     return "\n".join(lines)
 
 
+# =====================================================================
+# Risk Projection (Monte Carlo)
+# =====================================================================
+# Projects each recommended allocation forward with a vectorized Monte Carlo
+# simulation. The monthly portfolio returns are log-normal and built from the
+# per-asset-class returns, volatilities and correlations, with the portfolio
+# rebalanced to its allocation. It reports the 1-year VaR/CVaR at 95%, the
+# maximum drawdown over the client's horizon (p4_2) and the spread of outcomes
+# at that horizon. The 1-year VaR is then checked against the stated maximum
+# acceptable loss (p5_2).
+#
+# The assumptions are content ("risk_assumptions" in content.json). The
+# random paths are drawn once with a fixed seed and shared by every
+# projection, so figures are reproducible for the audit trail and comparable
+# between profiles. Projections are cached per content, allocation and
+# horizon and are warmed for every profile at startup and after each reload,
+# so a request only reads the cache. Without NumPy (pip install .[export])
+# risk_projection is null.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RISK_PATHS = int(os.getenv("RISK_PATHS", "10000"))
+RISK_SEED = int(os.getenv("RISK_SEED", "7"))
+RISK_HORIZON_YEARS = [1, 3, 5, 10]          # p4_2: <1 year, 1-3, 3-7, >7 years
+RISK_LOSS_TOLERANCE = [0, 5, 15, 25, None]  # p5_2: 0%, 5%, 15%, 25%, >25%
+
+# Illustrative long-run annual figures, not a market forecast
+RISK_ASSUMPTIONS = {
+    "asset_classes": {
+        "Equities":          {"return": 0.07,  "volatility": 0.16},
+        "Bonds":             {"return": 0.035, "volatility": 0.06},
+        "Cash/Money Market": {"return": 0.025, "volatility": 0.008},
+    },
+    "correlations": [
+        ["Equities", "Bonds", 0.1],
+        ["Equities", "Cash/Money Market", 0.0],
+        ["Bonds", "Cash/Money Market", 0.2],
+    ],
+}
+_risk_cache = {}  # (content hash, allocation, horizon years) -> projection
+_risk_paths = None  # cumulative standard normal draws, months x RISK_PATHS
+
+
+def _check_risk_assumptions(assumptions):
+    """Raise ValueError unless every allocated asset class has usable figures."""
+    classes = assumptions["asset_classes"]
+    for asset_class in {c for allocation in PROFILE_ALLOCATIONS.values() for c in allocation}:
+        figures = classes.get(asset_class)
+        if figures is None:
+            raise ValueError(f"risk_assumptions: no figures for {asset_class!r}")
+        ret, vol = figures.get("return"), figures.get("volatility")
+        if not isinstance(ret, (int, float)) or not isinstance(vol, (int, float)) or ret <= -1 or vol < 0:
+            raise ValueError(f"risk_assumptions[{asset_class!r}]: needs a return above -1 and a volatility >= 0")
+    for a, b, rho in assumptions.get("correlations", []):
+        if a not in classes or b not in classes or not -1 <= rho <= 1:
+            raise ValueError(f"risk_assumptions: bad correlation {a!r}/{b!r}")
+    if numpy is not None and numpy.linalg.eigvalsh(_correlation_matrix(assumptions, list(classes))).min() < -1e-9:
+        raise ValueError("risk_assumptions: correlations do not form a valid correlation matrix")
+
+
+def _correlation_matrix(assumptions, names):
+    index = {name: i for i, name in enumerate(names)}
+    matrix = numpy.eye(len(names))
+    for a, b, rho in assumptions.get("correlations", []):
+        if a in index and b in index:
+            matrix[index[a], index[b]] = matrix[index[b], index[a]] = rho
+    return matrix
+
+
+def _cumulative_shocks(months):
+    """The shared random paths for the first `months` months."""
+    global _risk_paths
+    if _risk_paths is None:
+        rng = numpy.random.default_rng(RISK_SEED)
+        _risk_paths = numpy.cumsum(rng.standard_normal((max(RISK_HORIZON_YEARS) * 12, RISK_PATHS)), axis=0)
+    return _risk_paths[:months]
+
+
+def _simulate_risk(allocation, years, assumptions):
+    """Monte Carlo projection of one allocation over `years` (percent figures)."""
+    names = [c for c, pct in allocation.items() if pct > 0]
+    weights = numpy.array([allocation[c] for c in names], dtype=float) / 100
+    figures = assumptions["asset_classes"]
+    returns = numpy.array([figures[c]["return"] for c in names])
+    vols = numpy.array([figures[c]["volatility"] for c in names])
+    cov = _correlation_matrix(assumptions, names) * numpy.outer(vols, vols)
+    expected = float(weights @ returns)
+    volatility = float(numpy.sqrt(max(weights @ cov @ weights, 0.0)))
+
+    monthly_vol = volatility / numpy.sqrt(12)
+    drift = numpy.log1p(expected) / 12 - monthly_vol ** 2 / 2
+    months = years * 12
+    log_wealth = drift * numpy.arange(1, months + 1)[:, None] + monthly_vol * _cumulative_shocks(months)
+
+    peak = numpy.maximum.accumulate(numpy.maximum(log_wealth, 0), axis=0)
+    max_drawdown = -numpy.expm1((log_wealth - peak).min(axis=0))
+    one_year = numpy.expm1(log_wealth[11])
+    var_cut = numpy.percentile(one_year, 5)
+    at_horizon = numpy.expm1(log_wealth[-1])
+
+    def pct(x):
+        return round(float(x) * 100, 1)
+
+    return {
+        "method": "Monte Carlo, log-normal monthly returns, monthly rebalancing",
+        "paths": RISK_PATHS,
+        "horizon_years": years,
+        "expected_return_pct": pct(expected),
+        "volatility_pct": pct(volatility),
+        "var_95_1y_pct": pct(max(-var_cut, 0.0)),
+        "cvar_95_1y_pct": pct(max(-one_year[one_year <= var_cut].mean(), 0.0)),
+        "max_drawdown_pct": {"median": pct(numpy.median(max_drawdown)), "p95": pct(numpy.percentile(max_drawdown, 95))},
+        "horizon_return_pct": dict(zip(("p5", "p50", "p95"), map(pct, numpy.percentile(at_horizon, [5, 50, 95])))),
+        "prob_loss_at_horizon_pct": pct((at_horizon < 0).mean()),
+    }
+
+
+def _risk_projection(allocation, horizon_answer, loss_answer):
+    """Projected risk of an allocation over the answered horizon, checked
+    against the answered maximum acceptable loss. None without NumPy."""
+    if numpy is None:
+        return None
+    content = _content
+    years = RISK_HORIZON_YEARS[min(horizon_answer, len(RISK_HORIZON_YEARS) - 1)]
+    key = (content["hash"], tuple(allocation.items()), years)
+    projection = _risk_cache.get(key)
+    if projection is None:
+        projection = _risk_cache[key] = _simulate_risk(allocation, years, content["risk_assumptions"])
+
+    tolerance = RISK_LOSS_TOLERANCE[min(loss_answer, len(RISK_LOSS_TOLERANCE) - 1)]
+    var = projection["var_95_1y_pct"]
+    if tolerance is None:
+        fits, detail = True, f"1-year VaR (95%) of {var}%; no maximum loss stated (>25%)"
+    else:
+        fits = var <= tolerance
+        detail = (f"1-year VaR (95%) of {var}% is {'within' if fits else 'above'} "
+                  f"the stated maximum acceptable loss of {tolerance}%")
+    return {**projection, "loss_tolerance": {"max_acceptable_loss_pct": tolerance, "fits": fits, "detail": detail}}
+
+
+def _warm_risk_cache():
+    """Project every profile allocation at every horizon for the current
+    content and drop projections made for older content."""
+    if numpy is None:
+        return
+    current = _content["hash"]
+    for key in [k for k in _risk_cache if k[0] != current]:
+        _risk_cache.pop(key, None)
+    for allocation in PROFILE_ALLOCATIONS.values():
+        for horizon in range(len(RISK_HORIZON_YEARS)):
+            _risk_projection(allocation, horizon, 0)
+
+
+async def _start_risk_cache():
+    await asyncio.to_thread(_warm_risk_cache)
+
+_startup_hooks.append(_start_risk_cache)
+
+
 # =====================================================================
 # Tool definition for LLM function calling
 # =====================================================================
@@ -735,90 +3114,133 @@ CALCULATE_PROFILE_TOOL = {
 }
 
 
-async def _execute_tool_call(tool_name, tool_args):
-    """Execute a tool call server-side and return the result."""
+async def _execute_tool_call(tool_name, tool_args, session_id=None):
+    """Execute a tool call server-side and return the result as a dict.
+    calculate_profile runs in-process: the result recorded in the audit log
+    is the same object the session history references."""
     if tool_name == "calculate_profile":
-        answers_raw = tool_args.get("answers", "{}")
-        if isinstance(answers_raw, str):
-            try:
-                answers = json.loads(answers_raw)
-            except json.JSONDecodeError:
-                return json.dumps({"error": "Invalid JSON in answers"})
-        else:
-            answers = answers_raw
-
-        # Call our own calculate-profile endpoint via HTTP
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(
-                "http://127.0.0.1:8000/calculate-profile",
-                json={"answers": answers},
-            )
-            return resp.text
-    return json.dumps({"error": f"Unknown tool: {tool_name}"})
+        try:
+            req = ProfileRequest.model_validate(tool_args)
+        except ValidationError as e:
+            return {"error": "Invalid answers", "detail": _validation_errors(e)}
+        return _score_and_record(req.answers.as_dict(), _get_ruleset(), session_id=session_id)
+    return {"error": f"Unknown tool: {tool_name}"}
 
 
 # =====================================================================
 # Text Chat Endpoint (React frontend - same brain, same prompt)
 # =====================================================================
 
-@app.post("/chat/{session_id}")
-@limiter.limit("20/minute")
-async def chat(session_id: str, request: Request):
-    """Text chat from the React frontend.
-    Includes tool calling so the LLM can invoke calculate_profile."""
-
-    body = await request.json()
-    user_message = body.get("message", "")
-    if not user_message:
-        return {"error": "No message provided"}
-
-    # Build conversation history
-    if session_id not in sessions:
-        sessions[session_id] = {
-            "history": [], "created": str(datetime.now())
-        }
-
-    # Build messages with system prompt
-    messages = [{"role": "system", "content": MIFID_SYSTEM_PROMPT}]
-
-    # Add recent history (including any tool call/result messages)
-    recent = sessions[session_id]["history"][-20:]
-    for h in recent:
-        if h["source"] == "user":
-            messages.append({"role": "user", "content": h["transcript"]})
-        elif h["source"] == "assistant":
-            msg = {"role": "assistant", "content": h["transcript"]}
-            if h.get("tool_calls"):
-                msg["tool_calls"] = h["tool_calls"]
-                msg["content"] = h["transcript"] or None
+class _RateLimited(Exception):
+    def __init__(self, scope, wait):
+        super().__init__(f"Rate limit exceeded ({scope})")
+        self.scope = scope
+        self.wait = wait
+
+
+def _session_messages(history, user_message):
+    """System prompt + recent history (including tool call/result messages)
+    + the new user message, in OpenAI chat format."""
+    messages = [{"role": "system", "content": _content["system_prompt"]}]
+    for h in history[-20:]:
+        if h.source == "user":
+            messages.append({"role": "user", "content": h.transcript})
+        elif h.source == "assistant":
+            msg = {"role": "assistant", "content": h.transcript}
+            if h.tool_calls:
+                msg["tool_calls"] = h.tool_calls
+                msg["content"] = h.transcript or None
             messages.append(msg)
-        elif h["source"] == "tool":
+        elif h.source == "tool":
             messages.append({
                 "role": "tool",
-                "tool_call_id": h.get("tool_call_id", ""),
-                "content": h["transcript"],
+                "tool_call_id": h.tool_call_id or "",
+                "content": h.text(),
             })
-
     messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+async def _llm_message(client, body, headers, on_token=None, stage="chat_turn", session_id=None):
+    """One chat completion; returns the assistant message dict and its
+    telemetry fields (usage, latency_ms, ttft_ms). With on_token, the call is
+    streamed: content deltas are passed to on_token as they arrive and
+    streamed tool call fragments are reassembled."""
+    started = time.monotonic()
+    try:
+        message, usage, ttft = await _llm_request(client, body, headers, on_token, started)
+    except Exception:
+        _record_llm_call(stage, session_id, None, time.monotonic() - started, error=True)
+        raise
+    fields = _record_llm_call(stage, session_id, usage, time.monotonic() - started, ttft,
+                              messages=body["messages"], completion=message.get("content") or "")
+    return message, fields
+
+
+async def _llm_request(client, body, headers, on_token, started):
+    if on_token is None:
+        resp = await client.post(f"{LLM_URL}/v1/chat/completions", json={**body, "stream": False}, headers=headers)
+        data = _json_loads(resp.content)
+        return data.get("choices", [{}])[0].get("message", {}), _usage_from(data), None
+
+    content, tool_calls = [], {}
+    usage = ttft = None
+    stream_body = {**body, "stream": True}
+    if LLM_STREAM_USAGE:
+        stream_body["stream_options"] = {"include_usage": True}
+    async with client.stream("POST", f"{LLM_URL}/v1/chat/completions",
+                             json=stream_body, headers=headers) as resp:
+        async for line in resp.aiter_lines():
+            if not line.startswith("data: ") or line.strip() == "data: [DONE]":
+                continue
+            chunk = _json_loads(line[6:])
+            usage = _usage_from(chunk) or usage
+            delta = (chunk.get("choices") or [{}])[0].get("delta", {})
+            if delta.get("content"):
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                content.append(delta["content"])
+                await on_token(delta["content"])
+            for part in delta.get("tool_calls") or []:
+                call = tool_calls.setdefault(part.get("index", 0), {"type": "function", "function": {"name": "", "arguments": ""}})
+                if part.get("id"):
+                    call["id"] = part["id"]
+                fn = part.get("function") or {}
+                call["function"]["name"] += fn.get("name") or ""
+                call["function"]["arguments"] += fn.get("arguments") or ""
+    message = {"role": "assistant", "content": "".join(content)}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return message, usage, ttft
+
+
+async def _chat_turn(session_id, user_message, client_key, on_token=None, on_profile=None):
+    """One text chat turn: LLM call with tool definitions, calculate_profile
+    execution when requested, follow-up call, history and audit. Shared by
+    POST /chat and the /ws/chat WebSocket. Returns the reply text.
+    Raises _RateLimited or _Overloaded before any upstream call is made."""
+    session = await _load_session(session_id)
+    history = session.history
+    messages = _session_messages(history, user_message)
+
+    # Charge estimated prompt tokens once admitted, before calling the LLM
+    slot = await _upstream_slot("chat")
+    bucket_keys = [("session", session_id), ("client", client_key), ("upstream", LLM_URL)]
+    limited = _take_tokens(bucket_keys, _estimate_tokens(messages, [CALCULATE_PROFILE_TOOL]))
+    if limited:
+        slot.release()
+        raise _RateLimited(*limited)
 
     # Call LLM with tool definitions
     llm_headers = {"Authorization": f"Bearer {LLM_API_KEY}"} if LLM_API_KEY else {}
     reply = ""
+    calls = []  # telemetry fields per LLM call, summed into the audit entry
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(
-                f"{LLM_URL}/v1/chat/completions",
-                json={
-                    "model": LLM_MODEL,
-                    "messages": messages,
-                    "tools": [CALCULATE_PROFILE_TOOL],
-                    "stream": False,
-                },
-                headers=llm_headers,
-            )
-            data = resp.json()
-            choice = data.get("choices", [{}])[0]
-            msg = choice.get("message", {})
+        async with slot, httpx.AsyncClient(timeout=30.0) as client:
+            msg, fields = await _llm_message(client, {"model": LLM_MODEL, "messages": messages,
+                                                      "tools": [CALCULATE_PROFILE_TOOL]},
+                                             llm_headers, on_token, "chat_turn", session_id)
+            calls.append(fields)
             reply = msg.get("content", "") or ""
             tool_calls = msg.get("tool_calls")
 
@@ -826,25 +3248,19 @@ async def chat(session_id: str, request: Request):
             if tool_calls:
                 tc = tool_calls[0]
                 fn_name = tc["function"]["name"]
-                fn_args = json.loads(tc["function"].get("arguments", "{}"))
+                fn_args = _json_loads(tc["function"].get("arguments") or "{}")
                 tc_id = tc.get("id", f"call_{uuid.uuid4().hex[:8]}")
 
-                print(f"[TEXT] Tool call: {fn_name}({json.dumps(fn_args)[:100]})")
+                _log(f"[TEXT] Tool call: {fn_name}({json.dumps(fn_args)[:100]})")
 
                 # Execute the tool
-                tool_result = await _execute_tool_call(fn_name, fn_args)
+                tool_result = await _execute_tool_call(fn_name, fn_args, session_id=session_id)
+                if on_profile is not None and fn_name == "calculate_profile" and "error" not in tool_result:
+                    await on_profile(tool_result)
 
                 # Save the assistant's tool-call message and tool result to history
-                sessions[session_id]["history"].append({
-                    "source": "assistant", "transcript": reply or "",
-                    "tool_calls": tool_calls,
-                    "timestamp": str(datetime.now()),
-                })
-                sessions[session_id]["history"].append({
-                    "source": "tool", "transcript": tool_result,
-                    "tool_call_id": tc_id,
-                    "timestamp": str(datetime.now()),
-                })
+                history.append(HistoryItem("assistant", reply or "", tool_calls=tool_calls))
+                history.append(HistoryItem("tool", None, tool_call_id=tc_id, result=tool_result))
 
                 # Build follow-up messages with tool result
                 messages.append({
@@ -855,69 +3271,141 @@ async def chat(session_id: str, request: Request):
                 messages.append({
                     "role": "tool",
                     "tool_call_id": tc_id,
-                    "content": tool_result,
+                    "content": history[-1].text(),
                 })
 
-                # Get final LLM response with the tool result
-                resp2 = await client.post(
-                    f"{LLM_URL}/v1/chat/completions",
-                    json={
-                        "model": LLM_MODEL,
-                        "messages": messages,
-                        "stream": False,
-                    },
-                    headers=llm_headers,
-                )
-                data2 = resp2.json()
-                reply = data2.get("choices", [{}])[0].get("message", {}).get("content", "Sorry, I had a problem processing your profile.")
+                # Get final LLM response with the tool result (charged after the fact)
+                _charge_tokens(bucket_keys, _estimate_tokens(messages))
+                msg2, fields = await _llm_message(client, {"model": LLM_MODEL, "messages": messages},
+                                                  llm_headers, on_token, "chat_tool_followup", session_id)
+                calls.append(fields)
+                reply = msg2.get("content") or "Sorry, I had a problem processing your profile."
 
                 # Log tool call in audit
                 tc_entry = {
-                    "timestamp": str(datetime.now()),
                     "type": "text_chat_tool_call",
                     "session_id": session_id,
                     "tool": fn_name,
                     "tool_args": fn_args,
                     "model": LLM_MODEL,
                 }
-                audit_log.append(tc_entry)
-                _persist_log(tc_entry)
+                _audit(tc_entry)
 
     except Exception as e:
         reply = f"Error connecting to AI model: {str(e)}"
 
     # Save user message and final reply to history
-    sessions[session_id]["history"].append({
-        "source": "user", "transcript": user_message,
-        "timestamp": str(datetime.now()),
-    })
-    sessions[session_id]["history"].append({
-        "source": "assistant", "transcript": reply,
-        "timestamp": str(datetime.now()),
-    })
+    history.append(HistoryItem("user", user_message))
+    history.append(HistoryItem("assistant", reply))
 
     # Audit log
     chat_entry = {
-        "timestamp": str(datetime.now()),
         "type": "text_chat",
         "session_id": session_id,
         "user_message": user_message[:200],
         "response": reply[:300],
         "model": LLM_MODEL,
     }
-    audit_log.append(chat_entry)
-    _persist_log(chat_entry)
+    if calls:
+        chat_entry["latency_ms"] = sum(f["latency_ms"] for f in calls)
+        usages = [f["usage"] for f in calls if "usage" in f]
+        if usages:
+            chat_entry["usage"] = {k: sum(u[k] for u in usages) for k in ("prompt_tokens", "completion_tokens")}
+            if any("estimated" in u for u in usages):
+                chat_entry["usage"]["estimated"] = True
+    _audit(chat_entry)
+
+    _log(f"[TEXT] User: {user_message[:80]}", f"[TEXT] AI: {reply[:120]}")
+    return reply
+
+
+@app.post("/chat/{session_id}")
+async def chat(session_id: str, request: Request):
+    """Text chat from the React frontend.
+    Includes tool calling so the LLM can invoke calculate_profile."""
+
+    try:
+        user_message = ChatRequest.model_validate_json(await request.body()).message
+    except ValidationError as e:
+        return _invalid_request(e)
+    if not user_message:
+        return {"error": "No message provided"}
 
-    print(f"[TEXT] User: {user_message[:80]}")
-    print(f"[TEXT] AI: {reply[:120]}")
+    try:
+        reply = await _chat_turn(session_id, user_message, get_remote_address(request))
+    except _RateLimited as e:
+        return _rate_limited(e.scope, e.wait)
+    except _Overloaded as e:
+        return _upstream_busy(e)
     return {"reply": reply, "session_id": session_id}
 
 
+@app.websocket("/ws/chat/{session_id}")
+async def chat_ws(websocket: WebSocket, session_id: str):
+    """Text chat over one persistent connection per session.
+    Client frames: {"message": "..."} (or {"type": "ping"}).
+    Server frames: {"type": "token", "text"} while the reply streams,
+    {"type": "profile", "result"} when calculate_profile runs,
+    {"type": "reply", "reply", "session_id"} at the end of each turn,
+    {"type": "error", "error", ...} for invalid input, rate limits and overload."""
+    await websocket.accept()
+    client_key = websocket.client.host if websocket.client else "unknown"
+    session = await _load_session(session_id)
+    session.connections += 1  # connected sessions are kept in memory
+
+    async def send(frame):
+        await websocket.send_text(_json_dumps(frame).decode("utf-8"))
+
+    async def on_token(text):
+        await send({"type": "token", "text": text})
+
+    async def on_profile(result):
+        await send({"type": "profile", "result": result})
+
+    try:
+        await send({"type": "ready", "session_id": session_id, "history": len(session.history)})
+        while True:
+            raw = await websocket.receive_text()
+            try:
+                frame = _json_loads(raw)
+            except json.JSONDecodeError:
+                frame = {"message": raw}
+            if not isinstance(frame, dict):
+                await send({"type": "error", "error": "Invalid frame"})
+                continue
+            if frame.get("type") == "ping":
+                await send({"type": "pong"})
+                continue
+            try:
+                user_message = ChatRequest.model_validate(frame).message
+            except ValidationError as e:
+                await send({"type": "error", "error": "Invalid request", "detail": _validation_errors(e)})
+                continue
+            if not user_message:
+                await send({"type": "error", "error": "No message provided"})
+                continue
+            try:
+                reply = await _chat_turn(session_id, user_message, client_key, on_token, on_profile)
+            except _RateLimited as e:
+                await send({"type": "error", "error": "Rate limit exceeded", "scope": e.scope,
+                            "retry_after": max(1, int(e.wait + 0.999))})
+                continue
+            except _Overloaded as e:
+                await send({"type": "error", "error": "Service busy, please retry", "retry_after": e.retry_after})
+                continue
+            await send({"type": "reply", "reply": reply, "session_id": session_id})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        session.connections -= 1
+
+
 # =====================================================================
 # Neuronpedia Steering Demo (SAE Feature Steering)
 # =====================================================================
 
 NEURONPEDIA_API_KEY = os.getenv("NEURONPEDIA_API_KEY", "")
+NEURONPEDIA_URL = os.getenv("NEURONPEDIA_URL", "https://www.neuronpedia.org").rstrip("/")
 STEER_MODEL = "gemma-2-9b-it"
 STEER_LAYER = "gemmascope-res-16k"
 
@@ -950,15 +3438,126 @@ async def get_steer_presets():
         "model": STEER_MODEL,
         "layer": STEER_LAYER,
         "presets": {k: {"label": v["label"], "description": v["description"], "color": v["color"]}
-                    for k, v in STEER_PRESETS.items()},
+                    for k, v in _content["steer_presets"].items()},
     }
 
 
+# ---- Steering result cache ----
+# Neuronpedia runs with a fixed seed and sampling parameters, so the request
+# body fully determines the output. Results are cached by a hash of that
+# body (prompt, features, parameters) in an LRU persisted to
+# logs/steer_cache.json, and concurrent identical requests share one
+# upstream call. Point NEURONPEDIA_URL at a local stub for tests.
+STEER_CACHE_SIZE = int(os.getenv("STEER_CACHE_SIZE", "512"))
+_STEER_CACHE_FILE = _LOG_DIR / "steer_cache.json"
+_steer_cache = OrderedDict()  # key -> Neuronpedia response data (DEFAULT, STEERED, shareUrl)
+_steer_inflight = {}  # key -> asyncio.Future of (status, data or error content)
+_steer_stats = {"hits": 0, "misses": 0, "shared": 0, "upstream_errors": 0}
+_steer_client = None
+
+
+def _load_steer_cache():
+    try:
+        items = _json_loads(_STEER_CACHE_FILE.read_bytes())["entries"]
+    except (OSError, ValueError, KeyError):
+        return
+    for key, data in items[-STEER_CACHE_SIZE:]:
+        _steer_cache[key] = data
+
+
+def _save_steer_cache(items):
+    tmp = _STEER_CACHE_FILE.with_suffix(".tmp")
+    tmp.write_bytes(_json_dumps({"entries": items}))
+    os.replace(tmp, _STEER_CACHE_FILE)
+
+
+def _steer_cache_key(np_body):
+    canonical = json.dumps(np_body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _get_steer_client():
+    """One pooled client for all Neuronpedia calls (keep-alive, one TLS handshake)."""
+    global _steer_client
+    if _steer_client is None:
+        _steer_client = httpx.AsyncClient(timeout=90.0)
+    return _steer_client
+
+
+async def _close_steer_client():
+    global _steer_client
+    if _steer_client is not None:
+        await _steer_client.aclose()
+        _steer_client = None
+
+
+async def _start_steer_cache():
+    await asyncio.to_thread(_load_steer_cache)
+
+
+_startup_hooks.append(_start_steer_cache)
+_shutdown_hooks.append(_close_steer_client)
+
+
+async def _fetch_steer(key, np_body, np_headers):
+    """(status, payload) for a Neuronpedia request: cache hit, a share of an
+    identical in-flight request, or a fresh upstream call. Only successful
+    responses are cached. Returns (200, data, source) or (status, error content, source)."""
+    data = _steer_cache.get(key)
+    if data is not None:
+        _steer_cache.move_to_end(key)
+        _steer_stats["hits"] += 1
+        return 200, data, "hit"
+    pending = _steer_inflight.get(key)
+    if pending is not None:
+        _steer_stats["shared"] += 1
+        status, payload = await asyncio.shield(pending)
+        return status, payload, "shared"
+
+    _steer_stats["misses"] += 1
+    future = _steer_inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        async with await _upstream_slot("steer"):
+            resp = await _get_steer_client().post(f"{NEURONPEDIA_URL}/api/steer", json=np_body, headers=np_headers)
+        if resp.status_code == 429:
+            outcome = (429, {"error": "Neuronpedia rate limit reached (100/hour). Please try again later."})
+        elif resp.status_code != 200:
+            outcome = (resp.status_code, {
+                "error": f"Neuronpedia API error ({resp.status_code})",
+                "detail": resp.text[:300],
+            })
+        else:
+            data = _json_loads(resp.content)
+            data = {"DEFAULT": data.get("DEFAULT", ""), "STEERED": data.get("STEERED", ""),
+                    "shareUrl": data.get("shareUrl", "")}
+            _steer_cache[key] = data
+            if len(_steer_cache) > STEER_CACHE_SIZE:
+                _steer_cache.popitem(last=False)
+            await asyncio.to_thread(_save_steer_cache, list(_steer_cache.items()))
+            outcome = (200, data)
+        if outcome[0] != 200:
+            _steer_stats["upstream_errors"] += 1
+        future.set_result(outcome)
+        return outcome + ("miss",)
+    except asyncio.CancelledError:
+        # The leader's client went away; don't fail the requests sharing its call
+        future.set_result((502, {"error": "Steering request cancelled, please retry"}))
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved when nobody else was waiting
+        raise
+    finally:
+        del _steer_inflight[key]
+
+
 @app.post("/steer")
 @limiter.limit("10/minute")
 async def steer_proxy(request: Request):
     """Proxy for Neuronpedia /api/steer endpoint.
-    Sends a prompt and returns both default and steered completions."""
+    Sends a prompt and returns both default and steered completions.
+    Served from the steering cache when the same request was made before
+    (X-Cache: HIT/MISS/SHARED)."""
 
     body = await request.json()
     prompt = body.get("prompt", "").strip()
@@ -967,11 +3566,12 @@ async def steer_proxy(request: Request):
     if not prompt:
         return JSONResponse(status_code=400, content={"error": "No prompt provided"})
 
-    preset = STEER_PRESETS.get(preset_key)
+    presets = _content["steer_presets"]
+    preset = presets.get(preset_key)
     if not preset:
         return JSONResponse(status_code=400, content={
             "error": f"Unknown preset: {preset_key}",
-            "available": list(STEER_PRESETS.keys()),
+            "available": list(presets.keys()),
         })
 
     np_body = {
@@ -989,89 +3589,575 @@ async def steer_proxy(request: Request):
     if NEURONPEDIA_API_KEY:
         np_headers["x-api-key"] = NEURONPEDIA_API_KEY
 
-    try:
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            resp = await client.post(
-                "https://www.neuronpedia.org/api/steer",
-                json=np_body,
-                headers=np_headers,
-            )
-
-            if resp.status_code == 429:
-                return JSONResponse(status_code=429, content={
-                    "error": "Neuronpedia rate limit reached (100/hour). Please try again later."
-                })
-            if resp.status_code != 200:
-                return JSONResponse(status_code=resp.status_code, content={
-                    "error": f"Neuronpedia API error ({resp.status_code})",
-                    "detail": resp.text[:300],
-                })
-
-            data = resp.json()
-
-            def _clean_response(text):
-                """Strip <bos> token and echoed prompt from Neuronpedia output."""
-                if not text:
-                    return ""
-                text = text.replace("<bos>", "").strip()
-                # Remove echoed prompt at start
-                if text.startswith(prompt):
-                    text = text[len(prompt):].strip()
-                return text
-
-            result = {
-                "default_response": _clean_response(data.get("DEFAULT", "")),
-                "steered_response": _clean_response(data.get("STEERED", "")),
-                "preset": preset_key,
-                "preset_label": preset["label"],
-                "preset_description": preset["description"],
-                "model": STEER_MODEL,
-                "share_url": data.get("shareUrl", ""),
-                "features_used": preset["features"],
-            }
-
-            steer_entry = {
-                "timestamp": str(datetime.now()),
-                "type": "steering_demo",
-                "prompt": prompt[:200],
-                "preset": preset_key,
-                "model": STEER_MODEL,
-                "default_response": result["default_response"][:300],
-                "steered_response": result["steered_response"][:300],
-            }
-            audit_log.append(steer_entry)
-            _persist_log(steer_entry)
-
-            print(f"[STEER] preset={preset_key} prompt='{prompt[:60]}'")
-            return result
+    key = _steer_cache_key(np_body)
+    if key not in _steer_cache and key not in _steer_inflight:
+        # Only calls that reach Neuronpedia count against its hourly quota
+        limited = _take_tokens([("neuronpedia", NEURONPEDIA_URL)], 1)
+        if limited:
+            return _rate_limited(*limited)
 
+    try:
+        status, data, source = await _fetch_steer(key, np_body, np_headers)
+    except _Overloaded as e:
+        return _upstream_busy(e)
     except httpx.TimeoutException:
         return JSONResponse(status_code=504, content={"error": "Neuronpedia API timeout (90s). Their model may be loading."})
     except Exception as e:
         return JSONResponse(status_code=502, content={"error": f"Steering error: {str(e)}"})
+    if status != 200:
+        return JSONResponse(status_code=status, content=data)
+
+    def _clean_response(text):
+        """Strip <bos> token and echoed prompt from Neuronpedia output."""
+        if not text:
+            return ""
+        text = text.replace("<bos>", "").strip()
+        # Remove echoed prompt at start
+        if text.startswith(prompt):
+            text = text[len(prompt):].strip()
+        return text
+
+    result = {
+        "default_response": _clean_response(data.get("DEFAULT", "")),
+        "steered_response": _clean_response(data.get("STEERED", "")),
+        "preset": preset_key,
+        "preset_label": preset["label"],
+        "preset_description": preset["description"],
+        "model": STEER_MODEL,
+        "share_url": data.get("shareUrl", ""),
+        "features_used": preset["features"],
+    }
+
+    steer_entry = {
+        "type": "steering_demo",
+        "prompt": prompt[:200],
+        "preset": preset_key,
+        "model": STEER_MODEL,
+        "default_response": result["default_response"][:300],
+        "steered_response": result["steered_response"][:300],
+        "cache": source,
+    }
+    _audit(steer_entry)
+
+    _log(f"[STEER] preset={preset_key} cache={source} prompt='{prompt[:60]}'")
+    return FastJSONResponse(result, headers={"X-Cache": source.upper()})
+
+
+# =====================================================================
+# Hot Reload & Graceful Handoff
+# =====================================================================
+# CONFIG_DIR/content.json overrides the built-in system prompt, ETF catalog,
+# per-profile ETF selection and steering presets, and may name the current
+# scoring rule set ("rules_version"). Sections it leaves out keep their
+# built-in values; it needs a "version" of its own.
+#
+# POST /config/reload (audit key) or SIGHUP re-reads it together with the
+# rule set files. Everything is parsed and validated first and then swapped
+# in as one snapshot, so no request sees half a reload and a bad file leaves
+# the running content in place. _reload_hooks then rebuild whatever was
+# derived from the old content, and the reload is recorded in the audit log.
+_CONTENT_FILE = CONFIG_DIR / "content.json"
+_CONTENT_SECTIONS = ("system_prompt", "etf_catalog", "profile_etfs", "steer_presets", "risk_assumptions")
+_BUILTIN_CONTENT = {
+    "version": "builtin",
+    "system_prompt": MIFID_SYSTEM_PROMPT,
+    "etf_catalog": ETF_CATALOG,
+    "profile_etfs": PROFILE_ETFS,
+    "steer_presets": STEER_PRESETS,
+    "risk_assumptions": RISK_ASSUMPTIONS,
+}
+_reload_hooks = []  # sync callables run in a worker thread after each reload
+_reload_lock = asyncio.Lock()
+_reload_stats = {"reloads": 0, "failed": 0, "last_reload": None, "last_error": None}
+
+
+def _check_content(content):
+    """Raise ValueError unless the content can be served as is."""
+    prompt = content["system_prompt"]
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError("system_prompt must be a non-empty string")
+    catalog = content["etf_catalog"]
+    tickers = {}  # ticker -> asset class
+    for asset_class, etfs in catalog.items():
+        for etf in etfs:
+            missing = {"ticker", "name", "desc"} - etf.keys()
+            if missing:
+                raise ValueError(f"etf_catalog[{asset_class!r}]: entry without {', '.join(sorted(missing))}")
+            if etf["ticker"] in tickers:
+                raise ValueError(f"etf_catalog: duplicate ticker {etf['ticker']!r}")
+            tickers[etf["ticker"]] = asset_class
+            if etf.get("sfdr", 6) not in (6, 8, 9):
+                raise ValueError(f"etf_catalog[{etf['ticker']!r}]: sfdr must be 6, 8 or 9")
+            if etf.get("sri", 1) not in range(1, 8):
+                raise ValueError(f"etf_catalog[{etf['ticker']!r}]: sri must be 1-7")
+            for key in ("sustainable_pct", "taxonomy_pct"):
+                value = etf.get(key, 0)
+                if not isinstance(value, (int, float)) or not 0 <= value <= 100:
+                    raise ValueError(f"etf_catalog[{etf['ticker']!r}]: {key} must be 0-100")
+    if "Moderate" not in content["profile_etfs"]:
+        raise ValueError("profile_etfs needs a 'Moderate' entry (the fallback profile)")
+    for profile, selection in content["profile_etfs"].items():
+        for asset_class, picks in selection.items():
+            size = len(catalog.get(asset_class, ()))
+            for pick in picks:
+                if isinstance(pick, str):
+                    valid = tickers.get(pick) == asset_class
+                else:  # positional index, as older content files have them
+                    valid = type(pick) is int and 0 <= pick < size
+                if not valid:
+                    raise ValueError(f"profile_etfs[{profile!r}][{asset_class!r}]: {pick!r} is not an ETF of that asset class")
+    for key, preset in content["steer_presets"].items():
+        missing = {"label", "description", "features", "color"} - preset.keys()
+        if missing:
+            raise ValueError(f"steer_presets[{key!r}]: missing {', '.join(sorted(missing))}")
+    _check_risk_assumptions(content["risk_assumptions"])
+
+
+def _read_config():
+    """Build a validated snapshot from content.json, the built-ins and the
+    rule set files. The rule sets are registered into a copy of the live
+    registry carried in the snapshot, so nothing is registered until the
+    snapshot is applied. Raises on anything invalid."""
+    rulesets = dict(_ruleset_sources)
+    rules_version = _load_rulesets(rulesets)
+    content = dict(_BUILTIN_CONTENT)
+    if _CONTENT_FILE.exists():
+        overrides = _json_loads(_CONTENT_FILE.read_bytes())
+        if not overrides.get("version"):
+            raise ValueError(f"{_CONTENT_FILE.name}: content needs a 'version'")
+        content.update({k: overrides[k] for k in ("version", *_CONTENT_SECTIONS) if k in overrides})
+        rules_version = overrides.get("rules_version") or rules_version
+    _check_content(content)
+    if rules_version not in rulesets:
+        raise ValueError(f"Unknown rules_version: {rules_version}")
+    # Compiled before the swap, not on the first request
+    content["ruleset"] = _compiled_rulesets.get(rules_version) or _compile_ruleset(rulesets[rules_version])
+    content["rulesets"] = rulesets
+    content["hash"] = _ruleset_hash({k: content[k] for k in ("version", *_CONTENT_SECTIONS)})
+    content["rules_version"] = rules_version
+    content["etf_index"] = _index_etf_catalog(content["etf_catalog"], content["profile_etfs"])
+    return content
+
+
+def _apply_content(content):
+    """Swap in a validated snapshot. Runs on the event loop between awaits,
+    so every request sees either the old content or the new one. Returns the
+    sections that changed."""
+    global _content, CURRENT_RULESET
+    changed = [k for k in _CONTENT_SECTIONS if content[k] != _content[k]]
+    if content["rules_version"] != CURRENT_RULESET:
+        changed.append("rules")
+    _register_snapshot(content)
+    _content, CURRENT_RULESET = content, content["rules_version"]
+    return changed
+
+
+def _register_snapshot(content):
+    """Make the snapshot's rule sets live (the live registry only grows)."""
+    _ruleset_sources.update(content["rulesets"])
+    _compiled_rulesets.setdefault(content["rules_version"], content["ruleset"])
+
+
+async def _reload_content(trigger):
+    """Re-read content and rule set files and swap them in. Returns a
+    summary; raises ValueError, with the old content still in place, if
+    anything is invalid."""
+    async with _reload_lock:
+        try:
+            content = await asyncio.to_thread(_read_config)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            _reload_stats["failed"] += 1
+            _reload_stats["last_error"] = f"{type(e).__name__}: {e}"
+            _log(f"[RELOAD FAILED] {_reload_stats['last_error']}")
+            raise ValueError(_reload_stats["last_error"]) from e
+        changed = _apply_content(content)
+        for hook in _reload_hooks:
+            try:
+                await asyncio.to_thread(hook)
+            except Exception as e:
+                _log(f"[RELOAD HOOK ERROR] {getattr(hook, '__name__', hook)}: {e}")
+        _reload_stats["reloads"] += 1
+        _reload_stats["last_reload"] = str(datetime.now())
+        _reload_stats["last_error"] = None
+    _audit({
+        "type": "config_reload",
+        "content_version": content["version"],
+        "content_hash": content["hash"],
+        "rules_version": content["rules_version"],
+        "changed": changed,
+        "trigger": trigger,
+    })
+    _log(f"[RELOAD] content {content['version']} ({content['hash']}), rules {content['rules_version']}, "
+         f"changed: {', '.join(changed) or 'nothing'}")
+    return {"content_version": content["version"], "content_hash": content["hash"],
+            "rules_version": content["rules_version"], "changed": changed}
+
+
+_content = _read_config()  # the snapshot every request reads
+_register_snapshot(_content)
+CURRENT_RULESET = _content["rules_version"]
+_reload_hooks.append(_warm_risk_cache)  # projections depend on risk_assumptions
+
+
+# ---- Graceful handoff ----
+# deploy_backend.py starts the new process next to the old one (python
+# main.py binds with SO_REUSEPORT) and then sends the old one SIGTERM. The
+# audit log stays with the old process until it exits (see Ordered audit
+# writer).
+# uvicorn stops accepting, waits for open responses and only then runs the
+# shutdown hooks, but SSE streams never finish on their own, so SIGTERM
+# first ends them here; EventSource reconnects to the new process and
+# resumes. In-flight requests get SHUTDOWN_GRACE seconds to finish.
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "30"))
+_draining = False
+_signal_tasks = set()
+
+
+def _begin_drain():
+    global _draining
+    _draining = True
+    _audit_stream.close()
+
+
+async def _reload_on_signal():
+    try:
+        await _reload_content("SIGHUP")
+    except ValueError:
+        pass  # logged, old content still served
+
+
+async def _install_signal_handlers():
+    """SIGHUP reloads content; SIGTERM starts draining, then runs the
+    server's own handler. Skipped off the main thread (test clients) and on
+    platforms without these signals."""
+    loop = asyncio.get_running_loop()
+
+    def on_hup():
+        task = loop.create_task(_reload_on_signal())
+        _signal_tasks.add(task)
+        task.add_done_callback(_signal_tasks.discard)
+
+    try:
+        loop.add_signal_handler(signal.SIGHUP, on_hup)
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_term(signum, frame):
+            loop.call_soon_threadsafe(_begin_drain)
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                signal.signal(signum, previous)
+                signal.raise_signal(signum)
+
+        signal.signal(signal.SIGTERM, on_term)
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        pass
+
+_startup_hooks.append(_install_signal_handlers)
+
+# Sessions live in memory, so on shutdown they are written to
+# logs/sessions.json. A process picks a session up from there the first time
+# it sees its id. During a handoff the new process is already serving while
+# the old one drains, so a session it hasn't seen yet is only picked up
+# once the old one has saved (see _load_session).
+_SESSIONS_FILE = _LOG_DIR / "sessions.json"
+_saved_sessions = {"mtime": None, "sessions": {}}  # last snapshot read, minus sessions restored since
+
+
+def _dump_session(session: Session) -> dict:
+    history = []
+    for h in session.history:
+        item = {"source": h.source, "transcript": h.transcript, "ts": h.ts}
+        for key in ("tool_calls", "tool_call_id", "result"):
+            if getattr(h, key) is not None:
+                item[key] = getattr(h, key)
+        history.append(item)
+    return {"created": session.created, "history": history}
+
+
+def _restore_session(session_id):
+    try:
+        mtime = _SESSIONS_FILE.stat().st_mtime
+        if mtime != _saved_sessions["mtime"]:
+            _saved_sessions.update(mtime=mtime, sessions=_json_loads(_SESSIONS_FILE.read_bytes())["sessions"])
+    except (OSError, ValueError, KeyError):
+        return None
+    saved = _saved_sessions["sessions"].pop(session_id, None)
+    if saved is None:
+        return None
+    return Session(created=saved["created"], history=[HistoryItem(**h) for h in saved["history"]])
+
+
+def _get_session(session_id) -> Session:
+    session = sessions.get(session_id)
+    if session is None:
+        session = sessions[session_id] = _restore_session(session_id) or Session()
+    return session
+
+
+async def _handoff_sessions():
+    """During a handoff, wait until the old process has saved its sessions:
+    it does so before it releases the audit log, which is what _log_opening
+    waits for. Until then a session this process hasn't seen may still be
+    live over there, and restoring it now would miss (or read an older copy
+    of) its history. Gives up after SHUTDOWN_GRACE plus a margin."""
+    if _log_opening is not None and not _log_opening.done():
+        await asyncio.wait({_log_opening}, timeout=SHUTDOWN_GRACE + 15)
+
+
+async def _load_session(session_id) -> Session:
+    """_get_session for request handlers, safe during a handoff."""
+    if session_id not in sessions:
+        await _handoff_sessions()
+    return _get_session(session_id)
+
+
+def _write_sessions(snapshot):
+    tmp = _SESSIONS_FILE.with_suffix(".tmp")
+    tmp.write_bytes(_json_dumps({"saved": time.time(), "sessions": snapshot}))
+    os.replace(tmp, _SESSIONS_FILE)
+
+
+async def _save_sessions():
+    # Sessions restored from an older snapshot but not used since are kept too
+    snapshot = {**_saved_sessions["sessions"], **{sid: _dump_session(s) for sid, s in sessions.items()}}
+    if snapshot:
+        await asyncio.to_thread(_write_sessions, snapshot)
+
+_shutdown_hooks.append(_save_sessions)
+
+
+@app.get("/config")
+async def get_config():
+    """Content and scoring rule versions being served."""
+    return {
+        "content_version": _content["version"],
+        "content_hash": _content["hash"],
+        "content_file": _CONTENT_FILE.name if _CONTENT_FILE.exists() else None,
+        "rules_version": CURRENT_RULESET,
+        "rules_hash": _get_ruleset()["hash"],
+        **_reload_stats,
+    }
+
+
+@app.post("/config/reload")
+async def reload_config(request: Request):
+    """Reload content and rule set files without a restart - protected by API key."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    try:
+        return await _reload_content("api")
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={
+            "error": "Reload failed; still serving the previous content",
+            "detail": str(e),
+        })
 
 
 # =====================================================================
 # ElevenLabs Post-Call Webhook
 # =====================================================================
 
-@app.post("/webhook/elevenlabs")
-async def elevenlabs_webhook(request: Request):
-    body = await request.json()
-    session_id = body.get("conversation_id", str(uuid.uuid4()))
-    transcript = body.get("transcript", "")
+# The webhook only acknowledges: the raw body goes onto a bounded queue and
+# a background worker parses it, stores the transcript gzip-compressed under
+# logs/transcripts/, extracts per-turn timings, links the call to the
+# profile calculations it produced, and writes the audit entry. ElevenLabs
+# retries on 503, so a full queue sheds instead of blocking.
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "256"))
+WEBHOOK_PROFILE_SCAN = int(os.getenv("WEBHOOK_PROFILE_SCAN", "10000"))  # newest audit entries searched per call
+_TRANSCRIPT_DIR = _LOG_DIR / "transcripts"
+_webhook_queue = None  # asyncio.Queue of (ingest_id, received ts, data, conversation id), created on startup
+_webhook_worker = None
+_webhook_stats = {"received": 0, "processed": 0, "failed": 0, "shed": 0}
+
+
+def _transcript_turns(transcript, call_start=None):
+    """Per-turn timings from an ElevenLabs transcript list: offset into the
+    call, duration until the next turn, and for agent turns the response gap
+    after the preceding user turn."""
+    # Start of the next timed turn after each turn (one backwards pass)
+    following, upcoming = [], None
+    for item in reversed(transcript):
+        following.append(upcoming)
+        if item.get("time_in_call_secs") is not None:
+            upcoming = item["time_in_call_secs"]
+    following.reverse()
+
+    turns = []
+    last_user_at = None
+    for i, item in enumerate(transcript):
+        at = item.get("time_in_call_secs")
+        turn = {
+            "index": i,
+            "role": item.get("role", ""),
+            "at_s": at,
+            "duration_s": following[i] - at if at is not None and following[i] is not None else None,
+            "chars": len(item.get("message") or ""),
+            "tool_calls": [tc.get("tool_name") or tc.get("name") for tc in item.get("tool_calls") or []],
+        }
+        if turn["role"] == "user":
+            last_user_at = at
+        elif turn["role"] == "agent" and at is not None and last_user_at is not None:
+            turn["response_gap_s"] = at - last_user_at
+        metrics = (item.get("conversation_turn_metrics") or {}).get("metrics")
+        if metrics:
+            turn["metrics"] = {k: v.get("elapsed_time") for k, v in metrics.items() if isinstance(v, dict)}
+        if call_start is not None and at is not None:
+            turn["ts"] = call_start + at
+        turns.append(turn)
+    return turns
+
+
+def _linked_profiles(conversation_id, start, end):
+    """Profile calculations belonging to a call: entries tagged with its
+    conversation id, or untagged ones (ElevenLabs server tool calls) made
+    during the call window. Searches the newest WEBHOOK_PROFILE_SCAN entries:
+    audit_log is in write order, not strictly in time order (entries keep
+    the time their request came in, and a handoff puts the previous
+    process's entries in front), so an older entry doesn't end the search."""
+    linked = []
+    oldest = (start if start is not None else end - 3600) - 60
+    for record in itertools.islice(reversed(audit_log), WEBHOOK_PROFILE_SCAN):
+        if record.ts < oldest or not _is_client_profile(record):
+            continue
+        session_id = record.get("session_id")
+        in_window = start is not None and start - 5 <= record.ts <= end + 60
+        if session_id == conversation_id or (session_id is None and in_window):
+            linked.append(record)
+    linked.sort(key=lambda record: record.ts)
+    return [{"timestamp": _fmt_ts(r.ts), "profile": r.get("profile"),
+             "score": r.get("score"), "rules_version": r.get("rules_version")} for r in linked]
+
+
+def _store_transcript(conversation_id, document):
+    """Write one call's transcript gzip-compressed; returns (file name, bytes)."""
+    name = f"{conversation_id}.json.gz"
+    path = _TRANSCRIPT_DIR / name
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(gzip.compress(_json_dumps(document), compresslevel=6))
+    os.replace(tmp, path)
+    return name, path.stat().st_size
+
+
+def _webhook_data(body, ingest_id):
+    """(payload data, conversation id) of a webhook body. ElevenLabs wraps the
+    payload in "data"; the id falls back to the ingest id."""
+    data = body["data"] if isinstance(body.get("data"), dict) else body
+    conversation_id = str(data.get("conversation_id") or ingest_id)
+    # Only safe characters end up in the transcript file name
+    conversation_id = "".join(c for c in conversation_id if c.isalnum() or c in "-_")[:128] or ingest_id
+    return data, conversation_id
+
+
+async def _process_webhook(ingest_id, received, data, conversation_id):
+    t0 = time.perf_counter()
+    transcript = data.get("transcript") or []
+    metadata = data.get("metadata") or {}
+    start = metadata.get("start_time_unix_secs")
+    duration = metadata.get("call_duration_secs")
+    end = start + duration if start is not None and duration is not None else received
+
+    if isinstance(transcript, str):
+        turns, transcript_length = [], len(transcript)
+    else:
+        turns = _transcript_turns(transcript, start)
+        transcript_length = sum(len(t.get("message") or "") for t in transcript)
+    linked = _linked_profiles(conversation_id, start, end)
+    document = {
+        "conversation_id": conversation_id,
+        "received_at": _fmt_ts(received),
+        "metadata": metadata,
+        "analysis": data.get("analysis"),
+        "turns": turns,
+        "linked_profiles": linked,
+        "transcript": transcript,
+    }
+    file_name, stored_bytes = await asyncio.to_thread(_store_transcript, conversation_id, document)
 
-    wh_entry = {
-        "timestamp": str(datetime.now()),
+    _audit({
         "type": "elevenlabs_webhook",
-        "session_id": session_id,
-        "transcript_length": len(transcript) if transcript else 0,
-    }
-    audit_log.append(wh_entry)
-    _persist_log(wh_entry)
+        "session_id": conversation_id,
+        "transcript_length": transcript_length,
+        "turns": len(turns),
+        "call_duration_s": duration,
+        "linked_profiles": len(linked),
+        "transcript_file": file_name,
+        "stored_bytes": stored_bytes,
+        "queue_delay_ms": round((time.time() - received) * 1000, 1),
+    })
+    _log(f"[WEBHOOK] {conversation_id}: {len(turns)} turns, {len(linked)} profile(s) linked, "
+          f"{stored_bytes} bytes ({(time.perf_counter() - t0) * 1000:.0f}ms)")
+
+
+async def _webhook_loop():
+    while True:
+        ingest_id, received, data, conversation_id = await _webhook_queue.get()
+        try:
+            await _process_webhook(ingest_id, received, data, conversation_id)
+            _webhook_stats["processed"] += 1
+        except Exception as e:
+            _webhook_stats["failed"] += 1
+            _log(f"[WEBHOOK ERROR] {ingest_id}: {e}")
+        finally:
+            _webhook_queue.task_done()
+
+
+async def _start_webhook_worker():
+    global _webhook_queue, _webhook_worker
+    _TRANSCRIPT_DIR.mkdir(parents=True, exist_ok=True)
+    _webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    _webhook_worker = asyncio.create_task(_webhook_loop())
+
+
+async def _stop_webhook_worker():
+    """Finish every acknowledged payload before shutting down."""
+    if _webhook_worker is None:
+        return
+    await _webhook_queue.join()
+    _webhook_worker.cancel()
+
 
-    print(f"[WEBHOOK] Post-call data for session {session_id}")
-    return {"status": "received", "session_id": session_id}
+_startup_hooks.append(_start_webhook_worker)
+_shutdown_hooks.append(_stop_webhook_worker)
+
+
+@app.post("/webhook/elevenlabs")
+async def elevenlabs_webhook(request: Request):
+    """Post-call webhook. Acknowledges immediately; the payload is processed
+    in the background."""
+    ingest_id = uuid.uuid4().hex[:12]
+    try:
+        body = _json_loads(await request.body())
+    except json.JSONDecodeError:
+        body = None
+    if not isinstance(body, dict):
+        return JSONResponse(status_code=400, content={"error": "Webhook body must be a JSON object"})
+    if _audit_backlog_full():
+        return _audit_busy()
+    data, session_id = _webhook_data(body, ingest_id)
+    if _webhook_queue is None:  # app served without lifespan events
+        await _start_webhook_worker()
+    try:
+        _webhook_queue.put_nowait((ingest_id, time.time(), data, session_id))
+    except asyncio.QueueFull:
+        _webhook_stats["shed"] += 1
+        return JSONResponse(status_code=503, content={"error": "Webhook queue full, please retry"},
+                            headers={"Retry-After": "5"})
+    _webhook_stats["received"] += 1
+    return {"status": "received", "session_id": session_id, "ingest_id": ingest_id}
+
+
+@app.get("/transcripts/{conversation_id}")
+async def get_transcript(conversation_id: str, request: Request):
+    """Stored call transcript with per-turn timings and linked profiles.
+    Protected by API key."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    path = _TRANSCRIPT_DIR / f"{conversation_id}.json.gz"
+    if not conversation_id.replace("-", "").replace("_", "").isalnum() or not path.exists():
+        return JSONResponse(status_code=404, content={"error": "Transcript not found"})
+    raw = await asyncio.to_thread(lambda: gzip.decompress(path.read_bytes()))
+    return Response(content=raw, media_type="application/json")
 
 
 # =====================================================================
@@ -1084,12 +4170,12 @@ async def get_audit_log(request: Request):
     """Full audit trail - protected by API key."""
     if not _check_audit_key(request):
         return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
-    return {
+    return FastJSONResponse({
         "total_entries": len(audit_log),
         "model": LLM_MODEL,
         "server": "Hostinger VPS (CPU-only, on-premises)",
-        "entries": audit_log[-50:],
-    }
+        "entries": [e.to_dict() for e in audit_log[-50:]],
+    })
 
 
 @app.get("/audit/profiles")
@@ -1097,11 +4183,11 @@ async def get_profile_calculations(request: Request):
     """All profile calculations - protected by API key."""
     if not _check_audit_key(request):
         return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
-    profiles = [e for e in audit_log if e.get("type") == "profile_calculation"]
-    return {
+    profiles = [e.to_dict() for e in audit_log if e.type is AuditType.PROFILE]
+    return FastJSONResponse({
         "count": len(profiles),
         "calculations": profiles,
-    }
+    })
 
 
 @app.get("/audit/latest-profile")
@@ -1109,39 +4195,644 @@ async def get_latest_profile(request: Request):
     """Most recent profile calculation - protected by API key."""
     if not _check_audit_key(request):
         return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
-    profiles = [e for e in audit_log if e.get("type") == "profile_calculation"]
-    if not profiles:
-        return {"message": "No profiles calculated yet"}
-    return profiles[-1]
+    for e in reversed(audit_log):
+        if _is_client_profile(e):
+            return FastJSONResponse(e.to_dict())
+    return {"message": "No profiles calculated yet"}
+
+
+def _is_client_profile(record: AuditRecord) -> bool:
+    """A profile calculation from a conversation or /calculate-profile, not a bulk upload."""
+    return record.type is AuditType.PROFILE and record.get("bulk_id") is None
+
+
+def _stream_entry(record: AuditRecord) -> dict:
+    """Audit entry as pushed to the panels: profile results travel once, in
+    the profile event, not with every entry."""
+    entry = record.to_dict()
+    if record.type is AuditType.PROFILE:
+        entry.pop("result", None)
+    return entry
+
+
+def _sse(event: str, cursor: int, data) -> bytes:
+    return b"event: " + event.encode() + b"\nid: " + str(cursor).encode() + b"\ndata: " + _json_dumps(data) + b"\n\n"
+
+
+async def _audit_events(cursor: Optional[int]):
+    """SSE events from cursor on. A first connect, a cursor from before a
+    restart, or one too far behind gets a snapshot of the latest 50 entries
+    instead of a replay."""
+    _audit_stream.subscribers += 1
+    resets = _audit_stream.resets
+    try:
+        yield b"retry: 3000\n\n"
+        while True:
+            end = len(audit_log)
+            if cursor is None or cursor > end or end - cursor > 50 or resets != _audit_stream.resets:
+                resets = _audit_stream.resets
+                latest = next((e for e in reversed(audit_log) if _is_client_profile(e)), None)
+                yield _sse("snapshot", end, {
+                    "total_entries": end,
+                    "model": LLM_MODEL,
+                    "server": "Hostinger VPS (CPU-only, on-premises)",
+                    "entries": [_stream_entry(e) for e in audit_log[-50:]],
+                    "latest_profile": latest.to_dict() if latest else None,
+                })
+            elif cursor < end:
+                new = audit_log[cursor:end]
+                yield _sse("audit", end, {"total_entries": end, "entries": [_stream_entry(e) for e in new]})
+                profile = next((e for e in reversed(new) if _is_client_profile(e)), None)
+                if profile:
+                    yield _sse("profile", end, profile.to_dict())
+            cursor = end
+            if _audit_stream.closed:
+                return
+            while len(audit_log) == cursor:
+                if not await _audit_stream.wait(AUDIT_STREAM_HEARTBEAT):
+                    yield b": ping\n\n"  # keeps proxies from closing an idle stream
+                if _audit_stream.closed:
+                    return
+    finally:
+        _audit_stream.subscribers -= 1
+
+
+@app.get("/audit/stream")
+async def stream_audit_log(request: Request):
+    """Server-sent events with new audit entries and profile changes -
+    protected by API key. Resumes from Last-Event-ID (or ?cursor=)."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    if _audit_stream.closed or _audit_stream.subscribers >= AUDIT_STREAM_MAX_CLIENTS:
+        return JSONResponse(status_code=503, content={"error": "Too many audit stream subscribers"},
+                            headers={"Retry-After": "30"})
+    raw = request.headers.get("last-event-id") or request.query_params.get("cursor")
+    try:
+        cursor = int(raw) if raw else None
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "cursor must be an integer"})
+    return StreamingResponse(_audit_events(cursor), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/audit/analytics")
+@limiter.limit("30/minute")
+async def get_audit_analytics(request: Request):
+    """Profile distribution, restriction/coherence hit rates, LLM error rate
+    and session stats from incrementally maintained counters.
+    Params: ?key=AUDIT_KEY&hours=N (hourly rollups, default 24)&rebuild=1"""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    try:
+        hours = min(max(int(request.query_params.get("hours", 24)), 0), ANALYTICS_HOURS)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Invalid query parameter: hours"})
+    if not _log_ready.is_set():
+        return _log_not_open()
+    await _flush_audit_log()
+    if request.query_params.get("rebuild") in ("1", "true"):
+        started = _begin_analytics_rebuild()
+        if started is not None:
+            await asyncio.to_thread(_rebuild_analytics, *started)
+    return FastJSONResponse(_analytics_report(hours))
+
+
+@app.get("/audit/verify")
+@limiter.limit("10/minute")
+async def verify_audit_log(request: Request):
+    """Verify the audit log hash chain - protected by API key.
+    Incremental (from the last verified checkpoint) unless ?full=1."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    full = request.query_params.get("full") in ("1", "true")
+    if not _log_ready.is_set():
+        return _log_not_open()
+    await _flush_audit_log()
+    report = await asyncio.to_thread(_verify_audit_chain, full)
+    return JSONResponse(status_code=200 if report["ok"] else 409, content=report)
 
 
 @app.get("/logs")
 @limiter.limit("10/minute")
 async def get_persistent_logs(request: Request):
-    """Read persistent audit log (JSONL file). Protected by API key.
-    Params: ?key=AUDIT_KEY&last=N (default 100)"""
+    """Read persistent audit log (JSONL segments). Protected by API key.
+    Params: ?key=AUDIT_KEY&last=N (default 100)&type=&since=&until=
+    (since/until: epoch seconds or ISO timestamps)"""
     if not _check_audit_key(request):
         return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
-    last_n = int(request.query_params.get("last", 100))
-    entries = []
-    total = 0
-    if _LOG_FILE.exists():
-        with open(_LOG_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        total = len(lines)
-        for line in lines[-last_n:]:
-            try:
-                entries.append(json.loads(line))
-            except json.JSONDecodeError:
-                pass
-    return {
-        "total_lines": total,
-        "returned": len(entries),
+    params = request.query_params
+    try:
+        last_n = int(params.get("last", 100))
+        since, until = (_parse_time_param(params.get(name)) for name in ("since", "until"))
+    except ValueError as exc:
+        return JSONResponse(status_code=400, content={"error": f"Invalid query parameter: {exc}"})
+    if not _log_ready.is_set():
+        return _log_not_open()
+    await _flush_audit_log()
+    result = await asyncio.to_thread(_query_log, last_n, params.get("type"), since, until)
+    return FastJSONResponse({
+        "total_lines": result["total_lines"],
+        "returned": result["returned"],
+        "segments_read": result["segments_read"],
         "log_file": str(_LOG_FILE),
-        "entries": entries,
+        "entries": result["entries"],
+    })
+
+
+def _parse_time_param(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+# =====================================================================
+# Columnar Export (profile calculations for offline analysis)
+# =====================================================================
+# Streams profile_calculation entries out of the audit segments into one
+# flat row per assessment: every answer, every block score, one boolean per
+# restriction/coherence rule id, raw/final level and timestamp. Parquet when
+# pyarrow is installed (written in row groups, so memory stays bounded),
+# NumPy .npz otherwise (numpy is imported with the risk projection).
+# Missing answers are -1.
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_ROW_GROUP = 50_000
+_EXPORT_DIR = _LOG_DIR / "exports"
+_PROFILE_MARKER = AuditType.PROFILE.value.encode("ascii")
+_rule_id_maps = {}  # rules_version -> {rule/flag text: rule id}
+
+
+def _export_columns():
+    """Column layout covering every registered rule set, so exports that
+    span rule set versions share one schema."""
+    answers, blocks, rules = ["p1_1", "p1_2", "p1_3"], [], []
+    for definition in _ruleset_sources.values():
+        for block in definition["blocks"]:
+            if block["id"] not in blocks:
+                blocks.append(block["id"])
+            answers += [q[0] for q in block["questions"] if q[0] not in answers]
+        rules += [r["id"] for r in definition["rules"]["rules"] if r["id"] not in rules]
+    answers += [key for key in ("p6_1", "p6_2", "p6_3") if key not in answers]  # ESG, not scored
+    return {
+        "answers": answers, "blocks": blocks, "rules": rules,
+        "int": answers + [f"{b}_score" for b in blocks] + ["total_score", "raw_level", "final_level"],
+        "bool": [f"rule_{r}" for r in rules],
+        "str": ["session_id", "profile", "rules_version"],
     }
 
 
+def _rule_ids(version):
+    """Map restriction/coherence display text back to rule ids for a version
+    (results only carry the text)."""
+    ids = _rule_id_maps.get(version)
+    if ids is None:
+        definition = _ruleset_sources.get(version) or _ruleset_sources[CURRENT_RULESET]
+        ids = _rule_id_maps[version] = {
+            r.get("rule") or r.get("flag"): r["id"] for r in definition["rules"]["rules"]
+        }
+    return ids
+
+
+def _export_int(value):
+    """Integer cell: -1 for missing values, including the nulls and numeric
+    strings older entries carry (e.g. "p6_2": null when ESG was declined)."""
+    if type(value) is int:
+        return value
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    return -1
+
+
+def _profile_row(entry, ts, columns):
+    """Flatten one persisted profile_calculation entry into a column dict."""
+    result = entry.get("result") or {}
+    explanation = result.get("explanation") or {}
+    answers = explanation.get("input_answers") or {}
+    version = entry.get("rules_version") or result.get("rules_version") or CURRENT_RULESET
+    definition = _ruleset_sources.get(version) or _ruleset_sources[CURRENT_RULESET]
+    levels = {p[0]: i for i, p in enumerate(definition["profiles"])}
+    row = {key: _export_int(answers.get(key)) for key in columns["answers"]}
+    detail = explanation.get("scoring_detail") or {}
+    for block_id in columns["blocks"]:
+        row[f"{block_id}_score"] = _export_int((detail.get(block_id) or {}).get("score"))
+    row["total_score"] = _export_int(explanation.get("total_score"))
+    row["raw_level"] = levels.get(explanation.get("raw_profile"), -1)
+    row["final_level"] = levels.get(explanation.get("final_profile"), -1)
+    row.update(dict.fromkeys(columns["bool"], False))
+    ids = _rule_ids(version)
+    for item in (explanation.get("restrictions_applied") or []) + (explanation.get("coherence_checks") or []):
+        rule_id = ids.get(item.get("rule") or item.get("flag"))
+        if rule_id is not None:
+            row[f"rule_{rule_id}"] = True
+    row["session_id"] = entry.get("session_id") or ""
+    row["profile"] = entry.get("profile") or ""
+    row["rules_version"] = version
+    row["ts"] = ts
+    return row
+
+
+def _iter_profile_rows(columns, since=None, until=None):
+    """Profile rows from all retained segments (oldest first). The segment
+    index skips segments with no profile entries in range; most other lines
+    are rejected on a byte match before JSON parsing."""
+    with _index_lock:
+        plan = [dict(d) for d in _segments if not d.get("pruned")]
+    plan.append(None)
+    for desc in plan:
+        stats = desc if desc is not None else dict(_active)
+        if not stats.get("types", {}).get(AuditType.PROFILE.value):
+            continue
+        if (since is not None and stats["last_ts"] < since) or (until is not None and stats["first_ts"] > until):
+            continue
+        with _open_segment(desc) as f:
+            for line in f:
+                if _PROFILE_MARKER not in line:
+                    continue
+                try:
+                    entry = _json_loads(line)
+                    ts = datetime.fromisoformat(entry["timestamp"]).timestamp()
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if entry.get("type") != AuditType.PROFILE.value:
+                    continue
+                if (since is not None and ts < since) or (until is not None and ts > until):
+                    continue
+                yield _profile_row(entry, ts, columns)
+
+
+def _export_profiles(path, fmt, since=None, until=None) -> int:
+    """Write profile calculations to `path` as parquet or npz. Returns rows."""
+    columns = _export_columns()
+    rows = _iter_profile_rows(columns, since, until)
+    if fmt == "parquet":
+        fields = [pyarrow.field("ts", pyarrow.timestamp("us", tz="UTC"))]
+        fields += [pyarrow.field(c, pyarrow.int32()) for c in columns["int"]]
+        fields += [pyarrow.field(c, pyarrow.bool_()) for c in columns["bool"]]
+        fields += [pyarrow.field(c, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())) for c in columns["str"]]
+        schema = pyarrow.schema(fields)
+        total = 0
+        with pyarrow.parquet.ParquetWriter(path, schema, compression="zstd") as writer:
+            while True:
+                batch = list(itertools.islice(rows, EXPORT_ROW_GROUP))
+                if not batch:
+                    break
+                data = {name: [r[name] for r in batch] for name in schema.names}
+                data["ts"] = [int(r["ts"] * 1_000_000) for r in batch]
+                writer.write_table(pyarrow.Table.from_pydict(data, schema=schema))
+                total += len(batch)
+        return total
+
+    # npz: accumulate typed buffers (compact), convert once at the end
+    ints = {c: array.array("i") for c in columns["int"]}
+    bools = {c: array.array("b") for c in columns["bool"]}
+    strs = {c: [] for c in columns["str"]}
+    ts = array.array("d")
+    for row in rows:
+        ts.append(row["ts"])
+        for c, buf in ints.items():
+            buf.append(row[c])
+        for c, buf in bools.items():
+            buf.append(row[c])
+        for c, buf in strs.items():
+            buf.append(row[c])
+    arrays = {"ts": numpy.frombuffer(ts, dtype=numpy.float64)}
+    arrays.update({c: numpy.frombuffer(buf, dtype=numpy.int32) for c, buf in ints.items()})
+    arrays.update({c: numpy.frombuffer(buf, dtype=numpy.int8).astype(bool) for c, buf in bools.items()})
+    arrays.update({c: numpy.asarray(values, dtype=str) for c, values in strs.items()})
+    with open(path, "wb") as f:
+        numpy.savez_compressed(f, **arrays)
+    return len(ts)
+
+
+@app.get("/audit/export")
+@limiter.limit("5/minute")
+async def export_profile_calculations(request: Request):
+    """Columnar export of profile calculations. Protected by API key.
+    Params: ?key=AUDIT_KEY&format=parquet|npz (default: parquet if
+    pyarrow is installed)&since=&until= (epoch seconds or ISO)"""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    params = request.query_params
+    fmt = params.get("format") or ("parquet" if pyarrow is not None else "npz")
+    available = [name for name, mod in (("parquet", pyarrow), ("npz", numpy)) if mod is not None]
+    if fmt not in available:
+        return JSONResponse(status_code=400, content={
+            "error": f"Export format not available: {fmt}",
+            "available": available,
+        })
+    try:
+        since, until = (_parse_time_param(params.get(name)) for name in ("since", "until"))
+    except ValueError as exc:
+        return JSONResponse(status_code=400, content={"error": f"Invalid query parameter: {exc}"})
+
+    if not _log_ready.is_set():
+        return _log_not_open()
+    _EXPORT_DIR.mkdir(exist_ok=True)
+    path = _EXPORT_DIR / f"profiles-{uuid.uuid4().hex[:12]}.{fmt}"
+    t0 = time.perf_counter()
+    await _flush_audit_log()
+    try:
+        rows = await asyncio.to_thread(_export_profiles, path, fmt, since, until)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    _log(f"[EXPORT] {rows} profile rows -> {fmt} ({path.stat().st_size} bytes, {time.perf_counter() - t0:.2f}s)")
+    return FileResponse(
+        path, media_type="application/octet-stream",
+        filename=f"profile_calculations.{fmt}",
+        headers={"X-Export-Rows": str(rows)},
+        background=BackgroundTask(path.unlink, missing_ok=True),
+    )
+
+
+# =====================================================================
+# Profiling (admin, off unless asked for)
+# =====================================================================
+# GET /debug/profile?seconds=N samples every thread's stack from a side
+# thread and returns them in collapsed format (one "root;caller;callee count"
+# line per stack), ready for flamegraph.pl, speedscope or inferno.
+# A request sent with X-Profile: 1 and the audit key runs under cProfile end
+# to end (streamed responses included); the response carries X-Profile-Id
+# and GET /debug/profiles/{id} returns the stats. cProfile sees everything
+# the event loop runs meanwhile, so profile on a quiet instance. With neither
+# in use the only cost is the middleware's header check.
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+_PROFILE_DIR = _LOG_DIR / "profiles"
+_profiling = {"sampler": False, "request": False}
+_request_profiles = OrderedDict()  # id -> {"method", "path", "status", "duration_ms", "at"}
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_stacks(seconds, interval, thread_name=None):
+    """Sample all threads (or those named thread_name) every `interval`
+    seconds. Returns (samples taken, {collapsed stack: count})."""
+    me = threading.get_ident()
+    names = {}
+    stacks = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if ident not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            name = names.get(ident, f"thread-{ident}")
+            if thread_name and name != thread_name:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(name)
+            key = ";".join(reversed(stack))
+            stacks[key] = stacks.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+@app.get("/debug/profile")
+async def sample_profile(request: Request):
+    """Sampling profiler - protected by API key. ?seconds= (default 10),
+    ?interval_ms= (default 5), ?thread= to keep one thread (MainThread is
+    the event loop). Returns collapsed stacks as text/plain."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    params = request.query_params
+    try:
+        seconds = float(params.get("seconds", "10"))
+        interval = float(params.get("interval_ms", "5")) / 1000
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "seconds and interval_ms must be numbers"})
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0.001 <= interval <= 1:
+        return JSONResponse(status_code=400, content={
+            "error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}], interval_ms in [1, 1000]",
+        })
+    if _profiling["sampler"]:
+        return JSONResponse(status_code=409, content={"error": "A sampling profile is already running"})
+    _profiling["sampler"] = True
+    try:
+        samples, stacks = await asyncio.to_thread(_sample_stacks, seconds, interval, params.get("thread"))
+    finally:
+        _profiling["sampler"] = False
+    body = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda kv: -kv[1]))
+    return Response(content=body, media_type="text/plain; charset=utf-8",
+                    headers={"X-Samples": str(samples), "X-Interval-Ms": f"{interval * 1000:g}"})
+
+
+def _save_request_profile(profile_id, profiler, info):
+    _PROFILE_DIR.mkdir(exist_ok=True)
+    profiler.dump_stats(str(_PROFILE_DIR / f"{profile_id}.prof"))
+    _request_profiles[profile_id] = info
+    while len(_request_profiles) > PROFILE_KEEP:
+        old_id, _ = _request_profiles.popitem(last=False)
+        (_PROFILE_DIR / f"{old_id}.prof").unlink(missing_ok=True)
+
+
+class _ProfileMiddleware:
+    """Pure ASGI middleware: runs a request under cProfile when it carries
+    X-Profile and the audit key. One profiled request at a time; others
+    (and requests without a valid key) run normally."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or _profiling["request"] \
+                or not any(name == b"x-profile" for name, _ in scope["headers"]) \
+                or not _check_audit_key(Request(scope)):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex[:12]
+        info = {"method": scope["method"], "path": scope["path"], "status": None, "at": str(datetime.now())}
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                info["status"] = message["status"]
+                message = {**message, "headers": [*message.get("headers", ()), (b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        profiler = cProfile.Profile()
+        _profiling["request"] = True
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.disable()
+            info["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            _profiling["request"] = False
+            _defer(_save_request_profile, profile_id, profiler, info)
+
+
+app.add_middleware(_ProfileMiddleware)
+
+
+@app.get("/debug/profiles")
+async def list_request_profiles(request: Request):
+    """Recent per-request profiles - protected by API key."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    return {"profiles": [{"id": k, **v} for k, v in reversed(list(_request_profiles.items()))]}
+
+
+@app.get("/debug/profiles/{profile_id}")
+async def get_request_profile(profile_id: str, request: Request):
+    """One request's cProfile stats - protected by API key. Text report by
+    default (?sort=cumulative|tottime|calls, ?limit=40); ?format=prof
+    downloads the raw stats for snakeviz or pstats."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    info = _request_profiles.get(profile_id)
+    if info is None:
+        return JSONResponse(status_code=404, content={"error": f"Unknown profile: {profile_id}"})
+    path = _PROFILE_DIR / f"{profile_id}.prof"
+    params = request.query_params
+    if params.get("format") == "prof":
+        return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
+    sort = params.get("sort", "cumulative")
+    if sort not in ("cumulative", "tottime", "calls"):
+        return JSONResponse(status_code=400, content={"error": "sort must be cumulative, tottime or calls"})
+    try:
+        limit = int(params.get("limit", "40"))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "limit must be an integer"})
+    out = io.StringIO()
+    out.write(f"{info['method']} {info['path']} -> {info['status']} in {info['duration_ms']} ms at {info['at']}\n")
+    pstats.Stats(str(path), stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+    return Response(content=out.getvalue(), media_type="text/plain; charset=utf-8")
+
+
+# ---- Event loop lag ----
+# A monitor task sleeps LOOP_LAG_INTERVAL at a time and records how late it
+# wakes up: that is how long anything else on the loop waited to be
+# scheduled. A watchdog thread watches the monitor's heartbeat; once the
+# loop is more than LOOP_LAG_THRESHOLD late it captures the loop thread's
+# stack while the blocking call is still running, so blocking regressions
+# show up with the code that caused them. LOOP_LAG_INTERVAL=0 turns it off.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.05"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+LOOP_LAG_STALLS = int(os.getenv("LOOP_LAG_STALLS", "50"))
+_LAG_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+_loop_lag = {
+    "beat": None,    # monotonic time the monitor last went to sleep
+    "thread": None,  # event loop thread id
+    "count": 0, "sum_ms": 0.0, "max_ms": 0.0,
+    "buckets": [0] * (len(_LAG_BUCKETS_MS) + 1),  # per bucket, last one is +Inf
+    "recent": deque(maxlen=1000),
+    "stalls": deque(maxlen=LOOP_LAG_STALLS),  # newest last
+    "stalls_total": 0,
+    "stalled_beat": None,   # beat the current stall was captured for
+    "current_stall": None,  # stall captured but not yet over
+}
+_loop_monitor = {"task": None, "watchdog": None, "stop": None}
+
+
+def _observe_lag(lag_ms):
+    state = _loop_lag
+    state["count"] += 1
+    state["sum_ms"] += lag_ms
+    state["max_ms"] = max(state["max_ms"], lag_ms)
+    state["buckets"][bisect.bisect_left(_LAG_BUCKETS_MS, lag_ms)] += 1
+    state["recent"].append(lag_ms)
+
+
+async def _loop_lag_monitor():
+    _loop_lag["thread"] = threading.get_ident()
+    while True:
+        beat = _loop_lag["beat"] = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag_ms = max(0.0, time.monotonic() - beat - LOOP_LAG_INTERVAL) * 1000
+        _observe_lag(lag_ms)
+        stall = _loop_lag["current_stall"]
+        if stall is not None:
+            _loop_lag["current_stall"] = None
+            stall["blocked_ms"] = round(lag_ms, 1)
+            _log(f"[LOOP BLOCKED] {stall['blocked_ms']} ms in {stall['stack'][-1] if stall['stack'] else '?'}")
+
+
+def _lag_watchdog(stop):
+    while not stop.wait(LOOP_LAG_THRESHOLD / 2):
+        beat = _loop_lag["beat"]
+        if beat is None or beat == _loop_lag["stalled_beat"]:
+            continue
+        if time.monotonic() - beat - LOOP_LAG_INTERVAL > LOOP_LAG_THRESHOLD:
+            frame = sys._current_frames().get(_loop_lag["thread"])
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stall = {"at": str(datetime.now()), "blocked_ms": None, "stack": stack[::-1]}  # outermost first
+            _loop_lag["stalled_beat"] = beat
+            _loop_lag["current_stall"] = stall
+            _loop_lag["stalls"].append(stall)
+            _loop_lag["stalls_total"] += 1
+
+
+async def _start_loop_monitor():
+    if LOOP_LAG_INTERVAL <= 0:
+        return
+    stop = threading.Event()
+    _loop_monitor["stop"] = stop
+    _loop_monitor["task"] = asyncio.create_task(_loop_lag_monitor())
+    _loop_monitor["watchdog"] = threading.Thread(target=_lag_watchdog, args=(stop,), name="loop-watchdog", daemon=True)
+    _loop_monitor["watchdog"].start()
+
+
+async def _stop_loop_monitor():
+    if _loop_monitor["task"] is None:
+        return
+    _loop_monitor["stop"].set()
+    _loop_monitor["task"].cancel()
+    _loop_monitor["task"] = None
+    _loop_lag["beat"] = None
+
+_startup_hooks.append(_start_loop_monitor)
+_shutdown_hooks.append(_stop_loop_monitor)
+
+
+def _loop_lag_metrics():
+    state = _loop_lag
+    recent = sorted(state["recent"])
+    pct = lambda q: round(recent[min(len(recent) - 1, int(len(recent) * q))], 1) if recent else 0.0
+    cumulative, histogram = 0, []
+    for bound, count in zip((*_LAG_BUCKETS_MS, "+Inf"), state["buckets"]):
+        cumulative += count
+        histogram.append({"le_ms": bound, "count": cumulative})
+    return {
+        "interval_ms": LOOP_LAG_INTERVAL * 1000,
+        "threshold_ms": LOOP_LAG_THRESHOLD * 1000,
+        "samples": state["count"],
+        "mean_ms": round(state["sum_ms"] / state["count"], 2) if state["count"] else 0.0,
+        "max_ms": round(state["max_ms"], 1),
+        "p50_ms": pct(0.5), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+        "histogram": histogram,
+        "stalls_total": state["stalls_total"],
+    }
+
+
+@app.get("/metrics/loop")
+async def loop_lag_metrics(request: Request):
+    """Event loop scheduling delay: histogram since start, percentiles over
+    the last 1000 samples and the most recent stalls with the stack of the
+    code that blocked the loop - protected by API key."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    return {**_loop_lag_metrics(), "stalls": list(reversed(_loop_lag["stalls"]))}
+
+
 # =====================================================================
 # Utility Endpoints
 # =====================================================================
@@ -1155,6 +4846,20 @@ async def health():
         "llm_provider": "Groq" if "groq" in LLM_URL else "Ollama",
         "audit_entries": len(audit_log),
         "active_sessions": len(sessions),
+        "steer_cache": {"entries": len(_steer_cache), "capacity": STEER_CACHE_SIZE, **_steer_stats},
+        "rate_limits": {"buckets": len(_buckets), **_bucket_stats},
+        "upstream": {k: v for k, v in _upstream_metrics().items() if k != "lanes"},
+        "webhooks": {"queued": _webhook_queue.qsize() if _webhook_queue else 0, **_webhook_stats},
+        "content": {"version": _content["version"], "rules_version": CURRENT_RULESET},
+        "pid": os.getpid(),
+        "draining": _draining,
+        "audit_log_open": _log_ready.is_set(),
+        "audit_stream": {"subscribers": _audit_stream.subscribers, "published": _audit_stream.published},
+        "loop_lag": {k: v for k, v in _loop_lag_metrics().items() if k in ("p95_ms", "max_ms", "stalls_total")},
+        "background": {
+            "audit_queued": _audit_queue.qsize(), **_audit_writer_stats,
+            "queued": _background_queue.qsize() if _background_queue else 0, **_background_stats,
+        },
         "architecture": {
             "brain": f"{LLM_MODEL} via Groq API",
             "voice": "ElevenLabs (STT + TTS only)",
@@ -1163,21 +4868,198 @@ async def health():
     }
 
 
+@app.get("/metrics/upstream")
+async def upstream_metrics():
+    """Upstream scheduler: active calls, queue depth and wait times per lane."""
+    return _upstream_metrics()
+
+
+@app.get("/metrics/llm")
+async def llm_metrics(request: Request):
+    """LLM token usage and latency per conversation stage (p50/p95 tokens per
+    turn, latency, time to first token, tokens/s) and the sessions using the
+    most tokens. ?session_id= returns one session's totals. Protected by
+    API key: session ids open /history and /transcripts."""
+    if not _check_audit_key(request):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing audit key"})
+    session_id = request.query_params.get("session_id")
+    if session_id:
+        totals = _usage_sessions.get(session_id)
+        if totals is None:
+            return JSONResponse(status_code=404, content={"error": f"No LLM calls recorded for {session_id}"})
+        return {"session_id": session_id, **_usage_summary(totals)}
+    try:
+        top = int(request.query_params.get("top", "10"))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "top must be an integer"})
+
+    overall = _new_usage_totals()
+    for stats in _usage_stages.values():
+        for key in overall:
+            overall[key] += stats[key]
+    busiest = sorted(_usage_sessions.items(), key=lambda kv: kv[1]["prompt_tokens"] + kv[1]["completion_tokens"],
+                     reverse=True)[:max(top, 0)]
+    return {
+        "model": LLM_MODEL,
+        "window": USAGE_WINDOW,
+        "total": _usage_summary(overall),
+        "stages": {stage: _usage_summary(stats) for stage, stats in _usage_stages.items()},
+        "top_sessions": [{"session_id": key, **_usage_summary(totals)} for key, totals in busiest],
+        "sessions_tracked": len(_usage_sessions),
+    }
+
+
+@app.get("/rules")
+async def list_rulesets():
+    """Registered scoring rule set versions and their content hashes."""
+    return {
+        "current": CURRENT_RULESET,
+        "versions": [
+            {
+                "version": version,
+                "hash": _ruleset_hash(definition),
+                "jurisdiction": definition["rules"].get("jurisdiction", ""),
+                "compiled": version in _compiled_rulesets,
+            }
+            for version, definition in _ruleset_sources.items()
+        ],
+    }
+
+
 @app.get("/history/{session_id}")
 async def get_history(session_id: str):
-    if session_id not in sessions:
-        return {"history": []}
-    return {"history": sessions[session_id]["history"]}
+    session = sessions.get(session_id)
+    if session is None:
+        await _handoff_sessions()
+        session = sessions.get(session_id) or _restore_session(session_id)  # saved by the previous process
+        if session is None:
+            return {"history": []}
+        sessions[session_id] = session
+    return FastJSONResponse({"history": [h.to_dict() for h in session.history]})
 
 
 @app.get("/sessions")
 async def list_sessions():
-    return {"sessions": list(sessions.keys()), "count": len(sessions)}
+    return {"sessions": list(sessions.keys()), "count": len(sessions),
+            "connected": sum(1 for s in sessions.values() if s.connections)}
 
 
 import pathlib
-_FRONTEND_HTML = pathlib.Path(__file__).resolve().parent.parent / "frontend" / "goose-advisor-voice.html"
+_REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+_FRONTEND_HTML = _REPO_ROOT / "frontend" / "goose-advisor-voice.html"
+
+# ---- Static assets: loaded at startup, precompressed, served with strong ETags ----
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# path -> (file, media type, Cache-Control). The page revalidates on every
+# load (a 304 costs one round trip) so deploys show up immediately; images
+# are cached for a day.
+_STATIC_FILES = {
+    "/": (_FRONTEND_HTML, "text/html; charset=utf-8", "no-cache"),
+    "/favicon.ico": (_REPO_ROOT / "goose_favicon.ico", "image/x-icon", "public, max-age=86400"),
+    "/goose_favicon.ico": (_REPO_ROOT / "goose_favicon.ico", "image/x-icon", "public, max-age=86400"),
+    "/logo.png": (_REPO_ROOT / "Goose Logo.png", "image/png", "public, max-age=86400"),
+    "/logo-square.png": (_REPO_ROOT / "Goose_Logo_squared.png", "image/png", "public, max-age=86400"),
+}
+_static_assets = {}  # path -> {"media_type", "cache_control", "tag", "variants": {encoding: (body, etag)}}
+
+
+def _load_static_asset(path, media_type, cache_control):
+    """Read a file once and keep identity/gzip/brotli variants in memory.
+    Compressed variants are kept only when they save at least 10%."""
+    body = path.read_bytes()
+    tag = hashlib.sha256(body).hexdigest()[:20]
+    variants = {"identity": (body, f'"{tag}"')}
+    candidates = {"gzip": lambda b: gzip.compress(b, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        candidates["br"] = lambda b: brotli.compress(b, quality=11)
+    for encoding, compress in candidates.items():
+        packed = compress(body)
+        if len(packed) < len(body) * 0.9:
+            # Strong ETags are per representation, so each encoding gets its own
+            variants[encoding] = (packed, f'"{tag}-{encoding}"')
+    return {"media_type": media_type, "cache_control": cache_control, "tag": tag, "variants": variants}
+
+
+def _load_static_assets():
+    for route, (path, media_type, cache_control) in _STATIC_FILES.items():
+        if path.exists():
+            _static_assets[route] = _load_static_asset(path, media_type, cache_control)
+        else:
+            logger.warning("[STATIC] %s not found, %s will 404", path.name, route)
 
-@app.get("/")
-async def serve_frontend():
-    return FileResponse(_FRONTEND_HTML, media_type="text/html")
+
+def _accepted_encodings(header: str) -> set:
+    """Content codings the client accepts (q > 0) from Accept-Encoding."""
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _serve_static(request: Request, route: str) -> Response:
+    asset = _static_assets.get(route)
+    if asset is None:
+        return JSONResponse(status_code=404, content={"error": "Not found"})
+    variants = asset["variants"]
+    accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next((e for e in ("br", "gzip") if e in variants and (e in accepted or "*" in accepted)), "identity")
+    body, etag = variants[encoding]
+    headers = {"ETag": etag, "Cache-Control": asset["cache_control"]}
+    if len(variants) > 1:
+        headers["Vary"] = "Accept-Encoding"
+
+    # Any of our tags for this content means the client's copy is current
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        if "*" in tags or any(t.strip('"').split("-")[0] == asset["tag"] for t in tags):
+            return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=asset["media_type"], headers=headers)
+
+
+async def _start_static_assets():
+    await asyncio.to_thread(_load_static_assets)
+
+
+_startup_hooks.append(_start_static_assets)
+_reload_hooks.append(_load_static_assets)  # the page is content too
+
+
+@app.api_route("/", methods=["GET", "HEAD"])
+async def serve_frontend(request: Request):
+    return _serve_static(request, "/")
+
+
+@app.api_route("/favicon.ico", methods=["GET", "HEAD"])
+@app.api_route("/goose_favicon.ico", methods=["GET", "HEAD"])
+@app.api_route("/logo.png", methods=["GET", "HEAD"])
+@app.api_route("/logo-square.png", methods=["GET", "HEAD"])
+async def serve_static_asset(request: Request):
+    return _serve_static(request, request.url.path)
+
+
+if __name__ == "__main__":
+    # python main.py serves like `uvicorn main:app`, but binds with
+    # SO_REUSEPORT so the next deploy can start beside it (see Graceful handoff)
+    import socket
+    import uvicorn
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((os.getenv("HOST", "0.0.0.0"), int(os.getenv("PORT", "8000"))))
+    uvicorn.Server(uvicorn.Config(app, timeout_graceful_shutdown=SHUTDOWN_GRACE)).run(sockets=[sock])
@@ -0,0 +1,242 @@
+"""Offline bulk scoring: answer files in, profiles out, no web server needed.
+
+Scores every answer set with the same logic as /calculate-profile
+(main._build_profile_result) on a pool of worker processes. Nothing goes to
+the audit log. The output file is the record, and every row carries the
+rules version and hash it was scored under.
+
+Input, by file extension:
+  .csv    header with p1_1 ... p6_3 and optional "id" / "rules_version"
+          columns; empty cells are unanswered
+  .jsonl  one object per line, {"id", "answers", "rules_version"} as for
+          /calculate-profile/bulk, or the answers object itself
+
+Output, by file extension:
+  .jsonl  profile, allocation, ETFs, ESG, risk projection and the full
+          explanation per answer set
+  .csv    one flat row per answer set (allocation %, tickers, restrictions,
+          coherence warnings, adjustments, VaR)
+
+Rows come out in input order; rows that don't validate get an "error".
+
+Usage (from the repo root):
+    python backend/rescore.py answers.csv [-o results.jsonl] [--workers N]
+                              [--chunk-size N] [--rules-version V]
+"""
+import argparse, csv, io, json, multiprocessing, os, sys, time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pydantic import ValidationError
+
+import main
+
+ASSET_CLASSES = list(main.PROFILE_ALLOCATIONS["Moderate"])
+CSV_COLUMNS = (["line", "id", "profile", "score", "raw_profile"]
+               + [f"{asset_class} %" for asset_class in ASSET_CLASSES]
+               + ["etfs", "restrictions", "coherence_warnings", "adjustments",
+                  "var_95_1y_pct", "risk_fits", "rules_version", "rules_hash", "error"])
+
+
+def _read_csv_items(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def _read_jsonl_items(path):
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield number, line
+
+
+def _items(path):
+    """(line number, raw item) for every input answer set. CSV rows are
+    dicts, JSONL lines strings; both are parsed in the workers."""
+    if path.suffix.lower() == ".csv":
+        return _read_csv_items(path)
+    return _read_jsonl_items(path)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _request_data(raw):
+    """Request body (as for /calculate-profile/bulk) from a CSV row or JSONL line."""
+    if isinstance(raw, dict):
+        return {
+            "id": raw.pop("id", None) or None,
+            "rules_version": raw.pop("rules_version", None) or None,
+            "answers": {k: v.strip() for k, v in raw.items() if k and v and v.strip()},
+        }
+    data = main._json_loads(raw)
+    if isinstance(data, dict) and "answers" not in data:
+        data = {"id": data.pop("id", None), "rules_version": data.pop("rules_version", None), "answers": data}
+    return data
+
+
+def _row(number, raw, default_version):
+    """Score one item. Returns (output row, profile or None)."""
+    try:
+        data = _request_data(raw)
+    except json.JSONDecodeError:
+        return {"line": number, "error": "Invalid JSON"}, None
+    ref = data.get("id") if isinstance(data, dict) else None
+    try:
+        req = main.BulkProfileRequest.model_validate(data)
+    except ValidationError as e:
+        errors = "; ".join(f"{err['field']}: {err['message']}" for err in main._validation_errors(e))
+        return {"line": number, "id": ref, "error": f"Invalid answers: {errors}"}, None
+    try:
+        ruleset = main._get_ruleset(req.rules_version or default_version)
+    except KeyError:
+        return {"line": number, "id": ref, "error": f"Unknown rules version: {req.rules_version}"}, None
+
+    result = main._build_profile_result(req.answers.as_dict(), ruleset)
+    return {
+        "line": number,
+        "id": ref,
+        "profile": result["profile"],
+        "score": result["score"],
+        "allocation": result["allocation"],
+        "recommended_etfs": {ac: [e["ticker"] for e in etfs] for ac, etfs in result["recommended_etfs"].items()},
+        "esg_preferences": result["esg_preferences"],
+        "risk_projection": result["risk_projection"],
+        "explanation": result["explanation"],
+        "rules_version": result["rules_version"],
+        "rules_hash": result["rules_hash"],
+    }, result["profile"]
+
+
+def _csv_cells(row):
+    if "error" in row:
+        return [row["line"], row.get("id"), *[""] * (len(CSV_COLUMNS) - 3), row["error"]]
+    explanation, risk = row["explanation"], row["risk_projection"]
+    return [
+        row["line"], row["id"], row["profile"], row["score"], explanation["raw_profile"],
+        *[row["allocation"].get(asset_class, 0) for asset_class in ASSET_CLASSES],
+        " ".join(t for tickers in row["recommended_etfs"].values() for t in tickers),
+        "; ".join(r["rule"] for r in explanation["restrictions_applied"]),
+        "; ".join(c["detail"] for c in explanation["coherence_checks"]),
+        "; ".join(explanation["adjustments"]),
+        risk["var_95_1y_pct"] if risk else "",
+        risk["loss_tolerance"]["fits"] if risk else "",
+        row["rules_version"], row["rules_hash"], "",
+    ]
+
+
+def _score_chunk(chunk, output_format, default_version):
+    """Worker: score a chunk and return (output text, profile counts, errors)."""
+    profiles, errors = Counter(), 0
+    if output_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+    else:
+        lines = []
+    for number, raw in chunk:
+        row, profile = _row(number, raw, default_version)
+        if profile is None:
+            errors += 1
+        else:
+            profiles[profile] += 1
+        if output_format == "csv":
+            writer.writerow(_csv_cells(row))
+        else:
+            lines.append(main._json_dumps(row).decode("utf-8"))
+    text = buffer.getvalue() if output_format == "csv" else "\n".join(lines) + "\n"
+    return text, profiles, errors
+
+
+def rescore(source, target, workers, chunk_size, rules_version):
+    """Score `source` into `target` and return the run summary."""
+    output_format = "csv" if target.suffix.lower() == ".csv" else "jsonl"
+    version = main._get_ruleset(rules_version)["version"]
+    profiles, stats = Counter(), {"scored": 0, "errors": 0}
+    started = time.perf_counter()
+
+    # spawn: each worker imports main afresh, which only reads the config and compiles
+    # the rule sets; the log, its writer thread and the caches start with the app
+    context = multiprocessing.get_context("spawn")
+    with open(target, "w", newline="", encoding="utf-8") as out, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        if output_format == "csv":
+            csv.writer(out).writerow(CSV_COLUMNS)
+        pending = deque()  # futures in input order; at most two per worker in flight
+
+        def write_next():
+            text, counts, errors = pending.popleft().result()
+            out.write(text)
+            profiles.update(counts)
+            stats["errors"] += errors
+            stats["scored"] += sum(counts.values())
+
+        for chunk in _chunks(_items(source), chunk_size):
+            pending.append(pool.submit(_score_chunk, chunk, output_format, version))
+            if len(pending) >= workers * 2:
+                write_next()
+        while pending:
+            write_next()
+
+    seconds = time.perf_counter() - started
+    total = stats["scored"] + stats["errors"]
+    return {
+        "input": str(source),
+        "output": str(target),
+        "rules_version": version,
+        "rules_hash": main._get_ruleset(version)["hash"],
+        "answer_sets": total,
+        "scored": stats["scored"],
+        "errors": stats["errors"],
+        "workers": workers,
+        "seconds": round(seconds, 2),
+        "per_second": round(total / seconds, 1) if seconds else None,
+        "profiles": dict(profiles.most_common()),
+    }
+
+
+def _print_summary(summary):
+    print(f"Scored {summary['answer_sets']} answer sets ({summary['scored']} ok, {summary['errors']} errors) "
+          f"in {summary['seconds']}s with {summary['workers']} workers: {summary['per_second']} per second",
+          file=sys.stderr)
+    print(f"Rules: {summary['rules_version']} ({summary['rules_hash']})", file=sys.stderr)
+    for profile, count in summary["profiles"].items():
+        print(f"  {profile:<22}{count:>9}  {count / max(summary['scored'], 1):6.1%}", file=sys.stderr)
+    print(f"Output: {summary['output']}", file=sys.stderr)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Score CSV or JSONL answer files offline.")
+    parser.add_argument("input", type=Path, help="answers file (.csv or .jsonl)")
+    parser.add_argument("-o", "--output", type=Path, help="results file (.jsonl or .csv); default <input>.scored.jsonl")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="answer sets per task (default: 500)")
+    parser.add_argument("--rules-version", help="rule set to score against (default: the current one)")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON on stdout")
+    args = parser.parse_args(argv)
+
+    if not args.input.is_file():
+        parser.error(f"no such file: {args.input}")
+    try:
+        main._get_ruleset(args.rules_version)
+    except KeyError:
+        parser.error(f"unknown rules version: {args.rules_version} (available: {', '.join(main._ruleset_sources)})")
+    target = args.output or args.input.with_suffix(".scored.jsonl")
+    summary = rescore(args.input, target, max(args.workers, 1), max(args.chunk_size, 1), args.rules_version)
+    _print_summary(summary)
+    if args.json:
+        print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,37 @@
+"""Shared setup: main is imported once, against a throwaway log and config
+directory, with rate limits off and no reachable LLM."""
+import os, sys, pathlib, tempfile
+
+import pytest
+
+_WORK = pathlib.Path(tempfile.mkdtemp(prefix="goose-tests-"))
+os.environ["LOG_DIR"] = str(_WORK / "logs")
+os.environ["CONFIG_DIR"] = str(_WORK / "config")
+os.environ["AUDIT_SIGNING_KEY"] = "test-signing-key"
+os.environ["BULK_API_KEY"] = "test-bulk-key"
+os.environ["LLM_URL"] = "http://127.0.0.1:9"
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+main.limiter.enabled = False
+
+AUDIT_KEY = {"x-audit-key": main.AUDIT_KEY}
+ANSWERS = {
+    "p1_1": 1, "p1_2": 0, "p1_3": 0, "p2_1": 3, "p2_2": 2, "p2_3": 3, "p2_4": 2, "p2_5": 3,
+    "p3_1": 2, "p3_2": 2, "p3_3": 1, "p3_4": 2, "p3_5": 2, "p4_1": 2, "p4_2": 3, "p4_3": 1,
+    "p4_4": 2, "p4_5": 2, "p5_1": 2, "p5_2": 2, "p5_3": 2, "p5_4": 2, "p6_1": 0,
+}
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as c:
+        assert main._log_ready.wait(10), "audit log not opened"
+        yield c
+
+
+def flush():
+    """Wait until every audited entry is on disk."""
+    main._audit_queue.join()
@@ -0,0 +1,47 @@
+import time
+
+import main
+from conftest import ANSWERS, AUDIT_KEY, flush
+
+COUNTERS = ("entries", "by_type", "profiles", "restrictions", "coherence", "llm", "sessions")
+
+
+def _report(client, **params):
+    response = client.get("/audit/analytics", headers=AUDIT_KEY, params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def _wait_for_startup_rebuild():
+    deadline = time.time() + 10
+    while not main._analytics_startup.done():
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+
+def test_incremental_counters_match_a_rebuild(client):
+    _wait_for_startup_rebuild()
+    before = _report(client)
+    unemployed = {**ANSWERS, "p1_2": 3}  # income stability cap
+    for answers in (ANSWERS, ANSWERS, unemployed):
+        client.post("/calculate-profile", json={"answers": answers})
+    after = _report(client)
+    assert after["profiles"]["count"] == before["profiles"]["count"] + 3
+    assert after["by_type"]["profile_calculation"] == before["by_type"].get("profile_calculation", 0) + 3
+    assert after["restrictions"]["hit_rate"] > 0
+
+    rebuilt = _report(client, rebuild=1)
+    assert not rebuilt["rebuilding"] and rebuilt["rebuilt_entries"] == rebuilt["entries"]
+    assert {k: rebuilt[k] for k in COUNTERS} == {k: after[k] for k in COUNTERS}
+
+
+def test_entries_written_during_a_rebuild_count_once(client):
+    _wait_for_startup_rebuild()
+    flush()
+    started = main._begin_analytics_rebuild()
+    assert main._begin_analytics_rebuild() is None  # one rebuild at a time
+    client.post("/calculate-profile", json={"answers": ANSWERS})
+    flush()
+    state = main._rebuild_analytics(*started)
+    assert state["entries"] == state["rebuilt_entries"] + 1
+    assert state["entries"] == main._chain["entries"]
@@ -0,0 +1,73 @@
+import json
+
+import main
+from conftest import ANSWERS, AUDIT_KEY, flush
+
+
+def _score(client, n):
+    for i in range(n):
+        assert client.post("/calculate-profile", json={"answers": {**ANSWERS, "p1_1": i % 5 + 1}}).status_code == 200
+    flush()
+
+
+def _verify(client, full=True):
+    return client.get("/audit/verify", headers=AUDIT_KEY, params={"full": 1} if full else {})
+
+
+def test_chain_verifies_with_checkpoints(client, monkeypatch):
+    monkeypatch.setattr(main, "AUDIT_CHECKPOINT_EVERY", 3)
+    _score(client, 7)
+    report = _verify(client).json()
+    assert report["ok"], report
+    assert report["signed_checkpoints"] and report["checkpoints_checked"] >= 2
+    assert report["entries"] == main._chain["entries"]
+
+    _score(client, 2)
+    report = _verify(client, full=False).json()
+    assert report["ok"] and report["mode"] == "incremental"
+    assert 0 < report["entries_verified"] < main._chain["entries"]
+
+
+def test_tampered_entry_is_detected(client):
+    _score(client, 3)
+    original = main._LOG_FILE.read_bytes()
+    lines = original.splitlines(keepends=True)
+    entry = json.loads(lines[-2])
+    tampered = lines[-2].replace(f'"score":{entry["score"]}'.encode(), f'"score":{entry["score"] + 1}'.encode(), 1)
+    assert tampered != lines[-2]
+    try:
+        main._LOG_FILE.write_bytes(b"".join(lines[:-2] + [tampered, lines[-1]]))
+        response = _verify(client)
+        assert response.status_code == 409
+        assert response.json()["error"]["reason"] == "hash mismatch"
+    finally:
+        main._LOG_FILE.write_bytes(original)
+    assert _verify(client).json()["ok"]
+
+
+def test_checkpoint_signed_with_audit_key_is_rejected(client):
+    _score(client, 1)
+    original = main._CHECKPOINT_FILE.read_bytes() if main._CHECKPOINT_FILE.exists() else b""
+    c = main._chain
+    message = f'{c["segment"]}:{c["entries"]}:{c["offset"]}:{c["head"]}'.encode()
+    forged = {"segment": c["segment"], "entries": c["entries"], "offset": c["offset"], "hash": c["head"],
+              "sig": main.hmac.new(main.AUDIT_KEY.encode(), message, main.hashlib.sha256).hexdigest()}
+    try:
+        with open(main._CHECKPOINT_FILE, "ab") as f:
+            f.write(json.dumps(forged).encode() + b"\n")
+        response = _verify(client)
+        assert response.status_code == 409
+        assert response.json()["bad_checkpoint_signatures"] == 1
+    finally:
+        main._CHECKPOINT_FILE.write_bytes(original)
+
+
+def test_no_checkpoints_without_signing_key(client, monkeypatch):
+    monkeypatch.setattr(main, "AUDIT_SIGNING_KEY", None)
+    before = main._CHECKPOINT_FILE.read_bytes()
+    monkeypatch.setattr(main, "AUDIT_CHECKPOINT_EVERY", 1)
+    _score(client, 2)
+    assert main._CHECKPOINT_FILE.read_bytes() == before
+    assert main._read_checkpoints() == []
+    report = _verify(client).json()
+    assert report["ok"] and not report["signed_checkpoints"] and report["checkpoints_checked"] == 0
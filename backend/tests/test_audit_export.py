@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+import main
+from conftest import ANSWERS, AUDIT_KEY, flush
+
+numpy = pytest.importorskip("numpy")
+
+# Shape of a profile_calculation written before the rule engine: ESG declined,
+# so p6_2/p6_3 are null, and a numeric string from an LLM tool call
+LEGACY_ENTRY = {
+    "type": "profile_calculation",
+    "session_id": "legacy-session",
+    "profile": "Moderate",
+    "score": 41,
+    "restrictions_count": 0,
+    "result": {
+        "profile": "Moderate",
+        "explanation": {
+            "input_answers": {**ANSWERS, "p1_1": "2", "p6_1": 0, "p6_2": None, "p6_3": None},
+            "total_score": 41,
+            "raw_profile": "Moderate",
+            "final_profile": "Moderate",
+            "scoring_detail": {"block_2": {"score": None}},
+            "restrictions_applied": None,
+            "coherence_checks": [],
+        },
+    },
+}
+
+
+def _export(client, fmt):
+    response = client.get("/audit/export", headers=AUDIT_KEY, params={"format": fmt})
+    assert response.status_code == 200, response.text
+    return response
+
+
+def test_npz_export_maps_null_answers_to_minus_one(client):
+    client.post("/calculate-profile", json={"answers": ANSWERS})
+    main._audit(dict(LEGACY_ENTRY))
+    flush()
+
+    response = _export(client, "npz")
+    data = numpy.load(io.BytesIO(response.content))
+    rows = int(response.headers["x-export-rows"])
+    assert len(data["ts"]) == rows >= 2
+
+    legacy = list(data["session_id"]).index("legacy-session")
+    assert data["p6_2"][legacy] == -1 and data["p6_3"][legacy] == -1
+    assert data["p1_1"][legacy] == 2
+    assert data["block_2_score"][legacy] == -1
+    assert data["total_score"][legacy] == 41
+    assert data["p2_1"].dtype == numpy.int32
+
+    scored = [i for i, sid in enumerate(data["session_id"]) if sid != "legacy-session"][-1]
+    assert data["p2_1"][scored] == ANSWERS["p2_1"] and data["p6_2"][scored] == -1
+
+
+def test_parquet_export_of_null_answers(client):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    main._audit(dict(LEGACY_ENTRY))
+    flush()
+    table = pyarrow_parquet.read_table(io.BytesIO(_export(client, "parquet").content))
+    legacy = table.column("session_id").to_pylist().index("legacy-session")
+    assert table.column("p6_2").to_pylist()[legacy] == -1
+
+
+def test_unavailable_format_is_rejected(client):
+    response = client.get("/audit/export", headers=AUDIT_KEY, params={"format": "csv"})
+    assert response.status_code == 400
+    assert "npz" in response.json()["available"]
@@ -0,0 +1,117 @@
+"""Deploy handoff: two processes on one log directory, as deploy_backend.py
+runs them. The old one serves and writes until it shuts down, the new one
+serves meanwhile but only opens the log once the old one has let go."""
+import json, os, subprocess, sys
+
+import main
+from conftest import ANSWERS
+
+_SERVER = """
+import json, sys, time
+import main
+from fastapi.testclient import TestClient
+
+main.limiter.enabled = False
+answers, entries, role = json.loads(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+with TestClient(main.app) as client:
+    if role == "old":
+        assert main._log_ready.wait(20)
+    for _ in range(entries):
+        assert client.post("/calculate-profile", json={"answers": answers}).status_code == 200
+    key = {"x-audit-key": main.AUDIT_KEY}
+    print("verify", client.get("/audit/verify", headers=key).status_code, flush=True)
+    sys.stdin.readline()
+    if role == "old":
+        sys.exit()
+    assert main._log_ready.wait(20)
+    main._audit_queue.join()
+    report = client.get("/audit/verify", headers=key, params={"full": 1}).json()
+    print("report", json.dumps({"ok": report["ok"], "entries": report["entries"],
+                                 "in_memory": len(main.audit_log)}), flush=True)
+"""
+
+
+def _start(env, entries, role):
+    return subprocess.Popen([sys.executable, "-c", _SERVER, json.dumps(ANSWERS), str(entries), role],
+                            cwd=os.path.dirname(main.__file__), env=env, text=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def _read(proc, tag):
+    """Next line the script printed under tag (the app logs to stdout too)."""
+    for line in proc.stdout:
+        if line.startswith(tag + " "):
+            return line.split(" ", 1)[1].strip()
+    raise AssertionError(f"process exited without printing {tag!r}")
+
+
+def test_new_process_waits_for_the_log_and_takes_over_the_tail(tmp_path):
+    env = dict(os.environ, LOG_DIR=str(tmp_path / "logs"), AUDIT_LOCK_POLL="0.05")
+    old = _start(env, 3, "old")
+    new = None
+    try:
+        assert _read(old, "verify") == "200"
+        new = _start(env, 2, "new")
+        assert _read(new, "verify") == "503"  # serving, but the old process holds the log
+        new.stdin.write("\n")
+        new.stdin.flush()
+        old.communicate("\n", timeout=30)
+        assert old.returncode == 0
+
+        report = json.loads(_read(new, "report"))
+        new.communicate(timeout=30)
+        assert new.returncode == 0
+    finally:
+        for proc in (old, new):
+            if proc is not None:
+                proc.kill()
+    assert report == {"ok": True, "entries": 5, "in_memory": 5}
+    tail = json.loads((tmp_path / "logs" / "audit_tail.json").read_text())["entries"]
+    assert len(tail) == 5
+
+
+_SESSION_SERVER = """
+import json, sys, threading, time
+import main
+from fastapi.testclient import TestClient
+
+role = sys.argv[1]
+with TestClient(main.app) as client:
+    if role == "old":
+        assert main._log_ready.wait(20)
+        main._get_session("s1").history.append(main.HistoryItem("user", "my savings are 40K"))
+        print("ready", len(main.sessions), flush=True)
+        sys.stdin.readline()
+        sys.exit()
+    out = {}
+    request = threading.Thread(target=lambda: out.update(client.get("/history/s1").json()))
+    request.start()
+    request.join(1)
+    print("waiting", request.is_alive(), flush=True)  # held until the old process has saved
+    request.join(30)
+    print("history", json.dumps([h["transcript"] for h in out["history"]]), flush=True)
+"""
+
+
+def test_new_process_waits_for_the_old_sessions(tmp_path):
+    env = dict(os.environ, LOG_DIR=str(tmp_path / "logs"), AUDIT_LOCK_POLL="0.05")
+    procs = []
+
+    def start(role):
+        procs.append(subprocess.Popen([sys.executable, "-c", _SESSION_SERVER, role],
+                                      cwd=os.path.dirname(main.__file__), env=env, text=True,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+        return procs[-1]
+
+    try:
+        old = start("old")
+        assert _read(old, "ready") == "1"
+        new = start("new")
+        assert _read(new, "waiting") == "True"
+        old.communicate("\n", timeout=30)
+        assert json.loads(_read(new, "history")) == ["my savings are 40K"]
+        new.communicate(timeout=30)
+        assert new.returncode == 0
+    finally:
+        for proc in procs:
+            proc.kill()
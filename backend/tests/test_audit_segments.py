@@ -0,0 +1,46 @@
+import os, subprocess, sys, time
+
+import main
+from conftest import ANSWERS, AUDIT_KEY, flush
+
+
+def _wait_compressed():
+    deadline = time.time() + 10
+    while any(d["codec"] is None for d in main._segments):
+        assert time.time() < deadline, "segments were not compressed"
+        time.sleep(0.05)
+
+
+def test_segments_rotate_compress_and_verify(client, monkeypatch):
+    sealed_before = len(main._segments)
+    monkeypatch.setattr(main, "AUDIT_SEGMENT_MAX_BYTES", 4096)
+    for i in range(12):
+        client.post("/calculate-profile", json={"answers": {**ANSWERS, "p2_1": i % 5}})
+    flush()
+    _wait_compressed()
+
+    assert len(main._segments) > sealed_before
+    index = main._json_loads(main._INDEX_FILE.read_bytes())["segments"]
+    assert [d["segment"] for d in index] == [d["segment"] for d in main._segments]
+    for desc in index[sealed_before:]:
+        assert desc["codec"] in ("gzip", "zstd")
+        assert (main._SEGMENT_DIR / desc["file"]).exists()
+        assert desc["chain_end"]["entries"] - desc["chain_start"]["entries"] == desc["entries"]
+
+    report = client.get("/audit/verify", headers=AUDIT_KEY, params={"full": 1}).json()
+    assert report["ok"], report
+    assert report["segments_read"] == len(main._segments) + 1
+
+    logs = client.get("/logs", headers=AUDIT_KEY, params={"last": 10, "type": "profile_calculation"}).json()
+    assert logs["returned"] == 10 and logs["segments_read"] >= 2
+    answers = [e["result"]["explanation"]["input_answers"]["p2_1"] for e in logs["entries"][-5:]]
+    assert answers == [i % 5 for i in range(7, 12)]
+
+
+def test_import_does_not_touch_the_log(tmp_path):
+    env = dict(os.environ, LOG_DIR=str(tmp_path / "logs"))
+    code = "import main, threading; print(len(threading.enumerate()))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(main.__file__), env=env,
+                         capture_output=True, text=True, check=True).stdout
+    assert out.split() == ["1"]
+    assert not (tmp_path / "logs").exists()
@@ -0,0 +1,24 @@
+import main
+from conftest import ANSWERS, flush
+
+
+def test_record_keeps_entry_timestamp():
+    entry = {"type": "llm_call", "rules_hash": "x", "timestamp": 1700000000.5}
+    assert main.AuditRecord.from_entry(entry).ts == 1700000000.5
+    rendered = main.AuditRecord.from_entry(entry).to_dict()["timestamp"]
+    assert main.AuditRecord.from_entry({**entry, "timestamp": rendered}).ts == 1700000000.5
+
+
+def test_requests_are_shed_while_the_writer_is_behind(client, monkeypatch):
+    monkeypatch.setattr(main, "AUDIT_QUEUE_SIZE", 0)  # any backlog counts as full
+    before, written = main._audit_writer_stats["shed"], len(main.audit_log)
+    response = client.post("/calculate-profile", json={"answers": ANSWERS})
+    assert response.status_code == 503 and response.headers["retry-after"]
+    chat = client.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "hi"}]})
+    assert chat.status_code == 503 and chat.json()["lane"] == "audit"
+    assert len(main.audit_log) == written  # shed before any work
+    assert client.get("/health").json()["background"]["shed"] == before + 2
+
+    monkeypatch.setattr(main, "AUDIT_QUEUE_SIZE", 10000)
+    assert client.post("/calculate-profile", json={"answers": ANSWERS}).status_code == 200
+    flush()
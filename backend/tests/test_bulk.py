@@ -0,0 +1,56 @@
+import json
+
+import main
+from conftest import ANSWERS, flush
+
+BULK_KEY = {"x-api-key": "test-bulk-key"}
+
+
+def _bulk(client, lines, **params):
+    body = "".join(line if isinstance(line, str) else json.dumps(line) + "\n" for line in lines)
+    response = client.post("/calculate-profile/bulk", content=body.encode(), headers=BULK_KEY, params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_bulk_scores_lines_in_order_with_errors_inline(client):
+    out = _bulk(client, [
+        {"id": "a", "answers": ANSWERS},
+        "not json\n",
+        "\n",
+        {"id": "b", "answers": {**ANSWERS, "p2_1": -1}},
+        {"id": "c", "answers": ANSWERS, "rules_version": "no-such-version"},
+        json.dumps({"id": "d", "answers": {**ANSWERS, "p1_2": 3}}),  # last line, no newline
+    ], compact=1)
+    *rows, summary = out
+    assert [(r["line"], r.get("id")) for r in rows] == [(1, "a"), (2, None), (4, "b"), (5, "c"), (6, "d")]
+    assert rows[1]["error"] == "Invalid JSON"
+    assert rows[2]["error"] == "Invalid answers" and rows[2]["detail"][0]["field"] == "answers.p2_1"
+    assert rows[3]["error"].startswith("Unknown rules version")
+    single = client.post("/calculate-profile", json={"answers": ANSWERS}).json()
+    assert rows[0]["profile"] == single["profile"] and rows[0]["allocation"] == single["allocation"]
+    assert rows[4]["restrictions"]
+    assert summary["summary"]["lines"] == 5
+    assert summary["summary"]["scored"] == 2 and summary["summary"]["errors"] == 3
+
+
+def test_bulk_results_are_audited_with_bulk_id(client):
+    *rows, summary = _bulk(client, [{"id": f"r{i}", "answers": ANSWERS} for i in range(3)])
+    assert all(r["result"]["profile"] for r in rows)
+    bulk_id = summary["summary"]["bulk_id"]
+    flush()
+    audited = [e for e in main.audit_log if e.get("bulk_id") == bulk_id]
+    assert [e.get("client_ref") for e in audited] == ["r0", "r1", "r2"]
+
+
+def test_bulk_requires_api_key(client):
+    assert client.post("/calculate-profile/bulk", content=b"{}\n").status_code == 401
+    audit_key = {"x-api-key": main.AUDIT_KEY}
+    assert client.post("/calculate-profile/bulk", content=b"{}\n", headers=audit_key).status_code == 401
+
+
+def test_bulk_is_disabled_without_its_own_key(client, monkeypatch):
+    monkeypatch.setattr(main, "BULK_API_KEY", None)
+    response = client.post("/calculate-profile/bulk", content=b"{}\n", headers=BULK_KEY)
+    assert response.status_code == 503
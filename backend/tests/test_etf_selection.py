@@ -0,0 +1,32 @@
+import pytest
+
+import main
+
+SFDR = main.ESG_TYPES.index("Art. 8/Art. 9 SFDR")
+
+
+@pytest.mark.parametrize("profile", list(main.PROFILE_ETFS))
+@pytest.mark.parametrize("esg_type", range(len(main.ESG_TYPES)))
+@pytest.mark.parametrize("level", range(len(main.ESG_MINIMUMS)))
+def test_esg_substitutes_keep_asset_class_risk_and_count(profile, esg_type, level):
+    standard, _ = main._get_etf_selection(profile)
+    selection, unmatched = main._get_etf_selection(profile, esg_type, level)
+    assert selection.keys() == standard.keys()
+    for asset_class, picks in selection.items():
+        assert len(picks) == len(standard[asset_class])
+        assert len({e["ticker"] for e in picks}) == len(picks)
+        for pick, original in zip(picks, standard[asset_class]):
+            assert pick["asset_class"] == asset_class
+            if pick is not original:
+                assert pick["sri"] == original["sri"]
+                assert main._meets_esg(pick, esg_type, main.ESG_MINIMUMS[level])
+        if asset_class not in unmatched:
+            assert all(main._meets_esg(e, esg_type, main.ESG_MINIMUMS[level]) for e in picks)
+
+
+def test_moderate_sfdr_preference_gets_no_thematic_equity():
+    selection, unmatched = main._get_etf_selection("Moderate", SFDR, main.ESG_MINIMUMS.index(50))
+    tickers = {ac: [e["ticker"] for e in picks] for ac, picks in selection.items()}
+    assert "INRG" not in tickers["Equities"]
+    assert tickers["Bonds"] == ["AGG", "GRON", "VCIT"]
+    assert "Bonds" in unmatched
@@ -0,0 +1,13 @@
+from conftest import AUDIT_KEY
+
+
+def test_llm_metrics_need_the_audit_key(client):
+    assert client.get("/metrics/llm").status_code == 401
+    assert client.get("/metrics/llm", params={"session_id": "s1"}).status_code == 401
+    report = client.get("/metrics/llm", headers=AUDIT_KEY).json()
+    assert "top_sessions" in report
+
+
+def test_loop_metrics_need_the_audit_key(client):
+    assert client.get("/metrics/loop").status_code == 401
+    assert "stalls" in client.get("/metrics/loop", headers=AUDIT_KEY).json()
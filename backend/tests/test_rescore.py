@@ -0,0 +1,26 @@
+import json, os, subprocess, sys
+
+import main
+from conftest import ANSWERS
+
+
+def test_rescore_matches_the_endpoint_and_leaves_no_log(tmp_path):
+    source = tmp_path / "answers.jsonl"
+    lines = [{"id": "a", "answers": ANSWERS}, {"id": "b", "answers": {**ANSWERS, "p1_2": 3}}, {"id": "c", "answers": {"p1_1": -1}}]
+    source.write_text("".join(json.dumps(line) + "\n" for line in lines))
+    target = tmp_path / "out.jsonl"
+    env = dict(os.environ, LOG_DIR=str(tmp_path / "logs"))
+    backend = os.path.dirname(main.__file__)
+    run = subprocess.run([sys.executable, os.path.join(backend, "rescore.py"), str(source), "-o", str(target),
+                          "--workers", "2", "--chunk-size", "1", "--json"],
+                         cwd=backend, env=env, capture_output=True, text=True, check=True)
+
+    summary = json.loads(run.stdout.splitlines()[-1])
+    assert (summary["scored"], summary["errors"]) == (2, 1)
+    rows = [json.loads(line) for line in target.read_text().splitlines()]
+    assert [r["id"] for r in rows] == ["a", "b", "c"] and "error" in rows[2]
+    for row, line in zip(rows[:2], lines):
+        expected = main._build_profile_result(main.ProfileAnswers.model_validate(line["answers"]).as_dict(),
+                                              main._get_ruleset())
+        assert (row["profile"], row["allocation"]) == (expected["profile"], expected["allocation"])
+    assert not (tmp_path / "logs").exists()
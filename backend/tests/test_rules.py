@@ -0,0 +1,83 @@
+"""The compiled rule table against the restrictions and coherence check as
+they were hand-coded in calculate_profile before the rule engine."""
+import random
+
+import pytest
+
+import main
+
+OPTIONS = {"p1_1": 5, "p1_2": 6, "p1_3": 3, "p2_1": 5, "p2_2": 5, "p2_3": 4, "p2_4": 4, "p2_5": 4,
+           "p3_1": 4, "p3_2": 4, "p3_3": 4, "p3_4": 3, "p3_5": 3, "p4_1": 4, "p4_2": 4, "p4_3": 4,
+           "p4_4": 4, "p4_5": 4, "p5_1": 4, "p5_2": 5, "p5_3": 4, "p5_4": 4}
+MODERATE_CAP = "Maximum profile capped at Moderate"
+
+
+def _baseline(answers, block_scores):
+    """(restrictions, coherence, final profile, adjustments) the old inline checks produced."""
+    restrictions, coherence, adjustments = [], [], []
+    max_level = 5
+    age, employment, dependents = answers.get("p1_1", 2), answers.get("p1_2", 0), answers.get("p1_3", 0)
+    if age >= 3:
+        max_level = min(max_level, 3)
+        restrictions.append({"rule": "Age restriction (MiFID II Art. 25)",
+                             "reason": f"Client age range {main.AGE_LABELS[min(age, 4)]} (>65): higher-risk profiles unsuitable",
+                             "effect": MODERATE_CAP})
+    if employment in (3, 5):
+        max_level = min(max_level, 2)
+        restrictions.append({"rule": "Income stability restriction",
+                             "reason": f"Employment status '{main.EMPLOYMENT_LABELS[min(employment, 5)]}': limited income stability",
+                             "effect": "Maximum profile capped at Moderate Conservative"})
+    if dependents >= 2:
+        restrictions.append({"rule": "Dependents adjustment", "reason": "3+ financial dependents increases obligations",
+                             "effect": "Profile reduced by one level"})
+    b2, b3 = block_scores["block_2"], block_scores["block_3"]
+    if b2 < 8:
+        max_level = min(max_level, 1)
+        restrictions.append({"rule": "Financial capacity restriction",
+                             "reason": f"Financial situation score {b2}/22 (below threshold of 8)",
+                             "effect": "Maximum profile capped at Conservative"})
+    if b3 < 5:
+        max_level = min(max_level, 2)
+        restrictions.append({"rule": "Knowledge restriction (MiFID II appropriateness)",
+                             "reason": f"Knowledge score {b3}/16 (below threshold of 5)",
+                             "effect": "Maximum profile capped at Moderate Conservative"})
+    if answers.get("p4_2", 2) == 0:
+        max_level = min(max_level, 3)
+        restrictions.append({"rule": "Short horizon restriction",
+                             "reason": "Investment horizon < 1 year: volatile products unsuitable",
+                             "effect": MODERATE_CAP})
+    if answers.get("p5_2", 1) == 0 and answers.get("p5_4", 0) >= 2:
+        coherence.append({"flag": "INCONSISTENCY DETECTED",
+                          "detail": "Client accepts 0% loss but selected high risk/return preference",
+                          "recommendation": "Advisor should discuss risk expectations with client"})
+
+    total = sum(block_scores.values())
+    profiles = main._get_ruleset()["profiles"]
+    raw_level = next((i for i, (_, low, high) in enumerate(profiles) if low <= total <= high), 3)
+    level = min(raw_level, max_level)
+    if dependents >= 2:
+        level = max(0, level - 1)
+        adjustments.append("Reduced by 1 level due to 3+ dependents")
+    if profiles[raw_level][0] != profiles[level][0]:
+        adjustments.append(f"Profile adjusted from '{profiles[raw_level][0]}' to '{profiles[level][0]}' due to regulatory restrictions")
+    return restrictions, coherence, profiles[level][0], adjustments
+
+
+def _answer_sets():
+    rng = random.Random(26)
+    yield {}
+    yield {"p1_1": 4, "p1_2": 5, "p1_3": 2, "p4_2": 0, "p5_2": 0, "p5_4": 3}  # every rule at once
+    for _ in range(300):
+        yield {key: rng.randrange(n) for key, n in OPTIONS.items() if rng.random() > 0.1}
+
+
+@pytest.mark.parametrize("answers", list(_answer_sets()))
+def test_rule_table_matches_baseline_checks(answers):
+    result = main._build_profile_result(answers, main._get_ruleset())
+    explanation = result["explanation"]
+    blocks = {block: detail["score"] for block, detail in explanation["scoring_detail"].items() if block != "block_1"}
+    restrictions, coherence, profile, adjustments = _baseline(answers, blocks)
+    assert explanation["restrictions_applied"] == restrictions
+    assert explanation["coherence_checks"] == coherence
+    assert result["profile"] == profile
+    assert explanation["adjustments"] == adjustments
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def one_slot(monkeypatch):
+    """One upstream slot, a two-deep queue and short waits."""
+    monkeypatch.setattr(main, "LLM_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(main, "LLM_QUEUE_SIZE", 2)
+    monkeypatch.setattr(main, "LLM_QUEUE_TIMEOUT", 0.2)
+    active = main._upstream["active"]
+    yield
+    assert main._queue_depth() == 0
+    main._upstream["active"] = active
+
+
+def test_timed_out_waiter_leaves_the_queue(one_slot):
+    async def scenario():
+        held = await main._upstream_slot("chat")
+        with pytest.raises(main._Overloaded):
+            await main._upstream_slot("chat")
+        assert main._queue_depth() == 0
+        held.release()
+        (await main._upstream_slot("chat")).release()  # free slot admits at once
+
+    asyncio.run(scenario())
+    assert main._upstream["active"] == 0
+
+
+def test_cancelled_waiter_leaves_the_queue(one_slot):
+    async def scenario():
+        held = await main._upstream_slot("voice")
+        waiter = asyncio.create_task(main._upstream_slot("voice"))
+        await asyncio.sleep(0.01)
+        assert main._queue_depth() == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert main._queue_depth() == 0
+        held.release()
+
+    asyncio.run(scenario())
+    assert main._upstream["active"] == 0
+
+
+def test_voice_lane_is_served_first_and_full_queue_sheds(one_slot):
+    order = []
+
+    async def wait(lane):
+        slot = await main._upstream_slot(lane)
+        order.append(lane)
+        slot.release()
+
+    async def scenario():
+        held = await main._upstream_slot("steer")
+        tasks = [asyncio.create_task(wait("chat")), asyncio.create_task(wait("voice"))]
+        await asyncio.sleep(0.01)
+        with pytest.raises(main._Overloaded) as shed:
+            await main._upstream_slot("steer")
+        assert shed.value.retry_after >= 1
+        held.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ["voice", "chat"]
+
+
+def test_shed_voice_request_is_not_charged(client, one_slot, monkeypatch):
+    monkeypatch.setattr(main, "LLM_QUEUE_SIZE", 0)
+    main._upstream["active"] = 1
+    body = {"model": "x", "messages": [{"role": "user", "content": "hello " * 200}]}
+    response = client.post("/v1/chat/completions", json=body, headers={"x-session-id": "shed-session"})
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    assert ("session", "shed-session") not in main._buckets
+
+    metrics = client.get("/metrics/upstream").json()
+    assert metrics["queue_depth"] == 0 and metrics["lanes"]["voice"]["shed"] >= 1
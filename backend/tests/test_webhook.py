@@ -0,0 +1,58 @@
+import time
+
+import main
+from conftest import AUDIT_KEY, flush
+
+
+def _wait_processed(count):
+    deadline = time.time() + 5
+    while main._webhook_stats["processed"] < count:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_webhook_acknowledges_with_session_id(client):
+    processed = main._webhook_stats["processed"]
+    payload = {"type": "post_call_transcription", "data": {
+        "conversation_id": "conv_123",
+        "metadata": {"start_time_unix_secs": time.time() - 60, "call_duration_secs": 60},
+        "transcript": [{"role": "agent", "message": "Hello", "time_in_call_secs": 0},
+                       {"role": "user", "message": "Hi there", "time_in_call_secs": 2}],
+    }}
+    response = client.post("/webhook/elevenlabs", json=payload)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "received" and body["session_id"] == "conv_123" and body["ingest_id"]
+
+    _wait_processed(processed + 1)
+    flush()
+    stored = client.get("/transcripts/conv_123", headers=AUDIT_KEY).json()
+    assert [t["role"] for t in stored["turns"]] == ["agent", "user"]
+    entry = next(e for e in reversed(main.audit_log) if e.type is main.AuditType.WEBHOOK)
+    assert entry.get("session_id") == "conv_123" and entry.get("transcript_length") == len("Hello") + len("Hi there")
+
+
+def test_webhook_without_conversation_id_falls_back_to_ingest_id(client):
+    body = client.post("/webhook/elevenlabs", json={"transcript": "plain text"}).json()
+    assert body["session_id"] == body["ingest_id"]
+
+
+def test_webhook_rejects_non_object_bodies(client):
+    assert client.post("/webhook/elevenlabs", content=b"not json").status_code == 400
+    assert client.post("/webhook/elevenlabs", json=[1, 2]).status_code == 400
+
+
+def test_linked_profiles_survive_out_of_order_entries(monkeypatch):
+    def record(ts, profile, session_id=None):
+        entry = {"type": "profile_calculation", "timestamp": ts, "rules_hash": "x", "profile": profile}
+        if session_id:
+            entry["session_id"] = session_id
+        return main.AuditRecord.from_entry(entry)
+
+    start = time.time() - 120
+    log = [record(start + 10, "Moderate", "conv_9"),
+           record(start - 86400, "Conservative"),  # older entry written later (e.g. a handoff tail)
+           record(start + 30, "Aggressive")]
+    monkeypatch.setattr(main, "audit_log", log)
+    linked = main._linked_profiles("conv_9", start, start + 60)
+    assert [p["profile"] for p in linked] == ["Moderate", "Aggressive"]
@@ -1,4 +1,4 @@
-import sys, io, time, os
+import sys, io, json, time, os
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
@@ -15,7 +15,18 @@ USER = os.getenv('VPS_USER', 'root')
 PASS = os.environ['VPS_PASS']
 
 LOCAL_FILE = r'c:\Users\inigo\OneDrive\Documents\Msc. Computer Science\Venture Lab\Venture_Lab\backend\main.py'
-REMOTE_FILE = '/root/voice-agent/backend/main.py'
+REMOTE_DIR = '/root/voice-agent/backend'
+REMOTE_FILE = f'{REMOTE_DIR}/main.py'
+REMOTE_CONFIG = f'{REMOTE_DIR}/config'  # CONFIG_DIR on the server
+
+# Matches the running backend (the brackets keep pgrep/pkill from matching
+# the shell running the command)
+BACKEND_PATTERN = '"[u]vicorn main:app|[p]ython main.py"'
+START_CMD = f'cd {REMOTE_DIR} && source venv/bin/activate && nohup python main.py >> /tmp/backend.log 2>&1 &'
+
+USAGE = """Usage:
+  python deploy_backend.py                          upload main.py, hand off to a new process
+  python deploy_backend.py --content FILE [RULES...] upload content.json (and rule set files), reload in place"""
 
 def ssh_run(client, cmd, timeout=60):
     print(f'\n>>> {cmd}')
@@ -30,33 +41,97 @@ def ssh_run(client, cmd, timeout=60):
     print(f'[exit_code: {exit_code}]')
     return out, err, exit_code
 
-def main():
-    print(f'Connecting to {HOST}...')
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(HOST, username=USER, password=PASS, timeout=15)
-    print('Connected.')
+def upload(sftp, local, remote):
+    """Upload next to the target, then rename over it, so the server never
+    reads a half-written file."""
+    sftp.put(local, remote + '.tmp')
+    sftp.posix_rename(remote + '.tmp', remote)
+    print(f'Uploaded {os.path.basename(local)} -> {remote} ({sftp.stat(remote).st_size} bytes)')
+
+
+def health(client):
+    out, _, _ = ssh_run(client, 'curl -s http://localhost:8000/health', timeout=15)
+    try:
+        return json.loads(out)
+    except ValueError:
+        return None
+
 
-    # Step 1: Upload main.py via SFTP
-    print(f'\n=== STEP 1: Upload main.py ===')
+def deploy_content(client, content_file, rule_files):
+    """Content-only deploy: no restart, sessions and caches stay warm."""
+    print('\n=== STEP 1: Upload config ===')
+    ssh_run(client, f'mkdir -p {REMOTE_CONFIG}/rules')
     sftp = client.open_sftp()
-    sftp.put(LOCAL_FILE, REMOTE_FILE)
-    remote_stat = sftp.stat(REMOTE_FILE)
-    print(f'Uploaded successfully. Remote file size: {remote_stat.st_size} bytes')
+    for path in rule_files:  # rule sets first, content.json may name one
+        upload(sftp, path, f'{REMOTE_CONFIG}/rules/{os.path.basename(path)}')
+    upload(sftp, content_file, f'{REMOTE_CONFIG}/content.json')
     sftp.close()
 
-    # Step 2: Restart backend
-    print('\n=== STEP 2: Restart backend ===')
-    restart_cmd = 'pkill -f "uvicorn main:app" ; sleep 2 ; cd /root/voice-agent/backend && source venv/bin/activate && nohup uvicorn main:app --host 0.0.0.0 --port 8000 > /tmp/backend.log 2>&1 &'
-    ssh_run(client, restart_cmd, timeout=30)
+    print('\n=== STEP 2: Reload (SIGHUP) ===')
+    ssh_run(client, f'pkill -HUP -f {BACKEND_PATTERN}')
+    time.sleep(1)
+    ssh_run(client, 'curl -s http://localhost:8000/config')
 
-    # Step 3: Wait 3 seconds, then test
-    print('\n=== STEP 3: Wait 3s, then test endpoint ===')
-    time.sleep(3)
 
+def deploy_code(client):
+    """Code deploy: the new process starts beside the old one (SO_REUSEPORT),
+    then the old one drains and exits. The new one takes over the audit log
+    only once the old one has released it. Falls back to a cold restart when
+    the old process can't share the port (started with plain uvicorn)."""
+    print('\n=== STEP 1: Upload main.py ===')
+    sftp = client.open_sftp()
+    upload(sftp, LOCAL_FILE, REMOTE_FILE)
+    sftp.close()
+
+    print('\n=== STEP 2: Start new process ===')
+    out, _, _ = ssh_run(client, f'pgrep -f {BACKEND_PATTERN}')
+    old_pids = out.split()
+    ssh_run(client, START_CMD, timeout=30)
+
+    new_pid = None
+    for _ in range(20):
+        time.sleep(1)
+        h = health(client)
+        if h and str(h.get('pid')) not in old_pids:
+            new_pid = h['pid']
+            break
+
+    if old_pids:
+        print('\n=== STEP 3: Drain old process ===')
+        if new_pid:
+            # SIGTERM: open SSE streams are closed (clients reconnect to the new
+            # process), in-flight requests finish, sessions and the audit tail
+            # are saved, then the audit log lock passes to the new process
+            ssh_run(client, f'kill -TERM {" ".join(old_pids)}')
+        else:
+            print('New process is not serving (port not shareable?), cold restart')
+            ssh_run(client, f'kill -TERM {" ".join(old_pids)} ; sleep 3 ; {START_CMD}', timeout=30)
+            time.sleep(3)
+
+    # Smoke test
+    print('\n=== STEP 4: Test endpoint ===')
     test_cmd = 'curl -s -w "\nHTTP_CODE:%{http_code}\nTIME:%{time_total}s\n" -X POST http://localhost:8000/v1/chat/completions -H "Content-Type: application/json" -d ' + "'" + '{"model":"llama3.1:8b","messages":[{"role":"system","content":"You are a financial advisor"},{"role":"user","content":"hello"}],"temperature":0.0,"max_tokens":-1}' + "'"
     ssh_run(client, test_cmd, timeout=180)
 
+
+def main():
+    args = sys.argv[1:]
+    content_deploy = args[:1] == ['--content']
+    if args and not (content_deploy and len(args) >= 2):
+        print(USAGE)
+        sys.exit(2)
+
+    print(f'Connecting to {HOST}...')
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(HOST, username=USER, password=PASS, timeout=15)
+    print('Connected.')
+
+    if content_deploy:
+        deploy_content(client, args[1], args[2:])
+    else:
+        deploy_code(client)
+
     # Also check backend log
     print('\n=== Backend log (last 20 lines) ===')
     ssh_run(client, 'tail -20 /tmp/backend.log')
@@ -1,9 +1,10 @@
-import React, { useState, useCallback, useEffect } from 'react';
+import React, { useState, useCallback, useEffect, useRef } from 'react';
 import { useConversation } from '@elevenlabs/react';
 import './App.css';
 
 const AGENT_ID = 'agent_3901kgmswk5ve9etvy9c1h4g2e40';
 const API_URL = 'http://168.231.87.2:8000';
+const AUDIT_KEY = new URLSearchParams(window.location.search).get('key') || '';
 
 function App() {
   const [messages, setMessages] = useState([]);
@@ -39,13 +40,46 @@ function App() {
     await conversation.endSession();
   }, [conversation]);
 
-  const sendText = async () => {
-    if (!textInput.trim()) return;
-    const userMsg = textInput;
-    setTextInput('');
-    setMessages(prev => [...prev, { role: 'user', text: userMsg }]);
-    setLoading(true);
+  // Text chat runs over one WebSocket per session so replies stream in and
+  // profile results show up as soon as calculate_profile runs.
+  const socketRef = useRef(null);
+
+  const appendStreaming = (prev, msg) => {
+    const last = prev[prev.length - 1];
+    return [...(last && last.streaming ? prev.slice(0, -1) : prev), msg];
+  };
+
+  const openSocket = () => {
+    const ws = new WebSocket(`${API_URL.replace(/^http/, 'ws')}/ws/chat/${sessionId}`);
+    ws.onmessage = (ev) => {
+      const frame = JSON.parse(ev.data);
+      if (frame.type === 'token') {
+        setMessages(prev => {
+          const last = prev[prev.length - 1];
+          const text = (last && last.streaming ? last.text : '') + frame.text;
+          return appendStreaming(prev, { role: 'assistant', text, streaming: true });
+        });
+      } else if (frame.type === 'profile') {
+        setLatestProfile({ type: 'profile_calculation', profile: frame.result.profile, result: frame.result });
+      } else if (frame.type === 'reply') {
+        setMessages(prev => appendStreaming(prev, { role: 'assistant', text: frame.reply }));
+        setLoading(false);
+      } else if (frame.type === 'error') {
+        setMessages(prev => appendStreaming(prev, { role: 'assistant', text: 'Error: ' + frame.error }));
+        setLoading(false);
+      }
+    };
+    ws.onclose = () => {
+      socketRef.current = null;
+      setLoading(false);
+    };
+    socketRef.current = ws;
+    return ws;
+  };
+
+  useEffect(() => () => socketRef.current && socketRef.current.close(), []);
 
+  const sendTextHttp = async (userMsg) => {
     try {
       const resp = await fetch(`${API_URL}/chat/${sessionId}`, {
         method: 'POST',
@@ -60,11 +94,37 @@ function App() {
     setLoading(false);
   };
 
+  const sendText = async () => {
+    if (!textInput.trim()) return;
+    const userMsg = textInput;
+    setTextInput('');
+    setMessages(prev => [...prev, { role: 'user', text: userMsg }]);
+    setLoading(true);
+
+    if (typeof WebSocket === 'undefined') return sendTextHttp(userMsg);
+    const ws = socketRef.current || openSocket();
+    const payload = JSON.stringify({ message: userMsg });
+    if (ws.readyState === WebSocket.OPEN) return ws.send(payload);
+    // Fall back to HTTP only if this socket fails before it opens; once the
+    // message is sent, a later socket error must not resend it.
+    const onOpen = () => {
+      ws.removeEventListener('error', onError);
+      ws.send(payload);
+    };
+    const onError = () => {
+      ws.removeEventListener('open', onOpen);
+      sendTextHttp(userMsg);
+    };
+    ws.addEventListener('open', onOpen, { once: true });
+    ws.addEventListener('error', onError, { once: true });
+  };
+
   const fetchAudit = async () => {
+    const q = `?key=${encodeURIComponent(AUDIT_KEY)}`;
     try {
       const [auditResp, profileResp] = await Promise.all([
-        fetch(`${API_URL}/audit`),
-        fetch(`${API_URL}/audit/latest-profile`),
+        fetch(`${API_URL}/audit${q}`),
+        fetch(`${API_URL}/audit/latest-profile${q}`),
       ]);
       setAuditData(await auditResp.json());
       setLatestProfile(await profileResp.json());
@@ -73,8 +133,28 @@ function App() {
     }
   };
 
+  // While the audit panel is open, /audit/stream pushes new entries and
+  // profile changes instead of re-fetching the last 50 entries.
   useEffect(() => {
-    if (showAudit) fetchAudit();
+    if (!showAudit) return undefined;
+    if (typeof EventSource === 'undefined') {
+      fetchAudit();
+      return undefined;
+    }
+    const es = new EventSource(`${API_URL}/audit/stream?key=${encodeURIComponent(AUDIT_KEY)}`);
+    es.addEventListener('snapshot', (ev) => {
+      const { latest_profile: profile, ...data } = JSON.parse(ev.data);
+      setAuditData(data);
+      setLatestProfile(profile || { message: 'No profiles calculated yet' });
+    });
+    es.addEventListener('audit', (ev) => {
+      const { total_entries, entries } = JSON.parse(ev.data);
+      setAuditData(prev => prev && prev.entries
+        ? { ...prev, total_entries, entries: [...prev.entries, ...entries].slice(-50) }
+        : prev);
+    });
+    es.addEventListener('profile', (ev) => setLatestProfile(JSON.parse(ev.data)));
+    return () => es.close();
   }, [showAudit]);
 
   return (